@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""
+Throughput of the reply parsing: the regex path the clients used to run
+on every received chunk against LineFramer + decode_vectors.
+
+    python benchmarks/bench_parsing.py [samples] [chunk size]
+"""
+import os
+import random
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from trebla_client.framing import LineFramer, decode_vectors
+
+accRegex = r"[-+]?\d*\.\d+|\d+"
+
+
+def make_stream(samples):
+    # same formatting as java.util.Arrays.toString(float[])
+    lines = ["[%.7g, %.7g, %.7g]" % (random.uniform(-20, 20), random.uniform(-20, 20), random.uniform(-20, 20)) for _ in range(samples)]
+    return ("\n".join(lines) + "\n").encode("ascii")
+
+
+def chunks(stream, size):
+    return [stream[i:i + size] for i in range(0, len(stream), size)]
+
+
+def regex_path(packets):
+    # one regex and three float() per reply, as in SocketClientThread.run
+    count = 0
+    for packet in packets:
+        for line in packet.decode("ascii").rstrip().split("\n"):
+            accData = re.findall(accRegex, line)
+            if len(accData) == 3:
+                float(accData[0]), float(accData[1]), float(accData[2])
+                count += 1
+    return count
+
+
+def framer_path(packets):
+    framer = LineFramer()
+    count = 0
+    for packet in packets:
+        lines = framer.feed(packet)
+        if lines:
+            values, malformed = decode_vectors(lines, 3)
+            count += len(values)
+    return count
+
+
+def bench(function, packets, repeat=5):
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        count = function(packets)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return count, best
+
+
+def main():
+    samples = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    size = int(sys.argv[2]) if len(sys.argv) > 2 else 1024
+    # the regex path only works when every chunk holds whole lines, feed it
+    # one line per chunk like a stop-and-wait client sees them
+    stream = make_stream(samples)
+    per_line = [line + b"\n" for line in stream.split(b"\n")[:-1]]
+
+    for name, function, packets in (("regex (1 line/recv)", regex_path, per_line),
+                                    ("framer (1 line/recv)", framer_path, per_line),
+                                    ("framer (%d B/recv)" % size, framer_path, chunks(stream, size))):
+        count, elapsed = bench(function, packets)
+        print("%-24s %8d samples %8.3f s %12.0f samples/s" % (name, count, elapsed, count / elapsed))
+
+
+if __name__ == '__main__':
+    main()
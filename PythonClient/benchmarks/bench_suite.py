@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+"""
+Benchmarks of the client pipeline, against the stand-in server.
+
+End to end: a TreblaClient polls "sensor acc" from a stand-in server
+running in another process, for several pipeline windows, and reports
+samples/s, request latency percentiles, client CPU and RSS. Micro
+benchmarks time the hot pieces: reply parsing (accRegex against
+LineFramer + decode_vectors), history append (list.pop(0) against
+SampleRing, batches of several sizes: the ring only wins from a few
+samples per extend on, reported as append_crossover_batch) and one plot
+frame of the GraphFrame figure (trebla_client.graph.AccGraph, the axes,
+PSD and spectrogram) on an Agg canvas while it follows the newest
+samples: full canvas.draw() against blitting, and the full redraws the
+blitted frames still needed (follow_full_draws, 0 when the layout stays
+put).
+
+    python benchmarks/bench_suite.py [--duration 3] [--json out.json] [--compare old.json]
+
+With --compare, results more than --tolerance (10%) worse than the old
+file are flagged and the exit status is 1.
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing as mp
+import os
+import platform
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import numpy as np
+
+import bench_parsing
+from trebla_client.core import TreblaClient
+from trebla_client.framing import decode_vectors
+from trebla_client.ringbuffer import SampleRing
+from trebla_client.standin import StandInServer, SyntheticSource
+from trebla_client.timing import acquisition_times
+
+# results where bigger is better, the others are times
+HIGHER_IS_BETTER = ("samples_per_s",)
+# results not compared between runs
+NOT_COMPARED = ("rss_mb", "cpu_percent", "append_crossover_batch", "follow_full_draws")
+
+# samples per SampleRing.extend: one poll, a batch of window replies, ...
+APPEND_BATCHES = (1, 8, 32, 128, 512)
+
+
+def rss_mb():
+    # current resident set size of this process
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1e6
+    except (OSError, ValueError, AttributeError):
+        import resource
+        # peak, in kB on Linux and bytes on macOS
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / (1e6 if sys.platform == "darwin" else 1e3)
+
+
+def serve(pipe, latency, jitter):
+    # runs in the server process
+    async def run():
+        server = await StandInServer(SyntheticSource(rate=1000.0, seed=0), port=0,
+                                     latency=latency, jitter=jitter).start()
+        pipe.send(server.port)
+        await server.serve_forever()
+    asyncio.run(run())
+
+
+def end_to_end(port, window, duration):
+    """ Polls "sensor acc" for `duration` seconds with `window` commands
+        in flight.
+    """
+    async def run():
+        client = TreblaClient("127.0.0.1", port, window, reconnect=False)
+        await client.wait_connected()
+        await client.ensure_started()
+        history = SampleRing(100 * 60 * 10, 3)
+        latencies = []
+
+        def on_replies(requests):
+            values, malformed = decode_vectors([r.reply for r in requests], 3)
+            times = acquisition_times(requests)
+            if malformed:
+                times = np.delete(times, [i for i, line in malformed])
+            history.extend(values, times)
+            latencies.extend(r.rtt for r in requests)
+
+        cpu, start = time.process_time(), time.time()
+        poll = client.poll("sensor acc", on_replies, batch=True)
+        await asyncio.sleep(duration)
+        poll.stop()
+        elapsed, cpu = time.time() - start, time.process_time() - cpu
+        await client.close()
+        latencies = np.array(latencies) * 1000
+        return {
+            "samples_per_s": history.total / elapsed,
+            "latency_p50_ms": float(np.percentile(latencies, 50)),
+            "latency_p99_ms": float(np.percentile(latencies, 99)),
+            "cpu_percent": 100 * cpu / elapsed,
+            "rss_mb": rss_mb(),
+        }
+    return asyncio.run(run())
+
+
+def best_of(function, repeat=5):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def micro_parsing(samples=100000):
+    stream = bench_parsing.make_stream(samples)
+    per_line = [line + b"\n" for line in stream.split(b"\n")[:-1]]
+    chunked = bench_parsing.chunks(stream, 65536)
+    return {
+        "regex_samples_per_s": samples / best_of(lambda: bench_parsing.regex_path(per_line)),
+        "framer_line_samples_per_s": samples / best_of(lambda: bench_parsing.framer_path(per_line)),
+        "framer_64k_samples_per_s": samples / best_of(lambda: bench_parsing.framer_path(chunked)),
+    }
+
+
+def micro_append(samples=100000, batches=APPEND_BATCHES):
+    """ list.pop(0) per sample against SampleRing.extend of each batch
+        size, and the smallest batch where the ring is faster (0 if none).
+    """
+    data = np.random.rand(samples, 3)
+    rows = data.tolist()
+
+    def lists():
+        # the original clients: three lists of the plot width, pop(0) per sample
+        x, y, z = [0.0] * 1000, [0.0] * 1000, [0.0] * 1000
+        for a, b, c in rows:
+            x.pop(0)
+            x.append(a)
+            y.pop(0)
+            y.append(b)
+            z.pop(0)
+            z.append(c)
+
+    def ring(batch):
+        history = SampleRing(100 * 60 * 10, 3)
+        for i in range(0, samples, batch):
+            history.extend(data[i:i + batch])
+
+    # a fixed cost per extend: small batches are slower than the lists
+    results = {"list_pop_samples_per_s": samples / best_of(lists)}
+    crossover = 0
+    for batch in batches:
+        rate = samples / best_of(lambda: ring(batch))
+        results["ring_extend_%d_samples_per_s" % batch] = rate
+        if not crossover and rate > results["list_pop_samples_per_s"]:
+            crossover = batch
+    results["append_crossover_batch"] = crossover
+    return results
+
+
+def micro_redraw(history=100 * 60 * 10, frames=20, batch=10):
+    try:
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        from trebla_client.graph import AccGraph, AccTracker
+        from trebla_client.spectrum import RollingSpectrum
+    except ImportError:
+        return {}
+    # the figure of GraphFrame on an Agg canvas, history and spectra full
+    tracker = AccTracker(None, history)
+    spectrum = RollingSpectrum(100.0, 3, frames=128)
+    graph = AccGraph(tracker, spectrum, 128)
+    graph.attach(FigureCanvasAgg(graph.fig), blit=False)
+
+    def receive(count):
+        # samples at 100 Hz, pulled into the spectra like on_redraw_timer
+        times = (tracker.acc_history.total + np.arange(count)) / 100.0
+        tracker.add(times, np.random.standard_normal((count, 3)))
+        spectrum.pull(tracker.acc_history)
+
+    def follow(count):
+        # auto-follow: `batch` new samples per frame, only the draw timed
+        best = None
+        for _ in range(count):
+            receive(batch)
+            start = time.perf_counter()
+            graph.draw()
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        return best
+
+    receive(history)
+    full_time = follow(max(1, frames // 4))
+    graph.set_blit(True)
+    graph.draw()
+    full_draws = graph.renderer.full_draws
+    blit_time = follow(frames)
+    return {"full_draw_ms": full_time * 1000, "decimated_blit_ms": blit_time * 1000,
+            "follow_full_draws": graph.renderer.full_draws - full_draws}
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline, tolerance=0.1):
+    """ Prints the changes against an older run, returns the regressions.
+    """
+    regressions = []
+    for group, values in results.items():
+        for name, value in values.items():
+            old = baseline.get(group, {}).get(name)
+            if not old or name in NOT_COMPARED:
+                continue
+            change = value / old - 1
+            worse = -change if name.endswith(HIGHER_IS_BETTER) else change
+            flag = "REGRESSION" if worse > tolerance else ""
+            print("%-14s %-28s %12.4g -> %12.4g %+7.1f%% %s" % (group, name, old, value, 100 * change, flag))
+            if flag:
+                regressions.append((group, name))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--duration", type=float, default=3.0, help="seconds per end to end run")
+    parser.add_argument("--windows", default="1,8,32", help="pipeline windows to run end to end")
+    parser.add_argument("--latency", type=float, default=0.0, help="server reply latency (s)")
+    parser.add_argument("--jitter", type=float, default=0.0, help="server reply jitter (s)")
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--compare", help="compare with the results of an older run")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="relative change flagged by --compare")
+    args = parser.parse_args()
+
+    results = {}
+    ours, theirs = mp.Pipe()
+    server = mp.Process(target=serve, args=(theirs, args.latency, args.jitter))
+    server.daemon = True
+    server.start()
+    port = ours.recv()
+    try:
+        for window in [int(w) for w in args.windows.split(",")]:
+            results["e2e_window_%d" % window] = end_to_end(port, window, args.duration)
+    finally:
+        server.terminate()
+    results["parsing"] = micro_parsing()
+    results["append"] = micro_append()
+    results["redraw"] = micro_redraw()
+
+    for group, values in results.items():
+        print(group)
+        for name, value in values.items():
+            print("    %-28s %12.4g" % (name, value))
+
+    report = {
+        "time": time.time(),
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "args": vars(args),
+        "results": results,
+    }
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            if compare(results, json.load(f)["results"], args.tolerance):
+                sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,170 +1,150 @@
-#!/usr/bin/env python2.7
-import socket
+#!/usr/bin/env python3
+import collections
+import logging
 import time
-import threading
 import wx
-import select
-import re
-import matplotlib.pyplot as plt
-import matplotlib.animation as animation
+import numpy as np
 import multiprocessing as mp
+from trebla_client import metrics
+from trebla_client.bridge import ClientBridge, DISCONNECTED, POLLED, REPLY, UNSOLICITED
+from trebla_client.engine import ConnectionLost
+from trebla_client.framing import decode_vectors
+from trebla_client.profiling import profiler
+from trebla_client.ringbuffer import SampleRing
+from trebla_client.sharedring import SharedSampleRing
+from trebla_client.timing import acquisition_times
 
 connectionState = 0
-dataBuffer = ""
+# number of "sensor acc" commands kept in flight
+pipelineWindow = 8
 sentCommandHistory = []
 sentCommandHistoryId = 0
+# lines kept in the output log, and at most that many events shown per refresh
+outputCapacity = 10000
+outputBatch = 2000
+# port to serve the metrics on for Prometheus, e.g. 9464, None to not serve
+metricsPort = None
+# Ctrl-P profiles the receiving for that many seconds into the current directory
+profileDuration = 30.0
 
-trackingState = 0
-# 0: initial, 1: trigger, 2: start, 3: running
-accRegex = "[-+]?\d*\.\d+|\d+"
+log = logging.getLogger("client")
 
 # those data accessed in another processes
 acc_line = None
 acc_line2 = None
 acc_line3 = None
 
-acc_ax1_list = []
-acc_ax2_list = []
-acc_ax3_list = []
+# width of the plot and number of samples kept in memory (10 minutes at 100 Hz)
+plotRange = 1000
+historyCapacity = 100 * 60 * 10
+accHistory = None
 
-acc_ax1_queue = None
-acc_ax2_queue = None
-acc_ax3_queue = None
+# samples handed over by the receiving process, the plot only has to
+# look at it more often than it wraps around (1 minute at 100 Hz)
+sharedCapacity = 100 * 60
+accShared = None
+accSeq = 0
 #end
 
-EVENT_DISCONNECTED = wx.NewEventType()
-EVENT_NEWDATA = wx.NewEventType()
-
 def init():
     global acc_line
     global acc_line2
     global acc_line3
     
-    global acc_ax1_list
-    global acc_ax2_list
-    global acc_ax3_list
-    
+    global accHistory
     
-    acc_ax1_list = [0.0 for i in xrange(0, 1000)]
-    acc_ax2_list = [0.0 for i in xrange(0, 1000)]
-    acc_ax3_list = [0.0 for i in xrange(0, 1000)]
+    # start with a flat line over the whole plot
+    accHistory.clear()
+    accHistory.extend(np.zeros((plotRange, 3)))
+    times, accData = accHistory.last(plotRange)
     
-    acc_line.set_ydata(acc_ax1_list)
-    acc_line2.set_ydata(acc_ax2_list)
-    acc_line3.set_ydata(acc_ax3_list)
+    acc_line.set_ydata(accData[:, 0])
+    acc_line2.set_ydata(accData[:, 1])
+    acc_line3.set_ydata(accData[:, 2])
+    return acc_line,acc_line2,acc_line3
 
-def update():
-    global acc_ax1_queue
-    global acc_ax2_queue
-    global acc_ax3_queue
+def update(frame):
+    global accShared
+    global accSeq
     
     global acc_line
     global acc_line2
     global acc_line3
     
-    global acc_ax1_list
-    global acc_ax2_list
-    global acc_ax3_list
+    global accHistory
     
-    try:
-        # wait here if data is not renewed
-        ax3_data = acc_ax3_queue.get()
-        ax1_data = acc_ax1_queue.get_nowait()
-        ax2_data = acc_ax2_queue.get_nowait()
-        
-        if type(ax1_data) is float:
-            acc_ax1_list.append(ax1_data)
-        if type(ax2_data) is float:
-            acc_ax2_list.append(ax2_data)
-        if type(ax3_data) is float:
-            acc_ax3_list.append(ax3_data)
-        
-        if (len(acc_ax1_list) > 1000):
-            acc_ax1_list.pop(0)
-        if (len(acc_ax2_list) > 1000):
-            acc_ax2_list.pop(0)        
-        if (len(acc_ax3_list) > 1000):
-            acc_ax3_list.pop(0)
-        
-        acc_line.set_ydata(acc_ax1_list)
-        acc_line2.set_ydata(acc_ax2_list)
-        acc_line3.set_ydata(acc_ax3_list)
-        
-        return acc_line,acc_line2,acc_line3
-    except:
-        print "update failure"
+    # take every sample written since the last frame at once
+    accSeq, times, accData = accShared.since(accSeq)
+    accHistory.extend(accData, times)
+    
+    # views of the last samples, nothing is copied here
+    times, accData = accHistory.last(plotRange)
+    acc_line.set_ydata(accData[:, 0])
+    acc_line2.set_ydata(accData[:, 1])
+    acc_line3.set_ydata(accData[:, 2])
+    
+    return acc_line,acc_line2,acc_line3
 
-def plot_acc_graph(q1, q2, q3):
-    global acc_ax1_list
-    global acc_ax2_list
-    global acc_ax3_list
-    global acc_ax1_queue
-    global acc_ax2_queue
-    global acc_ax3_queue
+def plot_acc_graph(shared):
+    global acc_line
+    global acc_line2
+    global acc_line3
+    global accHistory
+    global accShared
+    global accSeq
+    # only the plotting process needs matplotlib
+    import matplotlib.pyplot as plt
+    import matplotlib.animation as animation
     
-    acc_ax1_queue = q1
-    acc_ax2_queue = q2
-    acc_ax3_queue = q3
+    accShared = shared
+    # only plot what arrives from now on
+    accSeq = shared.total
     
     fig = plt.figure(1)
     
-    ax1 = fig.add_subplot(1, 1, 1, xlim=(0, 1000), ylim=(-20, 20))
-    ax2 = fig.add_subplot(1, 1, 2, xlim=(0, 1000), ylim=(-20, 20))
-    ax3 = fig.add_subplot(1, 1, 3, xlim=(0, 1000), ylim=(-20, 20))
+    ax1 = fig.add_subplot(3, 1, 1, xlim=(0, plotRange), ylim=(-20, 20))
+    ax2 = fig.add_subplot(3, 1, 2, xlim=(0, plotRange), ylim=(-20, 20))
+    ax3 = fig.add_subplot(3, 1, 3, xlim=(0, plotRange), ylim=(-20, 20))
 
-    acc_ax1_list = [0.0 for i in xrange(0, 1000)]
-    acc_ax2_list = [0.0 for i in xrange(0, 1000)]
-    acc_ax3_list = [0.0 for i in xrange(0, 1000)]
+    accHistory = SampleRing(historyCapacity, 3)
    
-    acc_line, = ax1.plot(acc_ax1_list)
-    acc_line2, = ax2.plot(acc_ax2_list)
-    acc_line3, = ax3.plot(acc_ax3_list)
+    acc_line, = ax1.plot(np.zeros(plotRange))
+    acc_line2, = ax2.plot(np.zeros(plotRange))
+    acc_line3, = ax3.plot(np.zeros(plotRange))
    
-    print "this is an another process"
+    print("this is an another process")
     ani = animation.FuncAnimation(fig, update, init_func=init, interval=2*100)
     plt.show()
 
-class SocketClientThread(threading.Thread):
-    def __init__(self, conn, parent):
-        threading.Thread.__init__(self)
-        self.conn = conn
-        self.parent = parent
-
-    def run(self):
-        global connectionState, dataBuffer
-        while connectionState:
-            # this will try to recieve data continuously
-            try:
-                # this makes sure there's someting to read from the server before actually reading it
-                # it's necessary because without it will keep blocking even with a closed connection
-                if select.select([self.conn], [], []):
-                    # this is blocking
-                    data = self.conn.recv(1024)
-                
-                # connection lost
-                if not data:
-                    wx.PostEvent(self.parent, wx.PyCommandEvent(EVENT_DISCONNECTED, -1))
-                    return
-                
-                # remove all whitespace characters on the right side
-                # append so that if there's a new packet before the previous is shown it doesn't get lost
-                dataBuffer += data.rstrip()
-                wx.PostEvent(self.parent, wx.PyCommandEvent(EVENT_NEWDATA, -1))
-            except socket.timeout, e:
-                #print e.args[0]
-                continue
-            except Exception as e:
-                #print e.args[0]
-                return
-
-    def send(self, data):
-        # new line defines an end of command on the server side
-        self.conn.send(data + "\n")
-
-    def close(self):
-        global connectionState
-        connectionState = 0
-        self.conn.close()
+class OutputLog(wx.ListCtrl):
+    """ Terminal output that keeps the last `capacity` lines. The list is
+        virtual: it only renders the rows on screen, whatever the number
+        of lines, and it is refreshed once per batch of lines.
+    """
+    def __init__(self, parent, capacity):
+        super(OutputLog, self).__init__(parent, style=wx.LC_REPORT|wx.LC_VIRTUAL|wx.LC_NO_HEADER)
+        self.lines = collections.deque(maxlen=capacity)
+        self.InsertColumn(0, "")
+        self.Bind(wx.EVT_SIZE, self.onSize)
+    
+    def OnGetItemText(self, item, column):
+        return self.lines[item]
+    
+    def appendLines(self, lines):
+        if not lines:
+            return
+        # only follow the end when it is on screen, not while scrolled back
+        following = self.GetTopItem() + self.GetCountPerPage() >= len(self.lines)
+        self.lines.extend(lines)
+        self.SetItemCount(len(self.lines))
+        if following:
+            self.EnsureVisible(len(self.lines) - 1)
+        # the oldest lines may have been dropped, the rows on screen moved
+        self.Refresh()
+    
+    def onSize(self, event):
+        self.SetColumnWidth(0, self.GetClientSize().width)
+        event.Skip()
 
 class SocketClientUI(wx.Frame):
     def __init__(self, parent, title):
@@ -173,9 +153,28 @@ class SocketClientUI(wx.Frame):
         # keyboard events
         self.Bind(wx.EVT_CHAR_HOOK, self.onKey)
         
-        # bind events from socket client thread
-        self.Bind(wx.PyEventBinder(EVENT_DISCONNECTED, 1), self.disconnect)
-        self.Bind(wx.PyEventBinder(EVENT_NEWDATA, 1), self.updateOutput)
+        # the socket is handled by an event loop in a background thread,
+        # what it has for the UI is picked up by a timer, not one event per packet
+        self.bridge = ClientBridge()
+        self.client = None
+        self.accShared = None
+        # the plot process, the "sensor acc" poll feeding it and its client
+        self.accPlot = None
+        self.accPoll = None
+        self.accClient = None
+        # copy of the "Show polling" check box for the loop thread
+        self.showPolls = False
+        # malformed acc replies, logged at most every 5 seconds
+        self.parseFailures = 0
+        self.badReplyLog = metrics.RateLimitedLog(log, 5.0)
+        self.metrics = metrics.Registry()
+        self.metrics.register(metrics.bridge_metrics(self.bridge))
+        self.metrics.register(self.collectMetrics)
+        self.metricsServer = metrics.MetricsServer(self.metrics, metricsPort) if metricsPort else None
+        self.clientMetrics = None
+        self.output_timer = wx.Timer(self)
+        self.Bind(wx.EVT_TIMER, self.updateOutput, self.output_timer)
+        self.output_timer.Start(50)
         
         self.InitUI()
         self.Centre()
@@ -204,8 +203,7 @@ class SocketClientUI(wx.Frame):
         
         # output data
         sizer.Add(wx.StaticText(panel, label="Output"), pos=(2, 0), flag=wx.TOP|wx.LEFT, border=5)
-        self.output = wx.TextCtrl(panel, style = wx.TE_MULTILINE)
-        #self.output.Enable(False)
+        self.output = OutputLog(panel, outputCapacity)
         sizer.Add(self.output, pos=(3, 0), span=(1, 5), flag=wx.EXPAND|wx.LEFT|wx.RIGHT, border=5)
         
         # input entries
@@ -222,7 +220,12 @@ class SocketClientUI(wx.Frame):
         self.track_acc = wx.Button(panel, label="ACC")
         self.track_acc.Enable(False)
         sizer.Add(self.track_acc, pos=(6, 0), flag=wx.EXPAND|wx.RIGHT, border=5)
-       	self.track_acc.Bind(wx.EVT_BUTTON, self.func_track_acc)
+        self.track_acc.Bind(wx.EVT_BUTTON, self.func_track_acc)
+        
+        # polling replies are not logged unless asked for, there are hundreds per second
+        self.cb_polls = wx.CheckBox(panel, label="Show polling")
+        sizer.Add(self.cb_polls, pos=(6, 1), flag=wx.ALIGN_CENTER_VERTICAL)
+        self.cb_polls.Bind(wx.EVT_CHECKBOX, self.onShowPolls)
         
         # make first column and 3rd row growable
         sizer.AddGrowableCol(1)
@@ -230,9 +233,12 @@ class SocketClientUI(wx.Frame):
         
         panel.SetSizerAndFit(sizer)
     
+    def onShowPolls(self, event):
+        self.showPolls = self.cb_polls.GetValue()
+    
     def disconnect(self, event):
         global connectionState
-        self.clientSocket.close()
+        self.bridge.disconnect(self.client)
         connectionState = 0
         
         if event != wx.EVT_BUTTON:
@@ -251,23 +257,53 @@ class SocketClientUI(wx.Frame):
         
     def func_track_acc(self, event):
         global connectionState
-        global trackingState
 
         if connectionState:
-            #check if sensor service has already started
-            self.sct.send("sensor acc")
-            self.output.AppendText("> " + "sensor acc" + "\n")
-            # set global state as trigger
-            trackingState = 1 
-            
-            # set buffer
-            self.acc_q1 = mp.Queue()
-            self.acc_q2 = mp.Queue()
-            self.acc_q3 = mp.Queue()
-            
-            plt_frame = mp.Process(target=plot_acc_graph,args=(self.acc_q1, self.acc_q2, self.acc_q3,))
-            plt_frame.start()
+            if self.accPlot is None or not self.accPlot.is_alive():
+                # set buffer, a new plot when the last window was closed
+                self.accShared = SharedSampleRing(sharedCapacity, 3)
+                
+                self.accPlot = mp.Process(target=plot_acc_graph,args=(self.accShared,))
+                self.accPlot.start()
+            elif self.accClient is self.client:
+                # already tracked, the plot is still open
+                return
+
+            self.accClient = self.client
+            self.bridge.call(self.startTracking)
+            self.output.appendLines(["> sensor acc"])
+
+    async def startTracking(self):
+        # runs on the bridge loop: check if sensor service has already started,
+        # then keep several "sensor acc" in flight instead of waiting for each reply
+        await self.client.ensure_started()
+        # one poll at a time, the old one fed a closed plot or an old connection
+        if self.accPoll is not None:
+            self.accPoll.stop()
+        self.accPoll = self.client.poll("sensor acc", self.onAccReplies, batch=True)
 
+    def onAccReplies(self, requests):
+        # runs on the bridge loop, every reply received in one go is decoded at once
+        started = profiler.start()
+        accData, malformed = decode_vectors([r.reply for r in requests], 3)
+        # each sample at the midpoint of its request
+        times = np.delete(acquisition_times(requests), [i for i, line in malformed])
+        profiler.stop("decode", started)
+        if len(accData):
+            started = profiler.start()
+            self.accShared.extend(accData, times)
+            profiler.stop("buffer", started)
+        self.parseFailures += len(malformed)
+        for i, line in malformed:
+            self.badReplyLog.warning("failure to get acc Data: %s", line)
+        if self.showPolls:
+            # one event for the whole batch
+            self.bridge.post(POLLED, self.client, requests)
+
+    def collectMetrics(self):
+        yield "trebla_parse_failures_total", metrics.COUNTER, "Malformed replies", {"channel": "acc"}, self.parseFailures
+        if self.accShared is not None:
+            yield "trebla_samples_total", metrics.COUNTER, "Samples stored", {"channel": "acc"}, self.accShared.total
 
     def connect(self, event):
         global connectionState
@@ -277,25 +313,20 @@ class SocketClientUI(wx.Frame):
             self.disconnect(wx.EVT_BUTTON)
             return
         
-        self.clientSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        # set timeout in case a wrong ip is used (in seconds)
-        self.clientSocket.settimeout(2)
         ip = self.tc_ip.GetValue()
         port = int(self.tc_port.GetValue())
         
         try:
-            self.clientSocket.connect((ip, port))
-        except socket.timeout:
-            wx.MessageBox('Timeout while connecting, verify the IP and port.', 'Error', wx.OK|wx.ICON_ERROR)
-            return
-        except Exception, e:
-            wx.MessageBox('Could not connect to socket, is the app running?', 'Error', wx.OK|wx.ICON_ERROR)
+            # set timeout in case a wrong ip is used (in seconds)
+            self.client = self.bridge.connect(ip, port, window=pipelineWindow, reconnect=False, connect_timeout=2)
+        except ConnectionLost:
+            wx.MessageBox('Could not connect to socket, verify the IP and port, is the app running?', 'Error', wx.OK|wx.ICON_ERROR)
             return
         
-        # start the receieveing thread
         connectionState = 1
-        self.sct = SocketClientThread(self.clientSocket, self)
-        self.sct.start()
+        if self.clientMetrics is not None:
+            self.metrics.unregister(self.clientMetrics)
+        self.clientMetrics = self.metrics.register(metrics.client_metrics(self.client))
         
         # update UI element statuses
         self.button_connect.SetLabel("Stop")
@@ -325,9 +356,21 @@ class SocketClientUI(wx.Frame):
         elif k == wx.WXK_DOWN:
             # navigate up in previous commands
             self.navigateCommands(wx.WXK_DOWN)
+        elif k == ord('P') and event.ControlDown():
+            self.toggleProfiling()
         else:
             event.Skip()
             
+    def toggleProfiling(self):
+        if profiler.active:
+            profiler.finish()
+            return
+        # the files are written from the thread that ends the session
+        profiler.on_finished = lambda paths: wx.CallAfter(
+            self.output.appendLines, ["profile written to " + path for path in paths])
+        profiler.begin(profileDuration, ".", cprofile=True, tracemalloc=True)
+        self.output.appendLines(["profiling for %.0f s, Ctrl-P to stop" % profileDuration])
+
     def navigateCommands(self, event):
         global sentCommandHistory, sentCommandHistoryId
         if not len(sentCommandHistory):
@@ -346,61 +389,34 @@ class SocketClientUI(wx.Frame):
         global sentCommandHistory, sentCommandHistoryId
         data = self.tc_send.GetValue()
         if data != "":
-            self.sct.send(data)
+            # interactive commands go out right away, even while polling
+            self.bridge.submit(self.client, data)
             sentCommandHistory.append(data)
             sentCommandHistoryId = len(sentCommandHistory)
             self.tc_send.SetValue("")
-            self.output.AppendText("> " + data + "\n")
+            self.output.appendLines(["> " + data])
     
     def updateOutput(self, event):
-        global dataBuffer
-        global trackingState
-        accData = None
-
-        # this is tracking mode
-        self.output.AppendText("< " + dataBuffer + "\n")
-            	
-        while True:
-            if trackingState == 1:
-                if "not started" in dataBuffer:
-                    self.sct.send("sensor start")
-                    self.output.AppendText("> " + "sensor start" + "\n")
-                    trackingState = 2
-                accData = re.findall(accRegex, dataBuffer) 
-                if accData is not None:
-                    print "got a valid result:"
-                    print accData
-                    self.sct.send("sensor acc")
-                    self.output.AppendText("> " + "sensor acc" + "\n")
-                    self.acc_q1.put(accData[0])
-                    self.acc_q2.put(accData[1])
-                    self.acc_q3.put(accData[2])
-                break
-            if trackingState == 2:
-                self.sct.send("sensor acc")
-                self.output.AppendText("> " + "sensor acc" + "\n")
-                trackingState = 3
-                break
-            if trackingState == 3:
-                accData = re.findall(accRegex, dataBuffer)
-                if accData is not None:
-                    print "got a valid result:"
-                    print accData
-                    self.acc_q1.put(accData[0])
-                    self.acc_q2.put(accData[1])
-                    self.acc_q3.put(accData[2])
-                    
-                    self.sct.send("sensor acc")
-                    self.output.AppendText("> " + "sensor acc" + "\n")
-                else:
-                    print "failure to get acc Data: " + dataBuffer
-                break
-            else:
-                break
+        global connectionState
 
-        dataBuffer = ""
+        # everything received since the last tick goes to the log at once,
+        # the rest waits for the next tick when there is more than a batch
+        lines = []
+        for kind, client, payload in self.bridge.drain(outputBatch):
+            if kind == REPLY and payload.error is None:
+                lines.append("< " + payload.reply)
+            elif kind == POLLED:
+                for request in payload:
+                    lines.append("> " + request.command + "  < " + request.reply)
+            elif kind == UNSOLICITED:
+                # data pushed by the server, e.g. forwarded by "usb -r"
+                lines.append("< " + payload)
+            elif kind == DISCONNECTED and client is self.client and connectionState:
+                self.disconnect(None)
+        self.output.appendLines(lines)
 
 if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
     app = wx.App()
     SocketClientUI(None, title="Python Terminal Client")
     app.MainLoop()
@@ -1,213 +1,219 @@
-#!/usr/bin/env python2.7
-import socket
+#!/usr/bin/env python3
+import logging
+import signal
 import time
 import threading
-import select
-import re
 import numpy as np
 import matplotlib.pyplot as plt
 from matplotlib.widgets import Slider, Button, RadioButtons
 import matplotlib.animation as animation
+from trebla_client import metrics
+from trebla_client.bridge import ClientBridge, DISCONNECTED
+from trebla_client.decimate import Decimator
+from trebla_client.engine import ConnectionLost
+from trebla_client.framing import decode_vectors
+from trebla_client.profiling import install_signal, profiler
+from trebla_client.recorder import SessionRecorder
+from trebla_client.ringbuffer import SampleRing
+from trebla_client.timing import acquisition_times
+
+log = logging.getLogger("client1")
+# at most one line every 5 seconds however many replies are bad
+badReplyLog = metrics.RateLimitedLog(log, 5.0)
+
+def on_acc_replies(requests):
+    global accDataLock
+    global accHistory
+
+    # every reply received in one go is decoded at once
+    started = profiler.start()
+    replies = [r for r in requests if r.error is None]
+    accData, malformed = decode_vectors([r.reply for r in replies], 3)
+    # each sample at the midpoint of its request
+    times = np.delete(acquisition_times(replies), [i for i, line in malformed])
+    profiler.stop("decode", started)
+    started = profiler.start()
+    accDataLock.acquire()
+    accHistory.extend(accData, times)
+    accDataLock.release()
+    profiler.stop("buffer", started)
+
+    if recorder is not None and len(accData):
+        recorder.record("acc", times, accData)
+
+    for i, line in malformed:
+        badReplyLog.warning("failure to get acc Data: %s", line)
 
-class SocketClientThread(threading.Thread):
-    def __init__(self, conn):
-        threading.Thread.__init__(self)
-        self.conn = conn
-
-    def run(self):
-        global connectionState
-        global accRegex,accDataLock
-        global acc_ax1_list
-        global acc_ax2_list
-        global acc_ax3_list
-
-        trackingState = 1
-
-        while connectionState:
-            # this will try to recieve data continuously
-            try:
-                # this makes sure there's someting to read from the server before actually reading it
-                # it's necessary because without it will keep blocking even with a closed connection
-                if select.select([self.conn], [], [], 0.5):
-                    # this is blocking
-                    data = self.conn.recv(1024)
-                
-                # connection lost
-                if not data:
-                    print "connection is LOST"
-                    return
-                
-                # remove all whitespace characters on the right side
-                # append so that if there's a new packet before the previous is shown it doesn't get lost
-                dataStrip = data.rstrip()
-                if trackingState == 1:
-                    if "not started" in dataStrip:
-                        self.send("sensor start")
-                        trackingState = 2
-                elif trackingState == 2:
-                    self.send("sensor acc")
-                    trackingState = 3
-                elif trackingState == 3:
-                    accData = re.findall(accRegex, dataStrip)
-                    if accData is not None:
-                        accDataLock.acquire()
-                        acc_ax1_list.append(float(accData[0]))
-                        acc_ax1_list.pop(0)
-                        acc_ax2_list.append(float(accData[1]))
-                        acc_ax2_list.pop(0)
-                        acc_ax3_list.append(float(accData[2]))
-                        acc_ax3_list.pop(0)
-                        accDataLock.release()
-                        
-                        print accData[0],accData[1],accData[2]
-
-                        self.send("sensor acc")
-                    else:
-                        print "failure to get acc Data: " + data
-                else:
-                    print trackingState
-
-            except socket.timeout, e:
-                print e.args[0]
-                continue
-            except Exception as e:
-                print e.args[0]
-                return
-
-    def send(self, data):
-        # new line defines an end of command on the server side
-        self.conn.send(data + "\n")
-
-    def close(self):
-        global connectionState
-
-        connectionState = False
-        self.conn.close()
+async def start_tracking(client):
+    # runs on the bridge loop: check if sensor service has already started,
+    # then keep several "sensor acc" in flight instead of waiting for each reply
+    await client.ensure_started()
+    client.poll("sensor acc", on_acc_replies, batch=True)
 
 
 serverIP = '192.168.31.227'
 serverPort = 8888
-clientSocket = None
-clientTalkSocket = None
+# number of "sensor acc" commands kept in flight
+pipelineWindow = 8
+bridge = None
+client = None
+# directory to record the session to, e.g. "sessions/flight1", None to not record
+recordDirectory = None
+recorder = None
+# port to serve the metrics on for Prometheus, e.g. 9464, None to not serve
+metricsPort = None
+# seconds between two metrics log lines, None to not log them
+metricsLogInterval = None
+metricsServer = None
+metricsReporter = None
 connectionState = False
-dataBuffer = ""
 accDataLock = threading.RLock()
 
-trackingState = 0
-# 0: initial, 1: trigger, 2: start, 3: running
-accRegex = "[-+]?\d*\.\d+|\d+"
-
 x_coordinate_range = 1000
+# samples kept in memory, 10 minutes at 100 Hz
+historyCapacity = 100 * 60 * 10
 
 accDataLock.acquire()
-acc_ax1_list = []
-acc_ax2_list = []
-acc_ax3_list = []
+accHistory = SampleRing(historyCapacity, 3)
+accDecimator = Decimator(accHistory)
 accDataLock.release()
 
 def connect():
     global serverIP
     global serverPort
     global connectionState
-    global clientTalkSocket
-
-    clientSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    # set timeout in case a wrong ip is used (in seconds)
-    clientSocket.settimeout(2)
-    ip = serverIP
-    port = serverPort
-    
+    global bridge
+    global client
+    global pipelineWindow
+    global recorder
+    global metricsServer
+    global metricsReporter
+
+    # the socket is handled by an event loop in a background thread
+    bridge = ClientBridge()
     try:
-        clientSocket.connect((ip, port))
-    except socket.timeout:
-        print 'Timeout while connecting, verify the IP and port.'
-        return 1
-    except Exception, e:
-        print 'Could not connect to socket, is the app running?'
+        # set timeout in case a wrong ip is used (in seconds)
+        client = bridge.connect(serverIP, serverPort, window=pipelineWindow, reconnect=False, connect_timeout=2)
+    except ConnectionLost as e:
+        print('Could not connect to socket, is the app running? (%s)' % e)
         return 1
     
-    # start the receieveing thread
     connectionState = True
-    clientTalkSocket = SocketClientThread(clientSocket)
-    clientTalkSocket.start()
+    if recordDirectory is not None:
+        recorder = SessionRecorder(recordDirectory)
+
+    if metricsPort is not None or metricsLogInterval is not None:
+        registry = metrics.Registry()
+        registry.register(metrics.client_metrics(client))
+        registry.register(metrics.bridge_metrics(bridge))
+        registry.register(metrics.ring_metrics(accHistory, channel="acc"))
+        if recorder is not None:
+            registry.register(metrics.recorder_metrics(recorder))
+        if metricsPort is not None:
+            metricsServer = metrics.MetricsServer(registry, metricsPort)
+        if metricsLogInterval is not None:
+            metricsReporter = metrics.LogReporter(registry, metricsLogInterval)
     
 
 def init():
-    global acc_ax1_list
-    global acc_ax2_list
-    global acc_ax3_list
+    global accHistory
     global accDataLock
     global acc_line,acc_line2,acc_line3
     global x_coordinate_range
    
     accDataLock.acquire()
-    acc_ax1_list = [0.0 for i in xrange(0, x_coordinate_range)]
-    acc_ax2_list = [0.0 for i in xrange(0, x_coordinate_range)]
-    acc_ax3_list = [0.0 for i in xrange(0, x_coordinate_range)]
+    # start with a flat line over the whole window
+    accHistory.clear()
+    accHistory.extend(np.zeros((x_coordinate_range, 3)))
+    times, accData = accHistory.last(x_coordinate_range)
     accDataLock.release()
     
-    acc_line.set_ydata(acc_ax1_list)
-    acc_line2.set_ydata(acc_ax2_list)
-    acc_line3.set_ydata(acc_ax3_list)
+    acc_line.set_ydata(accData[:, 0])
+    acc_line2.set_ydata(accData[:, 1])
+    acc_line3.set_ydata(accData[:, 2])
     return acc_line,acc_line2,acc_line3
 
-def update(val):
-    global acc_ax1_list
-    global acc_ax2_list
-    global acc_ax3_list
+def update():
+    global accHistory
     global acc_line,acc_line2,acc_line3
     global accDataLock
+    global connectionState
+
+    started = profiler.start()
+    for kind, source, payload in bridge.drain():
+        if kind == DISCONNECTED:
+            connectionState = False
+            print("connection is LOST")
 
-    print "update:%d,%d,%d"%(len(acc_ax1_list), len(acc_ax2_list), len(acc_ax3_list))
     accDataLock.acquire()       
-    acc_line.set_ydata(acc_ax1_list)
-    acc_line2.set_ydata(acc_ax2_list)
-    acc_line3.set_ydata(acc_ax3_list)
+    # the last samples reduced to about two points per pixel
+    first = accHistory.total - x_coordinate_range
+    x, accData = accDecimator.view(first, accHistory.total, ax1.bbox.width)
     accDataLock.release()
-
-    return acc_line,acc_line2,acc_line3
+    x = x - first
+    acc_line.set_data(x[:, 0], accData[:, 0])
+    acc_line2.set_data(x[:, 1], accData[:, 1])
+    acc_line3.set_data(x[:, 2], accData[:, 2])
+    profiler.stop("buffer", started)
+
+    # drawn here and not left to the event loop, so that "draw" is the
+    # time the canvas takes to render the frame
+    started = profiler.start()
+    fig.canvas.draw()
+    profiler.stop("draw", started)
 
 def func_track_acc(event):
     global connectionState
     global buttonClicked
 
     if connectionState and buttonClicked is not True:
-        #check if sensor service has already started
-        clientTalkSocket.send("sensor acc")
-        print "sensor acc command sent\n"
+        bridge.call(start_tracking, client)
+        print("sensor acc command sent\n")
         buttonClicked = True
     else:
-        print "button is clicked before"
+        print("button is clicked before")
         
 
-if (connect()) :
-    print "connection failure\n"
-    exit(1)
-
-axcolor = 'lightgoldenrodyellow'
-print "connection established\n"
-fig = plt.figure(1)
-
-ax1 = fig.add_subplot(3, 1, 1, xlim=(0, x_coordinate_range), ylim=(-20, 20))
-ax2 = fig.add_subplot(3, 1, 2, xlim=(0, x_coordinate_range), ylim=(-20, 20))
-ax3 = fig.add_subplot(3, 1, 3, xlim=(0, x_coordinate_range), ylim=(-20, 20))
-
-acc_ax1_list = [0.0 for i in xrange(0, x_coordinate_range)]
-acc_ax2_list = [0.0 for i in xrange(0, x_coordinate_range)]
-acc_ax3_list = [0.0 for i in xrange(0, x_coordinate_range)]
-
-acc_line, = ax1.plot(acc_ax1_list)
-acc_line2, = ax2.plot(acc_ax2_list)
-acc_line3, = ax3.plot(acc_ax3_list)
-
-buttonClicked = False
-trackax = plt.axes([0.8, 0.025, 0.1, 0.04])
-button = Button(trackax, 'Track', color=axcolor, hovercolor='0.975')
-button.on_clicked(func_track_acc)
-
-ani = animation.FuncAnimation(fig, update, init_func=init, interval=2*100)
-plt.show()
-print "quiting..."
-clientTalkSocket.close()
-clientTalkSocket.join()
+# nothing connects or opens a window on import
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    if hasattr(signal, "SIGUSR1"):
+        # kill -USR1 <pid> profiles 30 s into the current directory
+        install_signal(cprofile=True, tracemalloc=True)
+
+    if (connect()) :
+        print("connection failure\n")
+        exit(1)
+
+    axcolor = 'lightgoldenrodyellow'
+    print("connection established\n")
+    fig = plt.figure(1)
+
+    ax1 = fig.add_subplot(3, 1, 1, xlim=(0, x_coordinate_range), ylim=(-20, 20))
+    ax2 = fig.add_subplot(3, 1, 2, xlim=(0, x_coordinate_range), ylim=(-20, 20))
+    ax3 = fig.add_subplot(3, 1, 3, xlim=(0, x_coordinate_range), ylim=(-20, 20))
+
+    acc_line, = ax1.plot(np.zeros(x_coordinate_range))
+    acc_line2, = ax2.plot(np.zeros(x_coordinate_range))
+    acc_line3, = ax3.plot(np.zeros(x_coordinate_range))
+
+    buttonClicked = False
+    trackax = plt.axes([0.8, 0.025, 0.1, 0.04])
+    button = Button(trackax, 'Track', color=axcolor, hovercolor='0.975')
+    button.on_clicked(func_track_acc)
+
+    init()
+    redrawTimer = fig.canvas.new_timer(interval=2*100)
+    redrawTimer.add_callback(update)
+    redrawTimer.start()
+    plt.show()
+    print("quiting...")
+    bridge.disconnect(client)
+    bridge.close()
+    if recorder is not None:
+        recorder.close()
+    if metricsServer is not None:
+        metricsServer.close()
+    if metricsReporter is not None:
+        metricsReporter.close()
 
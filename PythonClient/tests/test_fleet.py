@@ -0,0 +1,63 @@
+"""
+FleetCollector against stand-in servers on the same event loop.
+
+    python -m pytest tests
+"""
+import asyncio
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from trebla_client import metrics
+from trebla_client.fleet import FleetCollector
+from trebla_client.standin import StandInServer, SyntheticSource
+
+
+def collect(channels, duration=0.5, **kwargs):
+    batches = []
+
+    async def run():
+        servers = [await StandInServer(SyntheticSource(seed=i), port=0).start() for i in range(2)]
+        collector = FleetCollector([("ph%d" % i, "127.0.0.1", server.port) for i, server in enumerate(servers)],
+                                   channels, sink=batches.append, **kwargs)
+        collector.start()
+        await asyncio.sleep(duration)
+        stats = collector.stats()
+        await collector.close()
+        for server in servers:
+            await server.close()
+        return collector, stats
+
+    collector, stats = asyncio.run(run())
+    return collector, stats, batches
+
+
+def test_channels_of_a_subscriber():
+    collector, stats, batches = collect(["acc", "gyro"], derived=[("shake", "acc", "highpass:0.3")], fusion={})
+    names = set((batch.device, batch.channel) for batch in batches)
+    for device in ("ph0", "ph1"):
+        for channel in ("acc", "gyro", "shake", "orientation_quat", "orientation_euler"):
+            assert (device, channel) in names
+        subscriber = collector.devices[device].subscriber
+        acc = subscriber.channels["acc"]
+        assert acc.history.total == sum(len(b.times) for b in batches if b.device == device and b.channel == "acc")
+        assert acc.timing.count and acc.stats.window().count
+        assert set(stats[device]["channels"]) >= {"acc", "gyro", "shake"}
+    assert all(len(batch.times) for batch in batches)
+    # the metrics of the subscribers, per device and channel
+    samples = list(metrics.fleet_metrics(collector)())
+    assert any(name == "trebla_sample_jitter_seconds" and labels == {"device": "ph1", "channel": "gyro"}
+               for name, kind, help, labels, value in samples)
+
+
+def test_slow_channels_at_their_rate():
+    collector, stats, batches = collect(["acc", "battery"], duration=1.0, rates={"acc": None})
+    for device in ("ph0", "ph1"):
+        channels = collector.devices[device].subscriber.channels
+        assert channels["battery"].poll.interval == 1.0
+        assert channels["acc"].priority > channels["battery"].priority
+        # battery at 1 Hz, not sharing the window with acc evenly
+        assert channels["battery"].history.total <= 3
+        assert channels["acc"].history.total > 20 * channels["battery"].history.total
+        assert collector.devices[device].scheduler is not None
@@ -0,0 +1,88 @@
+"""
+Line framing and decoding of the replies: the per line path of small
+batches and the bulk path agree whatever the number of lines.
+
+    python -m pytest tests
+"""
+import os
+import socket
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import numpy as np
+import pytest
+
+from trebla_client.framing import SMALL_BATCH, LineFramer, decode_vectors
+
+GOOD = "[1.0, -2.5, 9.81]"
+
+MALFORMED = [
+    "[7.0, , 9.0]",
+    "[7.0,,9.0]",
+    "[, 1.0, 2.0]",
+    "[1.0, 2.0, ]",
+    "[1.0,\t, 3.0]",
+    "[ , , ]",
+    "[]",
+    "null",
+    "internal sensor listener not started",
+    "[1.0, 2.0, x]",
+    "[1.0 2.0, 3.0, 4.0]",
+    "[1_0, 2.0, 3.0]",
+    "[1.0, 2.0]",
+    "[1.0, 2.0, 3.0, 4.0]",
+    "[1.0, 2.0, 3.0",
+]
+
+WELL_FORMED = [
+    ("[ 1.0 , 2.0 , 3.0 ]", [1.0, 2.0, 3.0]),
+    ("[1e3, -2E-2, +3.]", [1000.0, -0.02, 3.0]),
+    ("[NaN, Infinity, -Infinity]", [np.nan, np.inf, -np.inf]),
+]
+
+
+def batches(line):
+    # the line in the middle of a small and of a bulk batch, as str and bytes
+    for count in (3, SMALL_BATCH + 4):
+        lines = [GOOD] * count
+        lines[count // 2] = line
+        yield count // 2, lines
+        yield count // 2, [text.encode("ascii") for text in lines]
+
+
+@pytest.mark.parametrize("line", MALFORMED)
+def test_malformed_whatever_the_batch(line):
+    for index, lines in batches(line):
+        values, malformed = decode_vectors(lines, 3)
+        assert [i for i, bad in malformed] == [index]
+        assert malformed[0][1] == lines[index]
+        assert values.shape == (len(lines) - 1, 3)
+        assert (values == [1.0, -2.5, 9.81]).all()
+
+
+@pytest.mark.parametrize("line,expected", WELL_FORMED)
+def test_well_formed_whatever_the_batch(line, expected):
+    for index, lines in batches(line):
+        values, malformed = decode_vectors(lines, 3)
+        assert malformed == []
+        np.testing.assert_array_equal(values[index], expected)
+
+
+def test_framer_joins_split_lines():
+    ours, theirs = socket.socketpair()
+    try:
+        # a buffer smaller than a line grows
+        framer = LineFramer(bufsize=8)
+        lines = []
+        theirs.sendall(b"[1.0, 2.0, 3.0]\n[4.0,")
+        while len(lines) < 1:
+            lines += framer.recv_into(ours)
+        theirs.sendall(b" 5.0, 6.0]\r\n")
+        while len(lines) < 2:
+            lines += framer.recv_into(ours)
+        assert lines == [b"[1.0, 2.0, 3.0]", b"[4.0, 5.0, 6.0]"]
+        theirs.close()
+        assert framer.recv_into(ours) is None
+    finally:
+        ours.close()
@@ -0,0 +1,57 @@
+"""
+The GraphFrame figure drawn headless on an Agg canvas.
+
+    python -m pytest tests
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import numpy as np
+import pytest
+
+pytest.importorskip("matplotlib")
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+from trebla_client.graph import AccGraph, AccTracker
+from trebla_client.spectrum import RollingSpectrum
+
+
+def graph(blit):
+    tracker = AccTracker(None, 1000)
+    spectrum = RollingSpectrum(100.0, 3, frames=16)
+    graph = AccGraph(tracker, spectrum, 16)
+    graph.attach(FigureCanvasAgg(graph.fig), blit=blit)
+    return graph
+
+
+def receive(graph, count):
+    tracker = graph.tracker
+    times = (tracker.acc_history.total + np.arange(count)) / 100.0
+    tracker.add(times, np.ones((count, 3)))
+    graph.spectrum.pull(tracker.acc_history)
+
+
+def test_following_keeps_the_layout():
+    follower = graph(blit=True)
+    receive(follower, 500)
+    follower.draw()
+    layout, full_draws = follower.layout, follower.renderer.full_draws
+    for _ in range(5):
+        receive(follower, 7)
+        follower.draw()
+    assert follower.layout == layout
+    assert follower.renderer.full_draws == full_draws
+    # x counts back from the newest sample
+    x = follower.plot_lines[0].get_xdata()
+    assert x.max() <= 1 and x.min() >= -AccGraph.follow_width - 1
+
+
+def test_manual_bounds_and_full_draws():
+    manual = graph(blit=False)
+    receive(manual, 100)
+    manual.draw(xmin=0, xmax=100, ymin=-2, ymax=2, grid=False)
+    assert manual.all_axes[0].get_xbound() == (0, 100)
+    assert manual.all_axes[2].get_ybound() == (-2, 2)
+    assert manual.frame_time > 0
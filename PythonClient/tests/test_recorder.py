@@ -0,0 +1,43 @@
+"""
+Session recording: channel names and write errors.
+
+    python -m pytest tests
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import numpy as np
+import pytest
+
+from trebla_client.recorder import NAME_SIZE, SessionRecorder, open_session
+
+
+def test_long_names_are_rejected(tmp_path):
+    recorder = SessionRecorder(str(tmp_path))
+    long_name = "ph-" + "a" * (NAME_SIZE - 7) + ".acc"
+    recorder.record(long_name, 0.0, [1.0, 2.0, 3.0])
+    with pytest.raises(ValueError):
+        recorder.record(long_name + "x", 0.0, [1.0, 2.0, 3.0])
+    # a 2 byte character over the limit, it is not cut in half
+    with pytest.raises(ValueError):
+        recorder.record("é" * (NAME_SIZE // 2) + "x", 0.0, [1.0])
+    recorder.close()
+    assert list(open_session(str(tmp_path))) == [long_name]
+
+
+def test_failed_channel_keeps_the_others(tmp_path):
+    recorder = SessionRecorder(str(tmp_path))
+    recorder.record("acc", 0.0, [1.0, 2.0, 3.0])
+    recorder.close()
+    recorder = SessionRecorder(str(tmp_path))
+    # acc changed width, its file cannot take the rows
+    recorder.record("acc", [1.0, 2.0], [[1.0, 2.0], [3.0, 4.0]])
+    recorder.record("gyro", [1.0, 2.0], np.ones((2, 3)))
+    recorder.close()
+    assert recorder.dropped == 2
+    assert recorder.samples == 2
+    session = open_session(str(tmp_path))
+    assert len(session["acc"]) == 1
+    assert len(session["gyro"]) == 2
@@ -0,0 +1,44 @@
+"""
+How AdaptiveScheduler shares the pipeline window between channels.
+
+    python -m pytest tests
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from trebla_client.channels import Channel
+from trebla_client.engine import Pipeline
+from trebla_client.scheduler import AdaptiveScheduler
+
+
+class Client(object):
+    def __init__(self, window):
+        self.pipeline = Pipeline(window)
+
+
+class Subscriber(object):
+    def __init__(self, window, channels):
+        self.client = Client(window)
+        self.channels = {}
+        for name, rate, priority in channels:
+            channel = self.channels[name] = Channel(name, 10, rate, priority)
+            channel.poll = self.client.pipeline.poll(channel.command, None, rate=rate, priority=priority)
+
+
+def depths(window, channels):
+    subscriber = Subscriber(window, channels)
+    scheduler = AdaptiveScheduler(subscriber)
+    scheduler.adjust(now=0.0)
+    return dict((name, channel.poll.depth) for name, channel in subscriber.channels.items())
+
+
+def test_unrated_channels_share_what_is_left():
+    # battery paced at 1 Hz keeps one, the 9 left go 3 to each of the others
+    result = depths(10, [("battery", 1.0, 0), ("acc", None, 2), ("gyro", None, 1), ("mfield", None, 1)])
+    assert result["battery"] == 1
+    assert sorted([result["acc"], result["gyro"], result["mfield"]]) == [3, 3, 3]
+    result = depths(8, [("acc", None, 2), ("gyro", None, 1), ("mfield", None, 0)])
+    assert result == {"acc": 3, "gyro": 3, "mfield": 2}
+    assert sum(depths(32, [("acc", None, 0), ("gyro", None, 0), ("battery", 1.0, 0)]).values()) == 32
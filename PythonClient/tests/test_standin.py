@@ -0,0 +1,49 @@
+"""
+Replaying recorded sessions in the stand-in server.
+
+    python -m pytest tests
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import numpy as np
+import pytest
+
+from trebla_client.recorder import SessionRecorder
+from trebla_client.standin import ReplaySource
+
+
+def record(directory, channels):
+    recorder = SessionRecorder(directory)
+    for name, values in channels.items():
+        recorder.record(name, np.arange(len(values), dtype=np.float64), values)
+    recorder.close()
+
+
+def test_replay_collected_session(tmp_path):
+    # collect names the files <device>.<channel>, device ids can have dots
+    acc = np.array([[1.0, 2.0, 3.0], [4.0, 5.0, 6.0]])
+    record(str(tmp_path), {"ph1.acc": acc, "ph1.shake": acc, "10.0.0.2:8888.acc": acc * 2})
+    source = ReplaySource(str(tmp_path), speed=0)
+    assert source.device == "10.0.0.2:8888"
+    assert source.read("acc", 0).tolist() == [2.0, 4.0, 6.0]
+    source = ReplaySource(str(tmp_path), speed=0, device="ph1")
+    assert sorted(source.recordings) == ["acc"]
+    assert source.read("acc", 0).tolist() == [1.0, 2.0, 3.0]
+    assert source.read("gyro", 0) is None
+
+
+def test_replay_client_session(tmp_path):
+    record(str(tmp_path), {"acc": np.ones((3, 3))})
+    assert ReplaySource(str(tmp_path), speed=0).read("acc", 0).tolist() == [1.0, 1.0, 1.0]
+
+
+def test_replay_rejects_session_without_sensors(tmp_path):
+    record(str(tmp_path), {"ph1.shake": np.ones((3, 3))})
+    with pytest.raises(ValueError):
+        ReplaySource(str(tmp_path))
+    record(str(tmp_path), {"ph1.acc": np.ones((3, 3))})
+    with pytest.raises(ValueError):
+        ReplaySource(str(tmp_path), device="ph2")
@@ -0,0 +1,65 @@
+"""
+Sliding window statistics against brute force, NaN and infinities
+included.
+
+    python -m pytest tests
+"""
+import os
+import sys
+import warnings
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import numpy as np
+
+from trebla_client.framing import decode_vectors
+from trebla_client.stats import StreamStats, WindowStats, candidates
+
+
+def finite_extremes(values):
+    # what the window min and max should be: of the finite values only
+    finite = np.where(np.isfinite(values), values, np.nan)
+    with warnings.catch_warnings():
+        # all NaN columns
+        warnings.simplefilter("ignore", RuntimeWarning)
+        return np.nanmin(finite, axis=0), np.nanmax(finite, axis=0)
+
+
+def test_candidates_skip_non_finite():
+    values = np.array([[1.0, np.nan], [3.0, 2.0], [np.nan, -np.inf]])
+    assert candidates(values).tolist() == [[False, False], [True, True], [False, False]]
+
+
+def test_window_min_max_with_nan_and_inf():
+    rng = np.random.default_rng(1)
+    stream = rng.normal(size=(3000, 3))
+    # bursts of NaN, whole batches of them, and infinities of both signs
+    stream[100:140, 0] = np.nan
+    stream[500:520] = np.nan
+    stream[rng.integers(0, 3000, 60), 1] = np.inf
+    stream[rng.integers(0, 3000, 60), 2] = -np.inf
+    window = WindowStats(3, 50)
+    position = 0
+    while position < len(stream):
+        n = int(rng.integers(1, 12))
+        window.update(stream[position:position + n])
+        position += n
+        low, high = finite_extremes(stream[max(0, position - 50):position])
+        np.testing.assert_array_equal(window.min, low)
+        np.testing.assert_array_equal(window.max, high)
+
+
+def test_nan_replies_from_the_phone():
+    # "NaN" and "Infinity" as Arrays.toString writes them
+    lines = ["[1.0, 2.0, 3.0]", "[NaN, NaN, NaN]", "[Infinity, -Infinity, 0.5]", "[NaN, 1.0, NaN]"]
+    values, malformed = decode_vectors(lines, 3)
+    assert not malformed
+    stats = StreamStats(3, windows=(2,))
+    stats.update(values[:1])
+    stats.update(values[1:2])
+    stats.update(values[2:])
+    window = stats.window()
+    np.testing.assert_array_equal(window.max, [np.nan, 1.0, 0.5])
+    np.testing.assert_array_equal(window.min, [np.nan, 1.0, 0.5])
+    np.testing.assert_array_equal(stats.total.min, [1.0, 1.0, 0.5])
+    np.testing.assert_array_equal(stats.total.max, [1.0, 2.0, 3.0])
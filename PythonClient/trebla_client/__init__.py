@@ -0,0 +1,7 @@
+"""
+Client side building blocks for the Trebla socket server.
+
+The scripts in PythonClient (client.py, client1.py and
+wx_mpl_dynamic_graph.py) use these modules to talk to the phone, the
+modules themselves never import any GUI toolkit.
+"""
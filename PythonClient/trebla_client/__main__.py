@@ -0,0 +1,3 @@
+from trebla_client.cli import main
+
+main()
@@ -0,0 +1,122 @@
+"""
+Thread safe bridge between the asyncio core and code that has its own
+main loop (wx, matplotlib) or no event loop at all.
+
+The bridge runs one event loop in a background thread. Poll callbacks
+run on that loop and should only store the samples (ring buffers), the
+rest, replies to typed commands, unsolicited lines and connection
+changes, are queued as events that the GUI drains from its own timer,
+so there is no GUI event per packet.
+"""
+import asyncio
+import collections
+import concurrent.futures
+import threading
+
+from trebla_client.core import DEFAULT_PORT, TreblaClient
+
+# event kinds returned by drain()
+CONNECTED = "connected"
+DISCONNECTED = "disconnected"
+REPLY = "reply"
+POLLED = "polled"
+UNSOLICITED = "unsolicited"
+
+
+class ClientBridge(object):
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        # deque.append and popleft are thread safe
+        self.events = collections.deque()
+        self._thread = threading.Thread(target=self._run, name="trebla-loop")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def call(self, function, *args):
+        """ Runs function(*args) on the loop, returns a
+            concurrent.futures.Future with its result.
+        """
+        async def wrapper():
+            result = function(*args)
+            if asyncio.iscoroutine(result):
+                result = await result
+            return result
+        return asyncio.run_coroutine_threadsafe(wrapper(), self.loop)
+
+    def connect(self, host, port=DEFAULT_PORT, timeout=None, **kwargs):
+        """ Connects to a phone and returns its TreblaClient, blocks until
+            the first connection is made and raises ConnectionLost if it
+            cannot be made and reconnect is off.
+        """
+        kwargs.setdefault("on_connect", self._on_connect)
+        kwargs.setdefault("on_disconnect", self._on_disconnect)
+        kwargs.setdefault("on_unsolicited", self._on_unsolicited)
+
+        async def connect():
+            client = TreblaClient(host, port, **kwargs)
+            await client.wait_connected()
+            return client
+        return self.call(connect).result(timeout)
+
+    def submit(self, client, command, urgent=True, notify=True):
+        """ Sends a command, returns a concurrent.futures.Future of the
+            reply. With notify the answered engine.Request is also queued
+            as a REPLY event.
+        """
+        future = concurrent.futures.Future()
+
+        def done(request):
+            if notify:
+                self.events.append((REPLY, client, request))
+            if request.error is not None:
+                future.set_exception(request.error)
+            else:
+                future.set_result(request.reply)
+        self.loop.call_soon_threadsafe(client.submit, command, done, urgent)
+        return future
+
+    def ensure_started(self, client, service="sensor", timeout=None):
+        return self.call(client.ensure_started, service).result(timeout)
+
+    def poll(self, client, command, callback, depth=None, batch=True, rate=None, priority=0):
+        """ Starts polling, callback runs on the loop thread. Returns the
+            engine.Poll, stop it with stop_poll().
+        """
+        return self.call(client.poll, command, callback, depth, batch, rate, priority).result()
+
+    def stop_poll(self, poll):
+        self.loop.call_soon_threadsafe(poll.stop)
+
+    def disconnect(self, client, timeout=None):
+        return self.call(client.close).result(timeout)
+
+    def post(self, kind, client, payload):
+        """ Queues an event from the loop thread, e.g. POLLED with a batch
+            of answered poll requests from a poll callback.
+        """
+        self.events.append((kind, client, payload))
+
+    def drain(self, limit=None):
+        """ Returns the (kind, client, payload) events queued so far.
+        """
+        events = []
+        while self.events and (limit is None or len(events) < limit):
+            events.append(self.events.popleft())
+        return events
+
+    def close(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join(1.0)
+
+    def _on_connect(self, client):
+        self.events.append((CONNECTED, client, None))
+
+    def _on_disconnect(self, client, error):
+        self.events.append((DISCONNECTED, client, error))
+
+    def _on_unsolicited(self, client, line):
+        self.events.append((UNSOLICITED, client, line))
@@ -0,0 +1,255 @@
+"""
+Subscriptions to several sensors over one connection.
+
+    subscriber = SensorSubscriber(client)
+    gyro = subscriber.subscribe("gyro")
+    pressure = subscriber.subscribe("pressure", rate=10)
+    shake = subscriber.derive("shake", "gyro", "highpass:0.3,median:5:3")
+
+The polls of all the channels are interleaved on the connection of the
+client and every reply goes to the buffer of its own channel, stored in
+the type and with the number of values of that sensor. Everything runs
+on the event loop of the client, use bridge.call() from other threads.
+Derived channels are filtered (trebla_client.filters) from a polled one
+as its batches arrive.
+"""
+import logging
+
+import numpy as np
+
+from trebla_client import filters, sensors
+from trebla_client.framing import decode_vectors
+from trebla_client.profiling import profiler
+from trebla_client.ringbuffer import SampleRing
+from trebla_client.stats import StreamStats
+from trebla_client.timing import IntervalStats, acquisition_times
+
+log = logging.getLogger(__name__)
+
+
+def infer_width(lines):
+    """ Number of values of the first "[a, b, c]" line, None if there is
+        none.
+    """
+    for line in lines:
+        if line.startswith("[") and line.endswith("]") and len(line) > 2:
+            return line.count(",") + 1
+    return None
+
+
+class Channel(object):
+    """ Samples of one sensor: history is a SampleRing of `width` values
+        per sample in the channel dtype (see sensors.dtype), timestamped
+        at the midpoint of their request (timing.acquisition_times).
+        timing holds the interval, jitter and gaps of the samples, stats
+        (stats.StreamStats) their mean, variance, RMS, min and max since
+        the start and over each of `windows` samples.
+
+        listeners are called as listener(channel, times, values) with
+        every decoded batch.
+    """
+    def __init__(self, name, capacity, rate=None, priority=0, windows=(100,)):
+        self.name = name
+        self.command, self.dtype, width = self._describe(name)
+        self.capacity = capacity
+        self.rate = rate
+        self.priority = priority
+        self.width = None
+        self.history = None
+        self.listeners = []
+        self.poll = None
+        self.malformed = 0
+        # for the scheduler: replies and the sum of their round trips,
+        # samples decoded and how many differed from the previous one
+        self.replies = 0
+        self.rtt_total = 0.0
+        self.received = 0
+        self.fresh = 0
+        self.timing = IntervalStats()
+        self.windows = windows
+        self.stats = None
+        if width is not None:
+            self._allocate(width)
+
+    def __repr__(self):
+        return "<%s %s %s x %s>" % (type(self).__name__, self.name, len(self.history) if self.history else 0, self.width)
+
+    def _describe(self, name):
+        # command polling the channel, its dtype and width (None: from the replies)
+        return sensors.command(name), sensors.dtype(name), sensors.width(name)
+
+    def _allocate(self, width):
+        self.width = width
+        self.history = SampleRing(self.capacity, width, self.dtype)
+        self.stats = StreamStats(width, self.windows)
+
+    def feed(self, requests):
+        """ Decodes a batch of answered requests into the history. Returns
+            the malformed replies.
+        """
+        lines = [r.reply for r in requests]
+        self.replies += len(requests)
+        self.rtt_total += sum(r.rtt for r in requests)
+        if self.width is None:
+            width = infer_width(lines)
+            if width is None:
+                self.malformed += len(lines)
+                return lines
+            # the first reply tells how many values this phone sends
+            self._allocate(width)
+        started = profiler.start()
+        values, malformed = decode_vectors(lines, self.width)
+        times = acquisition_times(requests)
+        profiler.stop("decode", started)
+        if malformed:
+            self.malformed += len(malformed)
+            times = np.delete(times, [i for i, line in malformed])
+        if len(values):
+            self.add(times, values)
+        return [line for i, line in malformed]
+
+    def add(self, times, values):
+        """ Stores a batch of decoded samples and hands it to the listeners.
+        """
+        if self.history is None:
+            self._allocate(values.shape[1])
+        started = profiler.start()
+        # compared as stored, float32 repeats would differ in float64
+        values = values.astype(self.dtype, copy=False)
+        previous = self.history.last(1)[1]
+        if len(previous):
+            values_before = np.concatenate((previous, values[:-1]))
+        else:
+            values_before = np.concatenate((np.full((1, self.width), np.nan), values[:-1]))
+        # the phone answers with the last value it got from the
+        # sensor, polling faster than it updates gives repeats
+        self.fresh += int(np.count_nonzero(np.any(values != values_before, axis=1)))
+        self.received += len(values)
+        self.history.extend(values, times)
+        self.timing.add(times)
+        self.stats.update(values)
+        profiler.stop("buffer", started)
+        for listener in self.listeners:
+            listener(self, times, values)
+
+
+class ComputedChannel(Channel):
+    """ Samples computed on the client and stored with add(). Nothing
+        polls it, otherwise it is a channel like the others: history,
+        timing, stats, listeners.
+    """
+    def _describe(self, name):
+        # the width comes with the first batch
+        return None, np.float32, None
+
+
+class DerivedChannel(ComputedChannel):
+    """ Samples computed from those of another channel by `pipeline` (see
+        filters.Pipeline), as they arrive.
+    """
+    def __init__(self, name, source, pipeline, capacity, windows=(100,)):
+        ComputedChannel.__init__(self, name, capacity, windows=windows)
+        self.source = source
+        self.pipeline = pipeline
+        source.listeners.append(self._on_source)
+
+    def _on_source(self, source, times, values):
+        started = profiler.start()
+        times, values = self.pipeline.process(times, values)
+        profiler.stop("filter", started)
+        if len(values):
+            self.add(times, values)
+
+    def detach(self):
+        if self._on_source in self.source.listeners:
+            self.source.listeners.remove(self._on_source)
+
+
+class SensorSubscriber(object):
+    """ Polls the subscribed channels of a TreblaClient.
+
+        A channel without a rate is polled as fast as the pipeline window
+        allows, sharing it round robin with the others of its priority
+        (see scheduler.AdaptiveScheduler to adapt rates and depths). The listeners are
+        started on demand: when a reply says they are not started (first
+        use, or the phone stopped them when the connection dropped) they
+        are started again, once.
+    """
+    def __init__(self, client, capacity=100 * 60 * 10, windows=(100,)):
+        self.client = client
+        self.capacity = capacity
+        # sizes of the sliding windows of the channel statistics
+        self.windows = windows
+        self.channels = {}
+        self._starting = set()
+
+    def subscribe(self, name, rate=None, priority=0, capacity=None, listener=None):
+        """ Starts polling a channel (sensor name or "battery"), returns its
+            Channel. Subscribing again changes the rate and priority.
+        """
+        channel = self.channels.get(name)
+        if channel is None:
+            channel = Channel(name, capacity or self.capacity, rate, priority, self.windows)
+            self.channels[name] = channel
+        elif channel.poll is not None:
+            channel.poll.stop()
+        if listener is not None:
+            channel.listeners.append(listener)
+        channel.rate = rate
+        channel.priority = priority
+        channel.poll = self.client.poll(channel.command, lambda requests: self._on_replies(channel, requests),
+                                        batch=True, rate=rate, priority=priority)
+        return channel
+
+    def computed(self, name, capacity=None):
+        """ Adds a ComputedChannel `name`, filled by the caller (see
+            fusion.attach()).
+        """
+        if name in self.channels:
+            raise ValueError("channel %s exists" % name)
+        channel = self.channels[name] = ComputedChannel(name, capacity or self.capacity, windows=self.windows)
+        return channel
+
+    def derive(self, name, source, pipeline, capacity=None, listener=None):
+        """ Adds a DerivedChannel `name` computed by `pipeline` (a
+            filters.Pipeline, or its text for filters.parse()) from the
+            channel `source`, which must be subscribed.
+        """
+        if name in self.channels:
+            raise ValueError("channel %s exists" % name)
+        if isinstance(pipeline, str):
+            pipeline = filters.parse(pipeline)
+        channel = DerivedChannel(name, self.channels[source], pipeline, capacity or self.capacity, self.windows)
+        if listener is not None:
+            channel.listeners.append(listener)
+        self.channels[name] = channel
+        return channel
+
+    def unsubscribe(self, name):
+        channel = self.channels.pop(name)
+        if isinstance(channel, DerivedChannel):
+            channel.detach()
+        if channel.poll is not None:
+            channel.poll.stop()
+            channel.poll = None
+
+    def close(self):
+        for name in list(self.channels):
+            self.unsubscribe(name)
+
+    def _on_replies(self, channel, requests):
+        for line in channel.feed(requests):
+            if "not started" in line:
+                self._start("battery" if channel.name == "battery" else "sensor")
+
+    def _start(self, service):
+        if service in self._starting:
+            return
+        self._starting.add(service)
+
+        def started(request):
+            # every reply after this one comes from the started listener
+            self._starting.discard(service)
+            if request.error is None:
+                log.info("%s: %s", self.client, request.reply)
+        self.client.submit(service + " start", started, urgent=True)
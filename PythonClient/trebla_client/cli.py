@@ -0,0 +1,195 @@
+"""
+Command line entry point, without any GUI or plotting import.
+
+    python -m trebla_client collect --host 192.168.0.105 --sensors acc,gyro --out sessions/run1
+    python -m trebla_client standin --port 8888 --rate 100
+
+collect polls the sensors of one or more phones (--host again for every
+phone, host[:port][=id]) and records them to a session directory (see
+trebla_client.recorder) until interrupted, SIGTERM or --duration. It is
+meant to run unattended: connections are retried forever, statistics
+are logged every --stats seconds and SIGUSR1 profiles 30 s into the
+session directory (trebla_client.profiling). --filter records filtered
+channels next to the raw ones (trebla_client.filters), e.g. --filter
+shake=acc,highpass:0.3 for the acceleration without gravity, --fusion
+the orientation of each phone (trebla_client.fusion). ext_gyro in
+--sensors is the gyroscope on the external USB board (trebla_client.usbgyro),
+--ext-gyro-burst N asks for N readings per USB write. The battery and
+the slow sensors are polled at a few Hz (--rate to change it) and the
+window of every phone adapts to its round trip
+(trebla_client.scheduler), unless --fixed-window.
+
+The heavy modules are imported by the command that needs them, so that
+--help and a collector start at once.
+"""
+import argparse
+import asyncio
+import logging
+import signal
+import sys
+
+log = logging.getLogger("trebla_client")
+
+
+def sensor_list(text):
+    from trebla_client import sensors
+    names = [name.strip() for name in text.split(",") if name.strip()]
+    known = set(sensors.SENSOR_WIDTHS) | set(sensors.EXTERNAL_WIDTHS)
+    unknown = [name for name in names if name != "battery" and name not in known]
+    if unknown or not names:
+        raise argparse.ArgumentTypeError("unknown sensor %s, choose from battery, %s" % (
+            ", ".join(unknown) or "''", ", ".join(sorted(known))))
+    return names
+
+
+def rate_spec(text):
+    # NAME=HZ, polls per second of a sensor
+    name, _, rate = text.partition("=")
+    try:
+        rate = float(rate)
+    except ValueError:
+        rate = -1.0
+    if not name.strip() or rate < 0:
+        raise argparse.ArgumentTypeError("expected NAME=HZ, e.g. battery=1, 0 for as fast as possible")
+    return name.strip(), rate
+
+
+def filter_spec(text):
+    # NAME=SOURCE,STAGE[:ARGS],... see trebla_client.filters
+    from trebla_client import filters
+    name, _, rest = text.partition("=")
+    source, _, spec = rest.partition(",")
+    if not name.strip() or not source.strip() or not spec.strip():
+        raise argparse.ArgumentTypeError("expected NAME=SOURCE,STAGE[:ARGS],..., e.g. shake=acc,highpass:0.3")
+    try:
+        filters.parse(spec)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+    return name.strip(), source.strip(), spec
+
+
+async def collect(args):
+    from trebla_client import metrics
+    from trebla_client.fleet import FleetCollector
+    from trebla_client.profiling import install_signal
+    from trebla_client.recorder import SessionRecorder
+
+    recorder = SessionRecorder(args.out) if args.out else None
+    collector = FleetCollector(args.host, args.sensors, args.window,
+                               sink=recorder.record_batch if recorder is not None else lambda batch: None,
+                               derived=args.filter,
+                               fusion=dict(beta=args.fusion_beta) if args.fusion else None,
+                               ext_gyro_scale=args.ext_gyro_scale, ext_gyro_burst=args.ext_gyro_burst,
+                               ext_gyro_rate=args.ext_gyro_rate or None,
+                               rates=dict((name, rate or None) for name, rate in args.rate),
+                               adaptive=not args.fixed_window)
+    server = None
+    if args.metrics_port is not None:
+        registry = metrics.Registry()
+        registry.register(metrics.fleet_metrics(collector))
+        if recorder is not None:
+            registry.register(metrics.recorder_metrics(recorder))
+        server = metrics.MetricsServer(registry, args.metrics_port, host=args.metrics_host)
+
+    stop = asyncio.Event()
+    loop = asyncio.get_event_loop()
+    for signum in ("SIGINT", "SIGTERM"):
+        try:
+            loop.add_signal_handler(getattr(signal, signum), stop.set)
+        except (AttributeError, NotImplementedError):
+            # Windows: Ctrl-C still raises KeyboardInterrupt
+            pass
+    if hasattr(signal, "SIGUSR1"):
+        install_signal(directory=args.out or ".", cprofile=True, tracemalloc=True)
+
+    collector.start()
+    log.info("collecting %s from %s%s", ",".join(args.sensors), ", ".join(args.host),
+             " to %s" % args.out if args.out else "")
+    report = asyncio.ensure_future(collector.report(args.stats)) if args.stats else None
+    try:
+        await asyncio.wait_for(stop.wait(), args.duration or None)
+    except asyncio.TimeoutError:
+        pass
+    finally:
+        if report is not None:
+            report.cancel()
+        await collector.close()
+        if server is not None:
+            server.close()
+        if recorder is not None:
+            # writes what is still queued
+            await loop.run_in_executor(None, recorder.close)
+            log.info("recorded %d samples to %s, %d dropped", recorder.samples, args.out, recorder.dropped)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m trebla_client", description="Trebla client tools")
+    commands = parser.add_subparsers(dest="command", metavar="command")
+    commands.required = True
+
+    p = commands.add_parser("collect", help="record sensors of one or more phones, headless")
+    p.add_argument("--host", action="append", required=True, metavar="HOST[:PORT][=ID]",
+                   help="phone to collect from, repeat for more phones")
+    p.add_argument("--sensors", type=sensor_list, default=["acc"], help="comma separated, e.g. acc,gyro,battery")
+    p.add_argument("--filter", type=filter_spec, action="append", default=[], metavar="NAME=SOURCE,STAGES",
+                   help="also record SOURCE filtered as NAME, e.g. shake=acc,highpass:0.3,median:5:3")
+    p.add_argument("--ext-gyro-scale", type=int, default=250, choices=(250, 500, 2000),
+                   help="full scale (deg/s) the external gyroscope is set to, for ext_gyro")
+    p.add_argument("--ext-gyro-burst", type=int, default=1, metavar="N",
+                   help="ext_gyro readings asked for in one usb -w write, up to 64")
+    p.add_argument("--ext-gyro-rate", type=float, default=0.0, metavar="HZ",
+                   help="ext_gyro writes per second, 0 as fast as the window allows")
+    p.add_argument("--fusion", action="store_true",
+                   help="also record the orientation fused from acc, gyro and mfield (if collected)")
+    p.add_argument("--fusion-beta", type=float, default=0.1, help="gain of the fusion correction, rad/s")
+    p.add_argument("--out", metavar="DIR", help="session directory to record to, nothing is recorded without")
+    p.add_argument("--rate", type=rate_spec, action="append", default=[], metavar="NAME=HZ",
+                   help="polls per second of a sensor, e.g. battery=1 (the default), 0 as fast as possible")
+    p.add_argument("--window", type=int, default=8, help="commands in flight per phone, to start with")
+    p.add_argument("--fixed-window", action="store_true",
+                   help="keep --window and poll as set, without adapting to the phone")
+    p.add_argument("--duration", type=float, default=0.0, help="seconds to collect, 0 until stopped")
+    p.add_argument("--stats", type=float, default=10.0, metavar="SECONDS", help="log statistics that often, 0 never")
+    p.add_argument("--metrics-port", type=int, help="serve Prometheus metrics on this port")
+    p.add_argument("--metrics-host", default="127.0.0.1", help="address to serve the metrics on")
+    p.add_argument("--log-level", default="INFO")
+
+    commands.add_parser("standin", help="stand-in phone server, see its --help", add_help=False)
+
+    if argv is None:
+        argv = sys.argv[1:]
+    if argv[:1] == ["standin"]:
+        # its own options
+        from trebla_client import standin
+        return standin.main(argv[1:])
+
+    args = parser.parse_args(argv)
+    if not 1 <= getattr(args, "ext_gyro_burst", 1) <= 64:
+        parser.error("--ext-gyro-burst must be from 1 to 64")
+    if getattr(args, "fusion", False) and not {"acc", "gyro"} <= set(args.sensors):
+        parser.error("--fusion needs acc and gyro in --sensors")
+    for name, rate in getattr(args, "rate", []):
+        if name not in args.sensors or name == "ext_gyro":
+            parser.error("--rate %s: not a sensor in --sensors (--ext-gyro-rate for ext_gyro)" % name)
+    for name, source, spec in getattr(args, "filter", []):
+        if source not in args.sensors:
+            parser.error("--filter %s: %s is not in --sensors" % (name, source))
+    if getattr(args, "out", None):
+        # each device and channel is a file named after them
+        from trebla_client.fleet import parse_endpoint
+        from trebla_client.recorder import check_channel
+        names = list(args.sensors) + [name for name, source, spec in args.filter]
+        if args.fusion:
+            names += ["orientation_quat", "orientation_euler"]
+        for endpoint in args.host:
+            for name in names:
+                try:
+                    check_channel("%s.%s" % (parse_endpoint(endpoint)[0], name))
+                except ValueError as e:
+                    parser.error("--host %s: %s" % (endpoint, e))
+    logging.basicConfig(level=getattr(logging, args.log_level.upper(), logging.INFO),
+                        format="%(asctime)s %(levelname)s %(message)s")
+    try:
+        asyncio.run(collect(args))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,255 @@
+"""
+asyncio client for the Trebla socket server.
+
+One TreblaClient per phone: it connects (and reconnects), pipelines the
+commands through a Pipeline and frames the replies with a LineFramer.
+Any number of clients run on a single event loop, GUIs that have their
+own main loop go through trebla_client.bridge instead.
+"""
+import asyncio
+import logging
+import socket
+
+from trebla_client.engine import ConnectionLost, Pipeline
+from trebla_client.framing import LineFramer
+from trebla_client.profiling import profiler
+from trebla_client.timing import ClockOffset, clock
+
+log = logging.getLogger(__name__)
+
+DEFAULT_PORT = 8888
+
+
+class TreblaClient(object):
+    """ Connection to one SocketServerService.
+
+        on_connect(client) is called on every (re)connection, before the
+        queued commands go out, on_disconnect(client, error) when the
+        connection is lost and on_unsolicited(client, line) with lines
+        that do not answer any request ("usb -r" data), received_at is
+        then the clock() time they were read at. All of them run on the
+        event loop.
+    """
+    def __init__(self, host, port=DEFAULT_PORT, window=8, reconnect=True,
+                 connect_timeout=2.0, retry_delay=0.5, max_retry_delay=10.0,
+                 on_connect=None, on_disconnect=None, on_unsolicited=None):
+        self.host = host
+        self.port = port
+        self.pipeline = Pipeline(window)
+        self.reconnect = reconnect
+        self.connect_timeout = connect_timeout
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.on_connect = on_connect
+        self.on_disconnect = on_disconnect
+        self.on_unsolicited = on_unsolicited
+        self.connected = False
+        self.connections = 0
+        # traffic, read by trebla_client.metrics
+        self.bytes_received = 0
+        self.lines_received = 0
+        self.unsolicited = 0
+        self.received_at = None
+        # phone clock, for the replies that carry its time
+        self.clock_offset = ClockOffset()
+        self.framer = None
+        self._writer = None
+        self._task = None
+        self._closed = False
+        self._ready = None
+        # wakes pump() up for the rate limited polls
+        self._timer = None
+        self._timer_due = None
+
+    def __repr__(self):
+        return "<TreblaClient %s:%d>" % (self.host, self.port)
+
+    def start(self):
+        """ Connects in the background, returns the task running the
+            connection.
+        """
+        if self._task is None:
+            self._ready = asyncio.get_event_loop().create_future()
+            self._task = asyncio.ensure_future(self.run())
+        return self._task
+
+    async def wait_connected(self):
+        """ Waits for the first connection, raises if it fails and
+            reconnect is off.
+        """
+        self.start()
+        await asyncio.shield(self._ready)
+
+    async def run(self):
+        delay = self.retry_delay
+        while not self._closed:
+            try:
+                reader, writer = await asyncio.wait_for(
+                    asyncio.open_connection(self.host, self.port), self.connect_timeout)
+            except (OSError, asyncio.TimeoutError) as e:
+                error = ConnectionLost("could not connect to %s:%d: %s" % (self.host, self.port, str(e) or "timeout"))
+                if not self.reconnect:
+                    self._set_ready(error)
+                    self.pipeline.fail_all(error)
+                    return
+                log.debug("%s, retrying in %.1f s", error, delay)
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, self.max_retry_delay)
+                continue
+
+            delay = self.retry_delay
+            await self._session(reader, writer)
+            if not self.reconnect:
+                break
+            await asyncio.sleep(self.retry_delay)
+        self.pipeline.fail_all(ConnectionLost("connection closed"))
+
+    async def _session(self, reader, writer):
+        sock = writer.get_extra_info("socket")
+        if sock is not None:
+            # commands are tiny, do not let Nagle hold them back
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._writer = writer
+        self.framer = LineFramer()
+        self.connected = True
+        self.connections += 1
+        self._set_ready(None)
+        if self.on_connect is not None:
+            try:
+                self.on_connect(self)
+            except Exception:
+                log.exception("%s: on_connect failed", self)
+        self.pump()
+
+        error = None
+        try:
+            while True:
+                started = profiler.start()
+                data = await reader.read(65536)
+                profiler.stop("read", started)
+                received_at = clock()
+                if not data:
+                    raise ConnectionLost("connection closed by the server")
+                self.bytes_received += len(data)
+                started = profiler.start()
+                lines = self.framer.feed(data)
+                lines = [line.decode("ascii", "replace") for line in lines]
+                profiler.stop("framing", started)
+                if lines:
+                    self.lines_received += len(lines)
+                    self._dispatch(lines, received_at)
+        except (OSError, ConnectionLost) as e:
+            error = e if isinstance(e, ConnectionLost) else ConnectionLost(str(e))
+        except Exception as e:
+            # a bug on our side, the connection starts again rather than
+            # dying with the task
+            log.exception("%s: receive failed", self)
+            error = ConnectionLost("receive failed: %s" % e)
+        finally:
+            self.connected = False
+            self._writer = None
+            writer.close()
+            if error is None:
+                error = ConnectionLost("connection closed")
+            # the replies to what was in flight will never come
+            self.pipeline.reset(error)
+            if self.on_disconnect is not None and not self._closed:
+                try:
+                    self.on_disconnect(self, error)
+                except Exception:
+                    log.exception("%s: on_disconnect failed", self)
+
+    def _dispatch(self, lines, received_at=None):
+        self.received_at = clock() if received_at is None else received_at
+        for line in self.pipeline.feed_lines(lines, received_at):
+            self.unsolicited += 1
+            if self.on_unsolicited is not None:
+                try:
+                    self.on_unsolicited(self, line)
+                except Exception:
+                    log.exception("%s: on_unsolicited failed", self)
+        self.pump()
+
+    def _set_ready(self, error):
+        if self._ready is not None and not self._ready.done():
+            if error is None:
+                self._ready.set_result(True)
+            else:
+                self._ready.set_exception(error)
+
+    def pump(self):
+        """ Sends as many requests as the window allows in one write.
+        """
+        if not self.connected:
+            return
+        requests = self.pipeline.take()
+        if requests:
+            # new line defines an end of command on the server side
+            self._writer.write("".join(r.command + "\n" for r in requests).encode("ascii"))
+        self._schedule_pump()
+
+    def _schedule_pump(self):
+        # a rate limited poll is not sent by a reply coming in, it needs a
+        # timer when nothing else is in flight
+        due = self.pipeline.next_due()
+        if due is None or (self._timer is not None and self._timer_due <= due):
+            return
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer_due = due
+        self._timer = asyncio.get_event_loop().call_later(max(0.0, due - clock()), self._on_timer)
+
+    def _on_timer(self):
+        self._timer = None
+        self.pump()
+
+    def submit(self, command, callback=None, urgent=False):
+        """ Queues a command, returns its engine.Request.
+        """
+        request = self.pipeline.submit(command, callback, urgent)
+        self.pump()
+        return request
+
+    async def request(self, command, urgent=False, timeout=None):
+        """ Sends a command and returns its reply.
+        """
+        future = asyncio.get_event_loop().create_future()
+
+        def done(request):
+            if future.done():
+                return
+            if request.error is not None:
+                future.set_exception(request.error)
+            else:
+                future.set_result(request.reply)
+        self.submit(command, done, urgent)
+        return await asyncio.wait_for(future, timeout)
+
+    def poll(self, command, callback, depth=None, batch=False, rate=None, priority=0):
+        """ Sends command again and again, see engine.Poll. Polls survive
+            reconnections.
+        """
+        poll = self.pipeline.poll(command, callback, depth, batch, rate, priority)
+        self.pump()
+        return poll
+
+    async def ensure_started(self, service="sensor"):
+        """ Starts the sensor (or battery) listener on the phone unless it
+            is already running, starting it twice leaks a listener.
+        """
+        probe = {"sensor": "sensor acc", "battery": "battery state"}[service]
+        reply = await self.request(probe, urgent=True)
+        if "not started" in reply:
+            await self.request(service + " start", urgent=True)
+
+    async def close(self):
+        self._closed = True
+        if self._writer is not None:
+            self._writer.close()
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except (asyncio.CancelledError, ConnectionLost):
+                pass
+        self.pipeline.fail_all(ConnectionLost("connection closed"))
@@ -0,0 +1,113 @@
+"""
+Min/max decimation of sample histories for plotting.
+
+A line a few hundred pixels wide cannot show more than a couple of
+points per pixel column, so the visible range is cut in buckets of about
+one column and only the minimum and maximum of each bucket are drawn, in
+the order they happened. Peaks survive, unlike with plain subsampling,
+and the cost of a frame depends on the width of the plot, not on the
+length of the history.
+"""
+import numpy as np
+
+
+def minmax(values, size, start=0):
+    """ Decimates values (n, channels), n a multiple of size, to the
+        minimum and maximum of every `size` samples. Returns (x, y) of
+        shape (2 * n / size, channels), x are the sample numbers (values[0]
+        is sample `start`).
+    """
+    count, channels = len(values) // size, values.shape[1]
+    blocks = values.reshape(count, size, channels)
+    low = blocks.argmin(axis=1)
+    high = blocks.argmax(axis=1)
+    offsets = (start + np.arange(count) * size)[:, None]
+    # keep each pair in time order so the line goes through them in order
+    first = np.minimum(low, high)
+    second = np.maximum(low, high)
+    x = np.empty((2 * count, channels), dtype=np.int64)
+    x[0::2] = offsets + first
+    x[1::2] = offsets + second
+    y = np.empty((2 * count, channels), dtype=values.dtype)
+    y[0::2] = np.take_along_axis(blocks, first[:, None, :], axis=1)[:, 0]
+    y[1::2] = np.take_along_axis(blocks, second[:, None, :], axis=1)[:, 0]
+    return x, y
+
+
+def bucket_size(span, pixels):
+    # powers of two, so that the buckets stay the same while the view
+    # moves and only changes when the zoom really does
+    size = 1
+    while size * pixels < span:
+        size *= 2
+    return size
+
+
+class Decimator(object):
+    """ Decimated views of a SampleRing.
+
+        Buckets are aligned on sample numbers, the complete ones are kept
+        from one frame to the next so that when only the tail of the
+        history changed (auto-follow) only the new buckets are computed.
+    """
+    def __init__(self, ring):
+        self.ring = ring
+        self._size = None
+        self._total = 0
+        # complete buckets from sample _start on, as returned by minmax
+        self._start = 0
+        self._x = self._y = None
+
+    def view(self, lo, hi, pixels):
+        """ Returns (x, y), shape (m, channels), of the samples lo to hi
+            (sample numbers, hi excluded) decimated for a plot `pixels`
+            wide, about 2 * pixels points at most.
+        """
+        total = self.ring.total
+        if total < self._total:
+            # the ring was cleared
+            self._x = None
+        self._total = total
+        lo = max(lo, total - len(self.ring))
+        hi = max(lo, min(hi, total))
+        size = bucket_size(hi - lo, max(1, int(pixels)))
+        head = -(-lo // size) * size
+        tail = hi // size * size
+        if size == 1 or tail <= head:
+            # nothing to reduce
+            return self._raw(lo, hi)
+        # partial buckets at the edges are drawn as they are, there are
+        # fewer samples in them than in one bucket
+        parts = (self._raw(lo, head), self._buckets(head, tail, size), self._raw(tail, hi))
+        return (np.concatenate([x for x, y in parts]),
+                np.concatenate([y for x, y in parts]))
+
+    def _samples(self, lo, hi):
+        # view of the samples lo to hi, all of them still in the ring
+        times, values = self.ring.last(self.ring.total - lo)
+        return values[:hi - lo]
+
+    def _raw(self, lo, hi):
+        x = np.repeat(np.arange(lo, hi)[:, None], self.ring.channels, axis=1)
+        return x, self._samples(lo, hi)
+
+    def _buckets(self, lo, hi, size):
+        if self._x is not None:
+            stop = self._start + len(self._x) // 2 * size
+        if size != self._size or self._x is None or not self._start <= lo <= stop:
+            # zoomed, scrolled back before the cache or jumped past it
+            self._size, self._start, stop = size, lo, lo
+            self._x = np.zeros((0, self.ring.channels), dtype=np.int64)
+            self._y = self._x.astype(self._samples(lo, lo).dtype)
+        elif lo > self._start:
+            # drop what scrolled out of the view, the cache stays the size
+            # of the view
+            skip = 2 * ((lo - self._start) // size)
+            self._x, self._y = self._x[skip:], self._y[skip:]
+            self._start = lo
+        if hi > stop:
+            x, y = minmax(self._samples(stop, hi), size, stop)
+            self._x = np.concatenate((self._x, x))
+            self._y = np.concatenate((self._y, y))
+        count = 2 * ((hi - lo) // size)
+        return self._x[:count], self._y[:count]
@@ -0,0 +1,297 @@
+"""
+Pipelined requests for the Trebla socket server.
+
+SocketServerService reads one command line at a time and answers every
+command with exactly one reply line, in order. Waiting for each reply
+before sending the next command caps the sample rate at 1/RTT, so
+instead we keep up to `window` commands in flight and match the replies
+to the requests in FIFO order.
+
+Pipeline holds the bookkeeping and does no I/O, TreblaClient in
+trebla_client.core drives it over the connection.
+"""
+import collections
+import logging
+import socket
+import threading
+
+from trebla_client.timing import RttEstimator, clock, wall
+
+log = logging.getLogger(__name__)
+
+
+class ConnectionLost(Exception):
+    pass
+
+
+class Request(object):
+    """ A command sent to the server and its (future) reply. sent_at and
+        replied_at are timing.clock() times.
+    """
+    def __init__(self, command, callback=None):
+        self.command = command
+        self.poll = None
+        self.reply = None
+        self.error = None
+        self.sent_at = None
+        self.replied_at = None
+        self._event = threading.Event()
+        self._callbacks = []
+        if callback is not None:
+            self._callbacks.append(callback)
+
+    @property
+    def rtt(self):
+        return self.replied_at - self.sent_at
+
+    @property
+    def acquired_at(self):
+        # wall time of the midpoint, the best guess of when the phone
+        # read the value it replied
+        return wall((self.sent_at + self.replied_at) / 2)
+
+    def done(self):
+        return self._event.is_set()
+
+    def result(self, timeout=None):
+        """ Blocks until the reply arrives and returns it.
+        """
+        if not self._event.wait(timeout):
+            raise socket.timeout("no reply to '%s'" % self.command)
+        if self.error is not None:
+            raise self.error
+        return self.reply
+
+    def add_done_callback(self, callback):
+        # callbacks are called with the request as only argument
+        if self.done():
+            callback(self)
+        else:
+            self._callbacks.append(callback)
+
+    def _finish(self, reply=None, error=None, now=None):
+        self.reply = reply
+        self.error = error
+        self.replied_at = clock() if now is None else now
+        self._event.set()
+        for callback in self._callbacks:
+            try:
+                callback(self)
+            except Exception:
+                # one bad consumer must not take the connection down
+                log.exception("callback of '%s' failed", self.command)
+        self._callbacks = []
+
+
+class Poll(object):
+    """ A command that is sent again and again as long as there is room
+        in the window, e.g. "sensor acc".
+
+        With batch=True the callback gets the list of requests answered
+        by one received chunk instead of one call per request, so the
+        replies can be decoded together. With a rate the command is sent
+        at most `rate` times per second. When several polls are due the
+        one with the highest priority goes first.
+    """
+    def __init__(self, pipeline, command, callback, depth=None, batch=False, rate=None, priority=0):
+        self.pipeline = pipeline
+        self.command = command
+        self.callback = callback
+        # maximum number of requests of this poll in flight, None means
+        # as many as the window allows
+        self.depth = depth
+        self.batch = batch
+        self.interval = 1.0 / rate if rate else None
+        self.priority = priority
+        # time the next request may be sent at
+        self.due = 0.0
+        self.inflight = 0
+        self.active = True
+
+    def stop(self):
+        self.pipeline.cancel_poll(self)
+
+    def set_rate(self, rate):
+        # None to poll as fast as the window allows
+        self.interval = 1.0 / rate if rate else None
+
+    def ready(self, now):
+        return (self.depth is None or self.inflight < self.depth) and now >= self.due
+
+    def _sent(self, now):
+        self.inflight += 1
+        if self.interval is not None:
+            # keeps the average rate after a late send, without a burst
+            # to catch up on a long stall
+            self.due = max(self.due, now - self.interval) + self.interval
+
+    def _deliver(self, requests):
+        # replies to requests that were already sent when the poll was
+        # stopped are still delivered, failed requests never are
+        requests = [r for r in requests if r.error is None]
+        if not requests:
+            return
+        try:
+            if self.batch:
+                self.callback(requests)
+            else:
+                for request in requests:
+                    self.callback(request)
+        except Exception:
+            # the replies are lost to this poll, not the connection
+            log.exception("poll '%s' failed", self.command)
+
+
+class Pipeline(object):
+    """ Keeps track of the queued and in flight requests of one connection.
+
+        Interactive commands submitted with urgent=True go out before the
+        queued ones, and both go before the polls, so a "usb -w" typed
+        by the user only waits for a free slot in the window.
+
+        pushed, when set, tells the lines the server sends by itself
+        (pushed(line) is true) from the replies: "usb -r" data can come
+        at any time, also between two replies, and must not take the
+        place of one (see usbgyro.is_usb_data).
+    """
+    def __init__(self, window=4, pushed=None):
+        self.window = window
+        self.pushed = pushed
+        self._lock = threading.RLock()
+        self._urgent = collections.deque()
+        self._queued = collections.deque()
+        self._inflight = collections.deque()
+        self._polls = []
+        self._next_poll = 0
+        # round trips of the answered requests
+        self.rtt = RttEstimator()
+
+    def submit(self, command, callback=None, urgent=False):
+        request = Request(command, callback)
+        with self._lock:
+            if urgent:
+                self._urgent.append(request)
+            else:
+                self._queued.append(request)
+        return request
+
+    def poll(self, command, callback, depth=None, batch=False, rate=None, priority=0):
+        poll = Poll(self, command, callback, depth, batch, rate, priority)
+        with self._lock:
+            self._polls.append(poll)
+        return poll
+
+    def cancel_poll(self, poll):
+        with self._lock:
+            poll.active = False
+            if poll in self._polls:
+                self._polls.remove(poll)
+
+    def in_flight(self):
+        return len(self._inflight)
+
+    def next_due(self):
+        """ Time at which a rate limited poll can be sent, None if none is
+            waiting for its time or the window is full anyway.
+        """
+        with self._lock:
+            if len(self._inflight) >= self.window:
+                return None
+            due = [poll.due for poll in self._polls if poll.interval is not None
+                   and (poll.depth is None or poll.inflight < poll.depth)]
+        return min(due) if due else None
+
+    def take(self):
+        """ Returns the requests that can be sent now and marks them as
+            in flight, the caller must send them in that order.
+        """
+        taken = []
+        now = clock()
+        with self._lock:
+            while len(self._inflight) < self.window:
+                request = self._next_request(now)
+                if request is None:
+                    break
+                request.sent_at = now
+                self._inflight.append(request)
+                taken.append(request)
+        return taken
+
+    def _next_request(self, now):
+        if self._urgent:
+            return self._urgent.popleft()
+        if self._queued:
+            return self._queued.popleft()
+        # the polls that still have room and are due, highest priority
+        # first and round robin between equal priorities
+        chosen = None
+        for i in range(len(self._polls)):
+            poll = self._polls[(self._next_poll + i) % len(self._polls)]
+            if poll.ready(now) and (chosen is None or poll.priority > chosen[1].priority):
+                chosen = (i, poll)
+        if chosen is None:
+            return None
+        i, poll = chosen
+        self._next_poll = (self._next_poll + i + 1) % len(self._polls)
+        poll._sent(now)
+        request = Request(poll.command)
+        request.poll = poll
+        return request
+
+    def feed_lines(self, lines, now=None):
+        """ Matches reply lines to the requests in flight, in order. now is
+            when they were received, clock() by default.
+
+            Returns the lines that did not answer any request, e.g. data
+            forwarded by "usb -r".
+        """
+        now = clock() if now is None else now
+        pushed = []
+        if self.pushed is not None:
+            replies = []
+            for line in lines:
+                (pushed if self.pushed(line) else replies).append(line)
+            lines = replies
+        with self._lock:
+            count = min(len(lines), len(self._inflight))
+            matched = [self._inflight.popleft() for _ in range(count)]
+            for request in matched:
+                if request.poll is not None:
+                    request.poll.inflight -= 1
+        if matched:
+            self.rtt.add([now - request.sent_at for request in matched])
+        self._finish(matched, lines, now=now)
+        return pushed + lines[count:]
+
+    def _finish(self, requests, replies=None, error=None, now=None):
+        # polled requests are handed over grouped by poll
+        polls = collections.OrderedDict()
+        for i, request in enumerate(requests):
+            request._finish(replies[i] if replies is not None else None, error, now)
+            if request.poll is not None:
+                polls.setdefault(request.poll, []).append(request)
+        for poll, polled in polls.items():
+            poll._deliver(polled)
+
+    def reset(self, error):
+        """ Fails the requests in flight when the connection is lost, the
+            queued requests and the polls are kept for the next connection.
+        """
+        with self._lock:
+            pending = list(self._inflight)
+            self._inflight.clear()
+            for poll in self._polls:
+                poll.inflight = 0
+        self._finish(pending, error=error)
+
+    def fail_all(self, error):
+        with self._lock:
+            pending = list(self._inflight) + list(self._urgent) + list(self._queued)
+            self._inflight.clear()
+            self._urgent.clear()
+            self._queued.clear()
+            for poll in self._polls:
+                poll.active = False
+                poll.inflight = 0
+            self._polls = []
+        self._finish(pending, error=error)
@@ -0,0 +1,242 @@
+"""
+Filters for sample streams, applied to whole batches.
+
+A Pipeline chains stages, each keeps its state from one batch to the
+next so a stream filtered in batches gives the same result as filtered
+at once. The stages work on (n, width) arrays with NumPy, never sample
+by sample in Python:
+
+  - LowPass(cutoff, order): first order sections in cascade, on the
+    sample timestamps, so the irregular poll times do not change the
+    cutoff; run as one cumulative sum per batch,
+  - HighPass(cutoff, order): what the low-pass leaves out, HighPass(0.3)
+    removes gravity from "acc",
+  - MovingAverage(n): mean of the last n samples,
+  - MedianDespike(n, threshold): replaces the samples further than
+    threshold times the (normalized) median absolute deviation from the
+    median of the last n samples by that median, every sample without a
+    threshold (a median filter),
+  - Scale(gain, offset): units.
+
+Pipelines are also described by text, for the command line:
+
+    pipeline = filters.parse("highpass:0.3,median:5:3,scale:0.102")
+
+channels.SensorSubscriber.derive() makes a filtered channel of one it
+polls.
+"""
+import math
+
+import numpy as np
+
+# exp() of more than this would overflow, the batch is cut in blocks
+_MAX_EXPONENT = 300.0
+
+
+def _median(windows):
+    # of the last axis, sorting a few values beats np.median
+    ordered = np.sort(windows, axis=-1)
+    n = windows.shape[-1]
+    if n % 2:
+        return ordered[..., n // 2]
+    return (ordered[..., n // 2 - 1] + ordered[..., n // 2]) / 2
+
+
+def _sliding(values, tail, n):
+    """ (len(values), width, n) windows of the last n samples at each of
+        values, tail holds the n - 1 samples before them. Returns the
+        windows and the new tail.
+    """
+    if tail is None:
+        # the stream starts as if its first sample had always been there
+        tail = np.repeat(values[:1], n - 1, axis=0)
+    data = np.concatenate((tail, values))
+    windows = np.lib.stride_tricks.sliding_window_view(data, n, axis=0)
+    return windows, data[len(data) - (n - 1):]
+
+
+class LowPass(object):
+    """ Low-pass of `order` identical first order sections with a time
+        constant of 1 / (2 pi cutoff) seconds.
+
+        A sample weighs by the time since the previous one, at least
+        min_interval seconds: samples sharing a timestamp (pipelined
+        requests answered together) still count.
+    """
+    def __init__(self, cutoff, order=1, min_interval=0.001):
+        self.cutoff = cutoff
+        self.order = int(order)
+        self.min_interval = min_interval
+        self.tau = 1.0 / (2 * math.pi * cutoff)
+        self.reset()
+
+    def reset(self):
+        self._last_time = None
+        # output of each section for the last sample
+        self._state = None
+
+    def process(self, times, values):
+        if not len(values):
+            return values
+        # filter time: the timestamps, with at least min_interval between
+        if self._last_time is None:
+            steps = np.concatenate(([0.0], np.maximum(np.diff(times), self.min_interval)))
+            self._state = [values[0].copy() for _ in range(self.order)]
+        else:
+            steps = np.maximum(np.diff(times, prepend=self._last_time), self.min_interval)
+        self._last_time = float(times[-1])
+        elapsed = np.cumsum(steps) / self.tau
+        for section in range(self.order):
+            values = self._section(elapsed, values, section)
+        return values
+
+    def _section(self, elapsed, values, section):
+        # y[k] = d y[k - 1] + (1 - d) x[k] with d = exp(-step / tau), as
+        # y[k] = e^-s[k] (y[-1] + sum (1 - d[j]) e^s[j] x[j]) over blocks
+        # short enough for e^s
+        previous = self._state[section]
+        if elapsed[-1] <= _MAX_EXPONENT:
+            # the usual batch, in one block
+            weight = -np.expm1(-np.diff(elapsed, prepend=0.0))
+            sums = np.cumsum((weight * np.exp(elapsed))[:, None] * values, axis=0)
+            output = np.exp(-elapsed)[:, None] * (previous + sums)
+            self._state[section] = output[-1].copy()
+            return output
+        output = np.empty(values.shape)
+        start, origin = 0, 0.0
+        while start < len(values):
+            stop = int(np.searchsorted(elapsed, origin + _MAX_EXPONENT, side="right"))
+            stop = max(stop, start + 1)
+            s = elapsed[start:stop] - origin
+            weight = -np.expm1(-np.diff(s, prepend=0.0))
+            # only a single step can be longer, it forgets the past anyway
+            s = np.minimum(s, _MAX_EXPONENT)
+            sums = np.cumsum((weight * np.exp(s))[:, None] * values[start:stop], axis=0)
+            output[start:stop] = np.exp(-s)[:, None] * (previous + sums)
+            previous = output[stop - 1]
+            origin = elapsed[stop - 1]
+            start = stop
+        self._state[section] = previous.copy()
+        return output
+
+
+class HighPass(LowPass):
+    """ What LowPass(cutoff, order) leaves out: the signal minus its slow
+        part, a constant (gravity) is removed within a few time constants.
+    """
+    def process(self, times, values):
+        return values - LowPass.process(self, times, values)
+
+
+class MovingAverage(object):
+    """ Mean of the last n samples.
+    """
+    def __init__(self, n):
+        self.n = int(n)
+        self.reset()
+
+    def reset(self):
+        self._tail = None
+
+    def process(self, times, values):
+        if not len(values) or self.n == 1:
+            return values
+        if self._tail is None:
+            self._tail = np.repeat(values[:1], self.n - 1, axis=0)
+        data = np.concatenate((self._tail, values))
+        sums = np.cumsum(data, axis=0)
+        output = sums[self.n - 1:].copy()
+        output[1:] -= sums[:-self.n]
+        self._tail = data[len(data) - (self.n - 1):]
+        return output / self.n
+
+
+class MedianDespike(object):
+    """ Despiking on the median of the last n samples, see the module.
+        1.4826 times the median absolute deviation estimates the standard
+        deviation of normal noise.
+    """
+    def __init__(self, n=5, threshold=None):
+        self.n = int(n)
+        self.threshold = threshold
+        self.reset()
+
+    def reset(self):
+        self._tail = None
+
+    def process(self, times, values):
+        if not len(values) or self.n == 1:
+            return values
+        windows, self._tail = _sliding(values, self._tail, self.n)
+        median = _median(windows)
+        if self.threshold is None:
+            return median
+        deviation = 1.4826 * _median(np.abs(windows - median[:, :, None]))
+        spikes = np.abs(values - median) > self.threshold * deviation
+        return np.where(spikes, median, values)
+
+
+class Scale(object):
+    """ values * gain + offset, gain and offset scalars or one per value.
+    """
+    def __init__(self, gain, offset=0.0):
+        self.gain = np.asarray(gain, dtype=np.float64)
+        self.offset = np.asarray(offset, dtype=np.float64)
+
+    def reset(self):
+        pass
+
+    def process(self, times, values):
+        return values * self.gain + self.offset
+
+
+class Pipeline(object):
+    """ Stages applied in order to every batch.
+    """
+    def __init__(self, stages=()):
+        self.stages = list(stages)
+
+    def __repr__(self):
+        return "<Pipeline %s>" % ", ".join(type(stage).__name__ for stage in self.stages)
+
+    def reset(self):
+        for stage in self.stages:
+            stage.reset()
+
+    def process(self, times, values):
+        """ Filters (times, (n, width) values), returns (times, values)
+            with the values as float64.
+        """
+        times = np.asarray(times, dtype=np.float64)
+        values = np.asarray(values, dtype=np.float64).reshape(len(times), -1)
+        for stage in self.stages:
+            values = stage.process(times, values)
+        return times, values
+
+
+# names of the stages in parse(), their arguments follow separated by ":"
+STAGES = {
+    "lowpass": LowPass,
+    "highpass": HighPass,
+    "average": MovingAverage,
+    "median": MedianDespike,
+    "scale": Scale,
+}
+
+
+def parse(spec):
+    """ Pipeline of a text like "highpass:0.3,median:5:3": stages
+        separated by commas, each a name of STAGES and its arguments.
+    """
+    stages = []
+    for item in spec.split(","):
+        parts = [part.strip() for part in item.split(":")]
+        if not parts[0]:
+            continue
+        if parts[0] not in STAGES:
+            raise ValueError("unknown filter %s, choose from %s" % (parts[0], ", ".join(sorted(STAGES))))
+        try:
+            stages.append(STAGES[parts[0]](*[float(part) for part in parts[1:]]))
+        except (TypeError, ValueError) as e:
+            raise ValueError("bad filter %s: %s" % (item.strip(), e))
+    return Pipeline(stages)
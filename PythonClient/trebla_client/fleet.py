@@ -0,0 +1,348 @@
+"""
+Collects samples from many phones in one process.
+
+Every phone gets its own TreblaClient on the same event loop and its
+own channels.SensorSubscriber, all of them are polled concurrently and
+the samples of every channel come out as one merged stream of
+SampleBatch, tagged with the device id, for storage or plotting. The
+channels are those of a subscriber: filters, fusion, the external
+gyroscope and the metrics work on a device like on a single client.
+
+    python -m trebla_client.fleet 192.168.0.105 192.168.0.106:8888=rig2 [--metrics-port 9464]
+"""
+import argparse
+import asyncio
+import collections
+import copy
+import functools
+import logging
+import math
+import time
+
+from trebla_client import filters, metrics, sensors, usbgyro
+from trebla_client.channels import DerivedChannel, SensorSubscriber
+from trebla_client.core import DEFAULT_PORT, TreblaClient
+from trebla_client.fusion import OrientationFusion
+from trebla_client.scheduler import AdaptiveScheduler
+
+log = logging.getLogger(__name__)
+
+
+class SampleBatch(collections.namedtuple("SampleBatch", "device channel times values")):
+    """ Samples of one channel of one device, times has n timestamps and
+        values is (n, width).
+    """
+    __slots__ = ()
+
+
+def parse_endpoint(text):
+    """ "host[:port][=id]" -> (id, host, port), the id defaults to host:port.
+    """
+    text, _, device_id = text.partition("=")
+    host, _, port = text.partition(":")
+    port = int(port) if port else DEFAULT_PORT
+    return device_id or "%s:%d" % (host, port), host, port
+
+
+class DeviceStats(object):
+    """ Running figures of one device.
+    """
+    # time constant of the rate estimate (seconds)
+    tau = 2.0
+
+    def __init__(self):
+        self.samples = 0
+        self.dropped = 0
+        self.connections = 0
+        self.last_sample_at = None
+        self._rate = 0.0
+
+    def update(self, count, now):
+        if self.last_sample_at is not None and now > self.last_sample_at:
+            # exponentially weighted rate of events, independent of how
+            # the samples happen to be grouped in batches
+            dt = now - self.last_sample_at
+            alpha = 1.0 - math.exp(-dt / self.tau)
+            self._rate += alpha * (count / dt - self._rate)
+        self.samples += count
+        self.last_sample_at = now
+
+    def rate(self, now=None):
+        if self.last_sample_at is None:
+            return 0.0
+        now = time.time() if now is None else now
+        # decays when the samples stop coming
+        return self._rate * math.exp(-max(0.0, now - self.last_sample_at) / self.tau)
+
+    def lag(self, now=None):
+        # age of the newest sample
+        if self.last_sample_at is None:
+            return None
+        return (time.time() if now is None else now) - self.last_sample_at
+
+
+class Device(object):
+    def __init__(self, device_id, host, port):
+        self.id = device_id
+        self.host = host
+        self.port = port
+        self.client = None
+        # channels.SensorSubscriber of the client, once started, and its
+        # scheduler.AdaptiveScheduler
+        self.subscriber = None
+        self.scheduler = None
+        self.stats = DeviceStats()
+        # usbgyro.ExternalGyro when ext_gyro is collected
+        self.ext_gyro = None
+
+    @property
+    def malformed(self):
+        if self.subscriber is None:
+            return 0
+        return sum(channel.malformed for channel in self.subscriber.channels.values())
+
+
+class FleetCollector(object):
+    """ Polls `channels` (sensors.command names) on every endpoint,
+        each at its rate of `rates` and priority of `priorities` ({name:
+        value}, sensors.POLL_RATES and POLL_PRIORITIES for the others).
+        With adaptive an AdaptiveScheduler per device sizes the window,
+        starting from `window`, and shares it between the channels.
+
+        derived are (name, source, spec) channels: the batches of
+        the channel `source` of every device also go through the pipeline
+        filters.parse(spec), its own for each device, and come out as
+        batches of the channel `name`.
+
+        With fusion (keyword arguments of fusion.OrientationFusion, {} for
+        the defaults) the acc, gyro and mfield channels (the last if
+        collected) of all the devices are fused together every
+        fusion_interval seconds into the channels orientation_quat and
+        orientation_euler.
+
+        Every device keeps the last `capacity` samples of each channel in
+        device.subscriber.channels, the sink gets all of them.
+
+        ext_gyro in channels is the gyroscope on the external board of
+        the phones (trebla_client.usbgyro), of ext_gyro_scale deg/s full
+        scale, read ext_gyro_burst at a time at most ext_gyro_rate times
+        per second (None as fast as the window allows).
+
+        The batches go to sink(batch) when a sink is given, otherwise to a
+        bounded queue read with batches(); when the queue is full the
+        oldest batch is dropped and counted, a slow consumer never stalls
+        the sockets.
+    """
+    def __init__(self, endpoints, channels=("acc",), window=8, sink=None, queue_size=10000, derived=(),
+                 fusion=None, fusion_interval=0.05, ext_gyro_scale=usbgyro.DEFAULT_FULL_SCALE,
+                 ext_gyro_burst=1, ext_gyro_rate=None, capacity=100 * 60, rates=None, priorities=None,
+                 adaptive=True):
+        self.devices = collections.OrderedDict()
+        self.channels = list(channels)
+        self.derived = [(name, source, filters.parse(spec) if isinstance(spec, str) else spec)
+                        for name, source, spec in derived]
+        for name, source, spec in self.derived:
+            if source not in self.channels:
+                raise ValueError("filter %s: %s is not collected" % (name, source))
+        for endpoint in endpoints:
+            device_id, host, port = parse_endpoint(endpoint) if isinstance(endpoint, str) else endpoint
+            if device_id in self.devices:
+                raise ValueError("duplicate device id %s" % device_id)
+            self.devices[device_id] = Device(device_id, host, port)
+        self.ext_gyro_scale = ext_gyro_scale
+        self.ext_gyro_burst = ext_gyro_burst
+        self.ext_gyro_rate = ext_gyro_rate
+        self.capacity = capacity
+        self.rates = dict(sensors.POLL_RATES, **(rates or {}))
+        self.priorities = dict(sensors.POLL_PRIORITIES, **(priorities or {}))
+        self.adaptive = adaptive
+        self.window = window
+        self.sink = sink
+        self.queue = collections.deque(maxlen=queue_size)
+        self.fusion = None
+        self.fusion_interval = fusion_interval
+        if fusion is not None:
+            if "acc" not in self.channels or "gyro" not in self.channels:
+                raise ValueError("fusion needs the acc and gyro channels")
+            self.fusion = OrientationFusion(len(self.devices), magnetic="mfield" in self.channels, **fusion)
+        # device id -> row in the fusion
+        self._sensor = dict((device_id, i) for i, device_id in enumerate(self.devices))
+        self._wakeup = None
+        self._fusing = None
+
+    def start(self):
+        self._wakeup = asyncio.Event()
+        if self.fusion is not None:
+            self._fusing = asyncio.ensure_future(self._fuse())
+        for device in self.devices.values():
+            device.client = TreblaClient(
+                device.host, device.port, self.window, reconnect=True,
+                on_connect=functools.partial(self._on_connect, device),
+                on_disconnect=functools.partial(self._on_disconnect, device),
+                on_unsolicited=functools.partial(self._on_unsolicited, device))
+            self._subscribe(device)
+            if self.adaptive:
+                device.scheduler = AdaptiveScheduler(device.subscriber, max_window=max(32, self.window)).start()
+            device.client.start()
+
+    def _subscribe(self, device):
+        # the polls survive the reconnections, the subscriber starts the
+        # listeners again when the replies say they stopped
+        subscriber = device.subscriber = SensorSubscriber(device.client, self.capacity)
+        listener = functools.partial(self._on_samples, device)
+        for name in self.channels:
+            if name == "ext_gyro":
+                device.ext_gyro = usbgyro.attach(subscriber, self.ext_gyro_scale, rate=self.ext_gyro_rate,
+                                                 priority=self.priorities.get(name, 0), burst=self.ext_gyro_burst)
+                subscriber.channels[name].listeners.append(listener)
+            else:
+                subscriber.subscribe(name, self.rates.get(name), self.priorities.get(name, 0), listener=listener)
+        for name, source, pipeline in self.derived:
+            # a pipeline of its own for every device
+            subscriber.derive(name, source, copy.deepcopy(pipeline), listener=listener)
+        if self.fusion is not None:
+            for name in ("orientation_quat", "orientation_euler"):
+                subscriber.computed(name).listeners.append(listener)
+
+    def _on_connect(self, device, client):
+        device.stats.connections += 1
+        log.info("%s connected", device.id)
+        if device.ext_gyro is not None:
+            asyncio.ensure_future(self._start_ext_gyro(device))
+
+    async def _start_ext_gyro(self, device):
+        # "usb -r" stops with every disconnection on the phone
+        try:
+            await device.ext_gyro.start(device.client)
+        except Exception as e:
+            log.warning("%s: could not start the external gyroscope: %s", device.id, e)
+
+    def _on_disconnect(self, device, client, error):
+        log.warning("%s: %s", device.id, error)
+        for channel in device.subscriber.channels.values():
+            if isinstance(channel, DerivedChannel):
+                channel.pipeline.reset()
+        if device.ext_gyro is not None:
+            device.ext_gyro.reset()
+
+    def _on_unsolicited(self, device, client, line):
+        # the usb data are taken by usbgyro.attach before
+        log.debug("%s: unsolicited %r", device.id, line)
+
+    def _on_samples(self, device, channel, times, values):
+        # listener of every channel of the devices
+        device.stats.update(len(values), float(times[-1]))
+        self.emit(SampleBatch(device.id, channel.name, times, values))
+        if self.fusion is not None and channel.name in self.fusion.streams:
+            self.fusion.add(self._sensor[device.id], channel.name, times, values)
+
+    async def _fuse(self):
+        # the samples of all the devices since the last time, together
+        while True:
+            await asyncio.sleep(self.fusion_interval)
+            try:
+                results = self.fusion.flush()
+            except Exception:
+                log.exception("fusion failed")
+                continue
+            for device, (times, quaternions, angles) in zip(self.devices.values(), results):
+                if len(times):
+                    device.subscriber.channels["orientation_quat"].add(times, quaternions)
+                    device.subscriber.channels["orientation_euler"].add(times, angles)
+
+    def emit(self, batch):
+        if self.sink is not None:
+            self.sink(batch)
+            return
+        if len(self.queue) == self.queue.maxlen:
+            self.devices[self.queue[0].device].stats.dropped += len(self.queue[0].times)
+        self.queue.append(batch)
+        self._wakeup.set()
+
+    async def batches(self):
+        """ Yields the merged batches of all devices as they arrive.
+        """
+        while True:
+            while self.queue:
+                yield self.queue.popleft()
+            self._wakeup.clear()
+            await self._wakeup.wait()
+
+    def stats(self):
+        """ Per device figures: connected, samples, rate (samples/s), lag
+            (age of the newest sample), latency (smoothed request round
+            trip), window (commands allowed in flight), malformed,
+            dropped, connections, saturated (ext_gyro readings beyond the
+            full scale) and the interval, jitter and gaps of each channel
+            (timing.IntervalStats).
+        """
+        now = time.time()
+        result = collections.OrderedDict()
+        for device in self.devices.values():
+            stats = device.stats
+            channels = device.subscriber.channels.values() if device.subscriber is not None else ()
+            result[device.id] = {
+                "connected": device.client is not None and device.client.connected,
+                "samples": stats.samples,
+                "rate": stats.rate(now),
+                "lag": stats.lag(now),
+                "latency": device.client.pipeline.rtt.srtt if device.client is not None else None,
+                "window": device.client.pipeline.window if device.client is not None else None,
+                "malformed": device.malformed,
+                "dropped": stats.dropped,
+                "connections": stats.connections,
+                "saturated": device.ext_gyro.saturated if device.ext_gyro is not None else 0,
+                "channels": dict((channel.name, channel.timing.stats()) for channel in channels
+                                 if channel.timing.count),
+            }
+        return result
+
+    async def report(self, interval=5.0):
+        """ Logs one line per device every interval seconds.
+        """
+        while True:
+            await asyncio.sleep(interval)
+            for device_id, s in self.stats().items():
+                log.info("%s %s %d samples %.1f/s lag %s latency %s malformed %d dropped %d",
+                         device_id, "up" if s["connected"] else "DOWN", s["samples"], s["rate"],
+                         "-" if s["lag"] is None else "%.3fs" % s["lag"],
+                         "-" if s["latency"] is None else "%.1fms" % (s["latency"] * 1000),
+                         s["malformed"], s["dropped"])
+
+    async def close(self):
+        if self._fusing is not None:
+            self._fusing.cancel()
+            self._fusing = None
+        for device in self.devices.values():
+            if device.scheduler is not None:
+                device.scheduler.stop()
+            if device.client is not None:
+                await device.client.close()
+
+
+async def _main(endpoints, metrics_port=None):
+    collector = FleetCollector(endpoints, sink=lambda batch: None)
+    collector.start()
+    server = None
+    if metrics_port is not None:
+        registry = metrics.Registry()
+        registry.register(metrics.fleet_metrics(collector))
+        server = metrics.MetricsServer(registry, metrics_port, host="")
+    try:
+        await collector.report()
+    finally:
+        if server is not None:
+            server.close()
+        await collector.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Collect from many phones")
+    parser.add_argument("endpoints", nargs="+", metavar="host[:port][=id]")
+    parser.add_argument("--metrics-port", type=int, help="serve Prometheus metrics on this port")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    try:
+        asyncio.run(_main(args.endpoints, args.metrics_port))
+    except KeyboardInterrupt:
+        pass
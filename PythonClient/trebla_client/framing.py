@@ -0,0 +1,173 @@
+"""
+Line framing and bulk decoding of the server replies.
+
+The server terminates every reply with a new line, but TCP is free to
+glue several replies into one segment or to split one reply over two,
+so the received bytes are framed on the new lines first. Sensor replies
+look like "[x, y, z]" (java.util.Arrays.toString), a whole batch of them
+is decoded into one NumPy array instead of one regex and three float()
+calls per sample.
+"""
+import warnings
+
+import numpy as np
+
+NEWLINE = ord("\n")
+OPEN_BRACKET = ord("[")
+CLOSE_BRACKET = ord("]")
+COMMA = ord(",")
+SPACE = ord(" ")
+TAB = ord("\t")
+
+# below this many lines the NumPy call overhead is larger than the work
+SMALL_BATCH = 16
+
+
+class LineFramer(object):
+    """ Splits a byte stream into lines using a reusable receive buffer.
+    """
+    def __init__(self, bufsize=65536):
+        self._buf = bytearray(bufsize)
+        self._end = 0
+        self.lines = 0
+        self.bytes = 0
+
+    def recv_into(self, conn):
+        """ Reads from the socket straight into the buffer and returns the
+            complete lines, an empty list if none is complete yet and None
+            when the connection is closed.
+        """
+        if self._end == len(self._buf):
+            # a single line is larger than the buffer
+            self._buf.extend(bytearray(len(self._buf)))
+        count = conn.recv_into(memoryview(self._buf)[self._end:])
+        if not count:
+            return None
+        return self._frame(count)
+
+    def feed(self, data):
+        """ Same as recv_into() for data that has already been read.
+        """
+        if self._end + len(data) > len(self._buf):
+            self._buf.extend(bytearray(self._end + len(data) - len(self._buf)))
+        self._buf[self._end:self._end + len(data)] = data
+        return self._frame(len(data))
+
+    def pending(self):
+        # bytes of the incomplete last line
+        return self._end
+
+    def _frame(self, count):
+        start = self._end
+        self._end += count
+        self.bytes += count
+        # only the new bytes can hold the terminator of a line
+        last = self._buf.rfind(b"\n", start, self._end)
+        if last < 0:
+            return []
+        lines = bytes(self._buf[:last]).split(b"\n")
+        # keep the incomplete line at the start of the buffer
+        rest = self._end - last - 1
+        self._buf[:rest] = self._buf[last + 1:self._end]
+        self._end = rest
+        self.lines += len(lines)
+        return [line.rstrip(b"\r") for line in lines]
+
+
+def decode_vectors(lines, width):
+    """ Decodes "[a, b, c]" replies of `width` values each.
+
+        Returns the (n, width) float64 array of the well formed lines and
+        the list of (index, line) of the malformed ones, e.g. "null" for a
+        sensor the phone does not have or "internal sensor listener not
+        started".
+    """
+    if not lines:
+        return np.empty((0, width)), []
+    if len(lines) < SMALL_BATCH:
+        return _decode_small(lines, width)
+    if isinstance(lines[0], bytes):
+        data = b"\n".join(lines) + b"\n"
+    else:
+        data = ("\n".join(lines) + "\n").encode("ascii", "replace")
+
+    # check the shape of every line at once on the raw bytes
+    raw = np.frombuffer(data, dtype=np.uint8)
+    ends = np.flatnonzero(raw == NEWLINE)
+    starts = np.empty_like(ends)
+    starts[0] = 0
+    starts[1:] = ends[:-1] + 1
+    is_comma = raw == COMMA
+    commas = np.add.reduceat(is_comma, starts)
+    good = (raw[starts] == OPEN_BRACKET) & (raw[np.maximum(ends - 1, 0)] == CLOSE_BRACKET) & (commas == width - 1)
+    # an empty value, "[]" or "[1.0, , 2.0]": only blanks from a bracket or
+    # comma to the next, which NumPy would not reject
+    separators = np.flatnonzero(is_comma | (raw == OPEN_BRACKET) | (raw == CLOSE_BRACKET))
+    filled = np.cumsum((raw != SPACE) & (raw != TAB))
+    empty = (raw[separators[:-1]] != CLOSE_BRACKET) & (filled[separators[1:] - 1] == filled[separators[:-1]])
+    if empty.any():
+        good[np.searchsorted(ends, separators[:-1][empty])] = False
+
+    if good.all():
+        text = data
+    else:
+        text = b"\n".join(line for line, ok in zip(_as_bytes(lines), good) if ok) + b"\n"
+    values = _parse(text, width)
+    if values is None:
+        # a number that does not parse, find the culprits one by one
+        good = good.copy()
+        rows = []
+        for i, line in enumerate(_as_bytes(lines)):
+            if good[i]:
+                row = _parse(line + b"\n", width)
+                if row is None:
+                    good[i] = False
+                else:
+                    rows.append(row[0])
+        values = np.array(rows).reshape(-1, width)
+
+    bad = [(int(i), lines[i]) for i in np.flatnonzero(~good)]
+    return values, bad
+
+
+def _decode_small(lines, width):
+    rows = []
+    bad = []
+    for i, line in enumerate(lines):
+        try:
+            if line[:1] not in ("[", b"[") or line[-1:] not in ("]", b"]"):
+                raise ValueError(line)
+            if ("_" if isinstance(line, str) else b"_") in line:
+                # float() takes "1_0" as 10, the bulk path does not
+                raise ValueError(line)
+            row = [float(value) for value in line[1:-1].split(b"," if isinstance(line, bytes) else ",")]
+        except ValueError:
+            bad.append((i, line))
+            continue
+        if len(row) == width:
+            rows.append(row)
+        else:
+            bad.append((i, line))
+    return np.array(rows, dtype=np.float64).reshape(-1, width), bad
+
+
+def _as_bytes(lines):
+    if isinstance(lines[0], bytes):
+        return lines
+    return [line.encode("ascii", "replace") for line in lines]
+
+
+def _parse(text, width):
+    # the lines with an empty value were left out by decode_vectors
+    flat = text.replace(b"[", b"").replace(b"]", b"").replace(b"\n", b",")
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            # old numpy versions only warn and return what they could parse
+            values = np.fromstring(flat[:-1], dtype=np.float64, sep=",")
+    except ValueError:
+        return None
+    # every value is followed by a separator in flat
+    if len(values) != flat.count(b","):
+        return None
+    return values.reshape(-1, width)
@@ -0,0 +1,232 @@
+"""
+Orientation from acc, gyro and mfield, computed on the client.
+
+The phone's "rotation" is its own fusion, with the gyro bias resets of
+the phone (see the README). Madgwick's filter integrates the gyro and
+corrects the drift with one gradient descent step per sample towards
+the orientation where gravity (acc) and the magnetic field (mfield)
+point where they should; without mfield the heading is only integrated.
+
+The filter is recursive, each sample needs the orientation after the
+previous one, so it runs sample by sample but for many sensors at once:
+Madgwick keeps (count, 4) quaternions and every step is a few NumPy
+operations over all of them, a fleet of phones costs hardly more than
+one. OrientationFusion first aligns the three channels of each sensor
+on a common grid (resample.StreamAligner).
+
+    fusion = attach(subscriber, acc="acc", gyro="gyro", mfield="mfield")
+    subscriber.channels["orientation_quat"]     # w, x, y, z
+    subscriber.channels["orientation_euler"]    # roll, pitch, yaw (rad)
+"""
+import numpy as np
+
+from trebla_client.profiling import profiler
+from trebla_client.resample import StreamAligner
+
+STREAMS = ("acc", "gyro", "mfield")
+
+
+def _normalized(v):
+    norm = np.sqrt((v * v).sum(axis=-1, keepdims=True))
+    return v / np.where(norm > 0, norm, 1.0)
+
+
+def multiply(p, q):
+    """ Hamilton products of (..., 4) quaternions w, x, y, z.
+    """
+    pw, px, py, pz = np.moveaxis(p, -1, 0)
+    qw, qx, qy, qz = np.moveaxis(q, -1, 0)
+    return np.stack((pw * qw - px * qx - py * qy - pz * qz,
+                     pw * qx + px * qw + py * qz - pz * qy,
+                     pw * qy - px * qz + py * qw + pz * qx,
+                     pw * qz + px * qy - py * qx + pz * qw), axis=-1)
+
+
+def euler(q):
+    """ Roll, pitch and yaw (radians, aerospace ZYX) of (..., 4)
+        quaternions.
+    """
+    w, x, y, z = np.moveaxis(q, -1, 0)
+    roll = np.arctan2(2 * (w * x + y * z), 1 - 2 * (x * x + y * y))
+    pitch = np.arcsin(np.clip(2 * (w * y - z * x), -1.0, 1.0))
+    yaw = np.arctan2(2 * (w * z + x * y), 1 - 2 * (y * y + z * z))
+    return np.stack((roll, pitch, yaw), axis=-1)
+
+
+class Madgwick(object):
+    """ Madgwick's filter for `count` sensors, q (count, 4) their
+        orientations (sensor to earth). beta is the gain of the
+        correction, in rad/s: larger follows acc and mfield faster and
+        lets more of their noise through.
+    """
+    def __init__(self, count=1, beta=0.1):
+        self.count = count
+        self.beta = beta
+        self.q = np.tile([1.0, 0.0, 0.0, 0.0], (count, 1))
+
+    def step(self, dt, gyro, acc, mfield=None, valid=None):
+        """ One sample of every sensor: gyro (count, 3) rad/s, acc and
+            mfield (count, 3) any unit, dt seconds, one for all or (count,).
+            Only the rows where valid (count,) is true change.
+        """
+        # written out on (count,) columns, stacking small arrays costs
+        # more than the arithmetic
+        q = self.q
+        w, x, y, z = q.T
+        gx, gy, gz = gyro.T
+        ax, ay, az = _normalized(acc).T
+        # gravity where q says it is minus where acc says (f), and the
+        # gradient of its square J^T f
+        f1 = 2 * (x * z - w * y) - ax
+        f2 = 2 * (w * x + y * z) - ay
+        f3 = 1 - 2 * (x * x + y * y) - az
+        sw = -2 * y * f1 + 2 * x * f2
+        sx = 2 * z * f1 + 2 * w * f2 - 4 * x * f3
+        sy = -2 * w * f1 + 2 * z * f2 - 4 * y * f3
+        sz = 2 * x * f1 + 2 * y * f2
+        if mfield is not None:
+            mx, my, mz = _normalized(mfield).T
+            # the field in the earth frame, its horizontal part turned to x
+            hx = (1 - 2 * (y * y + z * z)) * mx + 2 * (x * y - w * z) * my + 2 * (x * z + w * y) * mz
+            hy = 2 * (x * y + w * z) * mx + (1 - 2 * (x * x + z * z)) * my + 2 * (y * z - w * x) * mz
+            bz = 2 * (x * z - w * y) * mx + 2 * (y * z + w * x) * my + (1 - 2 * (x * x + y * y)) * mz
+            bx = np.sqrt(hx * hx + hy * hy)
+            f1 = 2 * bx * (0.5 - y * y - z * z) + 2 * bz * (x * z - w * y) - mx
+            f2 = 2 * bx * (x * y - w * z) + 2 * bz * (w * x + y * z) - my
+            f3 = 2 * bx * (w * y + x * z) + 2 * bz * (0.5 - x * x - y * y) - mz
+            sw = sw - 2 * bz * y * f1 + (-2 * bx * z + 2 * bz * x) * f2 + 2 * bx * y * f3
+            sx = sx + 2 * bz * z * f1 + (2 * bx * y + 2 * bz * w) * f2 + (2 * bx * z - 4 * bz * x) * f3
+            sy = sy + (-4 * bx * y - 2 * bz * w) * f1 + (2 * bx * x + 2 * bz * z) * f2 + (2 * bx * w - 4 * bz * y) * f3
+            sz = sz + (-4 * bx * z + 2 * bz * x) * f1 + (-2 * bx * w + 2 * bz * y) * f2 + 2 * bx * x * f3
+        norm = np.sqrt(sw * sw + sx * sx + sy * sy + sz * sz)
+        gain = self.beta / np.where(norm > 0, norm, 1.0)
+        # rate of change: q * (0, gyro) / 2, minus the correction
+        updated = np.empty_like(q)
+        updated[:, 0] = w + dt * (0.5 * (-x * gx - y * gy - z * gz) - gain * sw)
+        updated[:, 1] = x + dt * (0.5 * (w * gx + y * gz - z * gy) - gain * sx)
+        updated[:, 2] = y + dt * (0.5 * (w * gy - x * gz + z * gx) - gain * sy)
+        updated[:, 3] = z + dt * (0.5 * (w * gz + x * gy - y * gx) - gain * sz)
+        updated = _normalized(updated)
+        if valid is not None:
+            updated = np.where(valid[:, None], updated, q)
+        self.q = updated
+        return updated
+
+    def run(self, dt, gyro, acc, mfield=None, valid=None):
+        """ step() over (steps, count, 3) arrays, dt one for all or
+            (steps, count), valid (steps, count). Returns the (steps,
+            count, 4) orientations.
+        """
+        output = np.empty((len(gyro), self.count, 4))
+        for i in range(len(gyro)):
+            output[i] = self.step(dt[i] if np.ndim(dt) else dt, gyro[i], acc[i], None if mfield is None else mfield[i],
+                                  None if valid is None else valid[i])
+        return output
+
+
+class OrientationFusion(object):
+    """ Orientation of `count` sensors (phones), each with its acc, gyro
+        and, with magnetic, mfield channels resampled at `rate` Hz.
+
+        add() the batches as they come, flush() runs one Madgwick step
+        per grid point for all the sensors together and returns what is
+        new for each. A step integrates the gyro over the time since the
+        previous grid point of its sensor: one interval, or more where the
+        aligner left points out, at most max_gap (or one interval without
+        max_gap) as the gyro after a break says nothing about it.
+    """
+    def __init__(self, count=1, rate=100.0, beta=0.1, magnetic=True, max_gap=0.5):
+        self.count = count
+        self.rate = float(rate)
+        self.max_dt = max_gap if max_gap else 1.0 / self.rate
+        self.streams = STREAMS if magnetic else STREAMS[:2]
+        self.filter = Madgwick(count, beta)
+        self.aligners = [StreamAligner([3] * len(self.streams), rate, max_gap) for _ in range(count)]
+        # per sensor, aligned rows not fused yet
+        self._times = [[] for _ in range(count)]
+        self._rows = [[] for _ in range(count)]
+        # per sensor, time of the last row fused
+        self._last = np.full(count, np.nan)
+
+    @property
+    def pending(self):
+        # aligned rows waiting for flush(), of the sensor with the most
+        return max(sum(len(t) for t in times) for times in self._times)
+
+    def add(self, sensor, stream, times, values):
+        """ Adds samples of stream ("acc", "gyro" or "mfield") of sensor
+            number `sensor`.
+        """
+        times, rows = self.aligners[sensor].update(self.streams.index(stream), times, values)
+        if len(times):
+            self._times[sensor].append(times)
+            self._rows[sensor].append(rows)
+
+    def flush(self):
+        """ Returns [(times, quaternions (n, 4), euler (n, 3))] of every
+            sensor.
+        """
+        started = profiler.start()
+        times = [np.concatenate(t) if t else np.zeros(0) for t in self._times]
+        rows = [np.concatenate(r) if r else np.zeros((0, 3 * len(self.streams))) for r in self._rows]
+        self._times = [[] for _ in range(self.count)]
+        self._rows = [[] for _ in range(self.count)]
+        steps = max(len(t) for t in times)
+        if not steps:
+            profiler.stop("fusion", started)
+            return [(t, np.zeros((0, 4)), np.zeros((0, 3))) for t in times]
+        dt = np.full((steps, self.count), 1.0 / self.rate)
+        # (steps, count, columns), the sensors with fewer rows are padded
+        # and left as they are on the steps they have no row for
+        data = np.ones((steps, self.count, rows[0].shape[1]))
+        valid = np.zeros((steps, self.count), dtype=bool)
+        for i, r in enumerate(rows):
+            data[:len(r), i] = r
+            valid[:len(r), i] = True
+            if len(r):
+                dt[:len(r), i] = self._intervals(i, times[i])
+        acc, gyro = data[:, :, 0:3], data[:, :, 3:6]
+        mfield = data[:, :, 6:9] if len(self.streams) == 3 else None
+        quaternions = self.filter.run(dt, gyro, acc, mfield, valid)
+        angles = euler(quaternions)
+        profiler.stop("fusion", started)
+        return [(t, quaternions[:len(t), i], angles[:len(t), i]) for i, t in enumerate(times)]
+
+    def _intervals(self, sensor, times):
+        # seconds from each row to the one before, one grid interval for
+        # the first row of a sensor
+        previous = np.concatenate(([self._last[sensor]], times[:-1]))
+        self._last[sensor] = times[-1]
+        dt = np.clip(times - previous, 0.0, self.max_dt)
+        return np.where(np.isnan(dt), 1.0 / self.rate, dt)
+
+
+def attach(subscriber, name="orientation", acc="acc", gyro="gyro", mfield=None, rate=100.0, beta=0.1,
+           interval=0.05):
+    """ Adds the channels <name>_quat (w, x, y, z) and <name>_euler (roll,
+        pitch, yaw in radians) to a channels.SensorSubscriber, fused from
+        its channels acc, gyro and mfield (None for none) as their batches
+        arrive, `interval` seconds of samples at a time. Returns the
+        OrientationFusion.
+    """
+    # aligned rows fused together, not a flush per batch of each channel
+    rows = max(1, int(round(interval * rate)))
+    fusion = OrientationFusion(1, rate, beta, magnetic=mfield is not None)
+    quaternions = subscriber.computed(name + "_quat")
+    angles = subscriber.computed(name + "_euler")
+
+    def listener(stream):
+        def on_batch(channel, times, values):
+            fusion.add(0, stream, times, values)
+            if fusion.pending < rows:
+                return
+            times, q, e = fusion.flush()[0]
+            if len(times):
+                quaternions.add(times, q)
+                angles.add(times, e)
+        return on_batch
+
+    for stream, source in zip(STREAMS, (acc, gyro, mfield)):
+        if source is not None:
+            subscriber.channels[source].listeners.append(listener(stream))
+    return fusion
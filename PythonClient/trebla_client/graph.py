@@ -0,0 +1,261 @@
+"""
+The acceleration graph of wx_mpl_dynamic_graph.py, without wx.
+
+AccTracker polls the acceleration and keeps the samples, AccGraph is the
+matplotlib figure drawn from them: the x, y and z axes, the PSD and the
+spectrogram. The frame gives the figure a wx canvas, the benchmarks an
+Agg one:
+
+    graph = AccGraph(tracker, RollingSpectrum(100.0, 3, frames=128), 128)
+    graph.attach(FigureCanvasAgg(graph.fig))
+    graph.draw()
+"""
+import math
+import time
+
+import numpy as np
+from matplotlib.artist import setp
+from matplotlib.figure import Figure
+
+from . import filters
+from .decimate import Decimator
+from .framing import decode_vectors
+from .profiling import profiler
+from .render import BlitRenderer
+from .ringbuffer import SampleRing
+from .stats import StreamStats
+from .timing import IntervalStats, acquisition_times
+
+
+class AccTracker(object):
+    """ Polls an acceleration command and keeps the samples, the polling
+        runs on the bridge loop, the frame only reads acc_history. With a
+        recorder (recorder.SessionRecorder) the samples are recorded too.
+        With acc_pipeline (filters.Pipeline) the history, statistics and
+        plot get the filtered samples, recorded as "acc_filtered" next to
+        the raw ones.
+    """
+    def __init__(self, bridge, history=100 * 60 * 10, recorder=None):
+        self.bridge = bridge
+        self.recorder = recorder
+        self.acc_poll = None
+        # the last `history` samples, 10 minutes at 100 Hz by default
+        self.acc_history = SampleRing(history, 3)
+        # what the plot draws of it
+        self.acc_decimator = Decimator(self.acc_history)
+        # interval, jitter and gaps of the samples
+        self.acc_timing = IntervalStats()
+        # mean, RMS, min and max over the last second and the history
+        self.acc_stats = StreamStats(3, windows=(100, history))
+        self.acc_pipeline = None
+
+    def track(self, client, command):
+        # keeps several commands in flight instead of waiting for each reply
+        if self.acc_poll is None:
+            self.acc_poll = self.bridge.poll(client, command, self.on_acc_replies)
+
+    def stop(self):
+        if self.acc_poll is not None:
+            self.bridge.stop_poll(self.acc_poll)
+            self.acc_poll = None
+
+    def set_filter(self, spec):
+        # filters.parse() text, "" for the raw samples; the pipeline is
+        # swapped whole, the bridge loop sees the old or the new one
+        self.acc_pipeline = filters.parse(spec) if spec else None
+
+    def on_acc_replies(self, requests):
+        # every reply received in one go is decoded at once
+        started = profiler.start()
+        acc_data, malformed = decode_vectors([r.reply for r in requests], 3)
+        # each sample at the midpoint of its request
+        times = np.delete(acquisition_times(requests), [i for i, line in malformed])
+        profiler.stop("decode", started)
+        if len(acc_data):
+            self.add(times, acc_data)
+
+    def add(self, times, acc_data):
+        raw = acc_data
+        pipeline = self.acc_pipeline
+        if pipeline is not None:
+            started = profiler.start()
+            times, acc_data = pipeline.process(times, acc_data)
+            profiler.stop("filter", started)
+        started = profiler.start()
+        self.acc_history.extend(acc_data, times)
+        self.acc_timing.add(times)
+        self.acc_stats.update(acc_data)
+        profiler.stop("buffer", started)
+        recorder = self.recorder
+        if recorder is not None:
+            recorder.record("acc", times, raw)
+            if pipeline is not None:
+                recorder.record("acc_filtered", times, acc_data)
+
+
+class AccGraph(object):
+    """ The figure of the samples of tracker (AccTracker) and of spectrum
+        (RollingSpectrum), `frames` spectra wide spectrogram.
+
+        draw() only lays the axes out again when the bounds, grid or
+        labels changed, then redraws through a BlitRenderer, or the whole
+        canvas with blit off. frame_time is the time of the last frame
+        drawn without blitting.
+    """
+    # samples shown when the x bounds are on auto
+    follow_width = 20
+
+    def __init__(self, tracker, spectrum, frames, dpi=100):
+        self.tracker = tracker
+        self.spectrum = spectrum
+        self.frames = frames
+        self.dpi = dpi
+        self.canvas = None
+        # bounds, grid and labels the axes were last laid out with
+        self.layout = None
+        self.renderer = None
+        self.frame_time = 0.0
+        self.fig = Figure(None, dpi)
+        self.fig.subplots_adjust(bottom=0.05, wspace=0.1, hspace=0.2, left=0.0455, top=0.99, right=0.99)
+        self.all_axes = tuple(self.fig.add_subplot(411 + i) for i in range(3))
+        # plot the data as a line series per axis, and save the
+        # references to the plotted line series
+        history = tracker.acc_history
+        self.plot_lines = tuple(
+            axes.plot(history.channel(i) if len(history) else [0], linewidth=1, color=(1, 1, 0))[0]
+            for i, axes in enumerate(self.all_axes))
+
+        # spectra panel: PSD of the three axes on the left, spectrogram
+        # of their sum on the right, newest spectrum at time 0
+        self.axes_psd = self.fig.add_subplot(427)
+        self.axes_spectrogram = self.fig.add_subplot(428)
+        self.axes_psd.set_yscale('log')
+        self.axes_psd.set_xlim(0, spectrum.rate / 2)
+        freqs = spectrum.freqs
+        self.psd_lines = tuple(
+            self.axes_psd.plot(freqs, np.ones(len(freqs)), linewidth=1, color=color, label=label)[0]
+            for color, label in (('r', 'x'), ('g', 'y'), ('b', 'z')))
+        self.axes_psd.legend(loc='upper right', fontsize=8)
+        seconds = frames * spectrum.hop / spectrum.rate
+        self.spectrogram_image = self.axes_spectrogram.imshow(
+            np.full((len(freqs), frames), np.nan),
+            aspect='auto', origin='lower', interpolation='nearest',
+            extent=(-seconds, 0, 0, spectrum.rate / 2))
+        for axes in self.all_axes + (self.axes_psd, self.axes_spectrogram):
+            setp(axes.get_xticklabels(), fontsize=8)
+            setp(axes.get_yticklabels(), fontsize=8)
+
+    def attach(self, canvas, blit=True):
+        # the canvas of self.fig, whatever the backend
+        self.canvas = canvas
+        self.set_blit(blit)
+
+    def set_blit(self, blit):
+        if self.renderer is not None:
+            self.renderer.close()
+            self.renderer = None
+        if blit:
+            self.renderer = BlitRenderer(self.canvas, self.plot_lines + self.psd_lines + (self.spectrogram_image,))
+        self.layout = None
+
+    def draw(self, xmin=None, xmax=None, ymin=None, ymax=None, grid=True, xlabels=True):
+        """ Redraws the plot, a None bound is on auto.
+        """
+        history = self.tracker.acc_history
+        # sample number of the newest sample in memory
+        newest = history.total if len(history) else 1
+
+        # when xmin is on auto, it "follows" xmax to produce a
+        # sliding window effect. therefore, xmin is assigned after
+        # xmax.
+        #
+        if xmax is None:
+            xmax = max(newest, self.follow_width)
+            follow = xmin is None
+        else:
+            follow = False
+        if xmin is None:
+            xmin = xmax - self.follow_width
+
+        # when following, x counts the samples back from the newest: the
+        # bounds stay put and the frames need no new layout (nor a full
+        # redraw when blitting), like client1.py
+        offset = xmax if follow else 0
+
+        # for ymin and ymax, take the minimal and maximal values
+        # of the history, kept up to date as the samples arrive,
+        # and add a mininal margin.
+        #
+        history_stats = self.tracker.acc_stats.window(history.capacity)
+        if ymin is None:
+            ymins = np.round(np.nan_to_num(history_stats.min), 0) - 1
+        else:
+            ymins = [ymin] * 3
+        if ymax is None:
+            ymaxs = np.round(np.nan_to_num(history_stats.max), 0) + 1
+        else:
+            ymaxs = [ymax] * 3
+
+        # PSD bounds in whole decades, they seldom change
+        psd = self.spectrum.psd()
+        psd_bounds = (1e-6, 1.0)
+        if psd is not None:
+            positive = psd[1:][psd[1:] > 0]
+            if len(positive):
+                psd_bounds = (10.0 ** math.floor(math.log10(positive.min())),
+                              10.0 ** math.ceil(math.log10(positive.max())))
+
+        layout = (xmin - offset, xmax - offset, tuple(ymins), tuple(ymaxs), psd_bounds, grid, xlabels)
+        layout_changed = layout != self.layout
+        if layout_changed:
+            # bounds, grid and tick labels only change once in a while,
+            # there is no point laying the axes out again every frame
+            self.layout = layout
+            for axes, low, high in zip(self.all_axes, ymins, ymaxs):
+                axes.set_xbound(lower=xmin - offset, upper=xmax - offset)
+                axes.set_ybound(lower=low, upper=high)
+
+                # anecdote: axes.grid assumes b=True if any other flag is
+                # given even if b is set to False.
+                # so just passing the flag into the first statement won't
+                # work.
+                #
+                if grid:
+                    axes.grid(True, color='gray')
+                else:
+                    axes.grid(False)
+
+                # Using setp here is convenient, because get_xticklabels
+                # returns a list over which one needs to explicitly
+                # iterate, and setp already handles this.
+                #
+                setp(axes.get_xticklabels(), visible=xlabels)
+            self.axes_psd.set_ylim(*psd_bounds)
+            if grid:
+                self.axes_psd.grid(True, color='gray')
+            else:
+                self.axes_psd.grid(False)
+            self.spectrogram_image.set_clim(*np.log10(psd_bounds))
+
+        # about two points per pixel of the visible range, whatever the
+        # zoom, one more sample on each side so the line reaches the edges
+        xdata, ydata = self.tracker.acc_decimator.view(xmin - 1, xmax + 2, self.all_axes[0].bbox.width)
+        xdata = xdata - offset
+        for index, line in enumerate(self.plot_lines):
+            line.set_data(xdata[:, index], ydata[:, index])
+
+        if psd is not None:
+            for index, line in enumerate(self.psd_lines):
+                line.set_ydata(psd[:, index])
+            # oldest spectrum on the left, columns without one stay empty
+            times, power = self.spectrum.spectrogram(self.frames)
+            image = np.full((len(self.spectrum.freqs), self.frames), np.nan)
+            image[:, self.frames - len(power):] = np.log10(power.sum(axis=2) + 1e-12).T
+            self.spectrogram_image.set_data(image)
+
+        if self.renderer is not None:
+            self.renderer.draw(layout_changed)
+        else:
+            start = time.perf_counter()
+            self.canvas.draw()
+            self.frame_time = time.perf_counter() - start
@@ -0,0 +1,302 @@
+"""
+Counters and gauges of the client, for dashboards and logs.
+
+Nothing is counted here: the hot path keeps plain attributes (bytes and
+lines received by a TreblaClient, malformed replies of a Channel, drops
+of a SessionRecorder...) and collectors read them when the metrics are
+asked for. A collector is a function yielding (name, kind, help, labels,
+value) tuples, registered with Registry.register(); the *_metrics()
+functions below make them for the objects of this package.
+
+    registry = metrics.Registry()
+    registry.register(metrics.client_metrics(client))
+    server = metrics.MetricsServer(registry, port=9464)   # Prometheus
+    reporter = metrics.LogReporter(registry, interval=10)  # one log line
+
+RateLimitedLog replaces the per reply prints of the clients.
+"""
+import collections
+import http.server
+import logging
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+COUNTER = "counter"
+GAUGE = "gauge"
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class Registry(object):
+    def __init__(self):
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def register(self, collector):
+        with self._lock:
+            self._collectors.append(collector)
+        return collector
+
+    def unregister(self, collector):
+        with self._lock:
+            if collector in self._collectors:
+                self._collectors.remove(collector)
+
+    def collect(self):
+        """ Returns {name: (kind, help, [(labels, value)])}.
+        """
+        with self._lock:
+            collectors = list(self._collectors)
+        metrics = collections.OrderedDict()
+        for collector in collectors:
+            try:
+                # the objects keep changing on their own threads
+                samples = list(collector())
+            except Exception:
+                log.exception("metrics collector %r failed", collector)
+                continue
+            for name, kind, text, labels, value in samples:
+                if value is None:
+                    continue
+                metrics.setdefault(name, (kind, text, []))[2].append((labels, value))
+        return metrics
+
+    def render(self):
+        """ The metrics in the Prometheus text format.
+        """
+        lines = []
+        for name, (kind, text, samples) in self.collect().items():
+            lines.append("# HELP %s %s" % (name, text))
+            lines.append("# TYPE %s %s" % (name, kind))
+            for labels, value in samples:
+                if labels:
+                    label_text = ",".join('%s="%s"' % (k, _escape(v)) for k, v in sorted(labels.items()))
+                    lines.append("%s{%s} %r" % (name, label_text, float(value)))
+                else:
+                    lines.append("%s %r" % (name, float(value)))
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        """ One compact line: every metric summed over its labels, gauges
+            of ratios and seconds averaged.
+        """
+        parts = []
+        for name, (kind, text, samples) in self.collect().items():
+            values = [float(value) for labels, value in samples]
+            short = name.replace("trebla_", "", 1)
+            if kind == COUNTER:
+                short = short[:-len("_total")] if short.endswith("_total") else short
+                value = sum(values)
+            elif short.endswith(("_ratio", "_seconds")):
+                value = sum(values) / len(values)
+            else:
+                value = sum(values)
+            parts.append("%s=%s" % (short, _compact(value)))
+        return " ".join(parts)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _compact(value):
+    if value == int(value) and abs(value) < 1e15:
+        value = int(value)
+        for unit, size in (("G", 1e9), ("M", 1e6), ("k", 1e3)):
+            if abs(value) >= 10 * size:
+                return "%.1f%s" % (value / size, unit)
+        return str(value)
+    return "%.4g" % value
+
+
+def client_metrics(client, **labels):
+    """ Collector of a TreblaClient: traffic, pipeline and round trip.
+    """
+    def collect():
+        pipeline = client.pipeline
+        yield "trebla_connected", GAUGE, "1 while connected to the phone", labels, int(client.connected)
+        yield "trebla_connections_total", COUNTER, "Connections made", labels, client.connections
+        yield "trebla_bytes_received_total", COUNTER, "Bytes received", labels, client.bytes_received
+        yield "trebla_lines_received_total", COUNTER, "Lines framed", labels, client.lines_received
+        yield "trebla_unsolicited_lines_total", COUNTER, "Lines answering no request", labels, client.unsolicited
+        yield "trebla_requests_in_flight", GAUGE, "Commands sent and not answered", labels, pipeline.in_flight()
+        yield "trebla_pipeline_window", GAUGE, "Commands allowed in flight", labels, pipeline.window
+        yield "trebla_rtt_seconds", GAUGE, "Smoothed request round trip", labels, pipeline.rtt.srtt
+        yield "trebla_rtt_p99_seconds", GAUGE, "99th percentile round trip", labels, pipeline.rtt.percentile(99)
+    return collect
+
+
+def ring_metrics(ring, **labels):
+    """ Collector of a SampleRing.
+    """
+    def collect():
+        yield "trebla_samples_total", COUNTER, "Samples stored", labels, ring.total
+        yield "trebla_buffer_fill_ratio", GAUGE, "Fill of the sample buffer", labels, len(ring) / float(ring.capacity)
+    return collect
+
+
+def subscriber_metrics(subscriber, **labels):
+    """ Collector of a SensorSubscriber, its client and its channels.
+    """
+    client_collect = client_metrics(subscriber.client, **labels)
+
+    def collect():
+        for sample in client_collect():
+            yield sample
+        for channel in list(subscriber.channels.values()):
+            channel_labels = dict(labels, channel=channel.name)
+            yield "trebla_parse_failures_total", COUNTER, "Malformed replies", channel_labels, channel.malformed
+            yield "trebla_sample_jitter_seconds", GAUGE, "Jitter of the sample interval", channel_labels, channel.timing.jitter
+            yield "trebla_sample_gaps_total", COUNTER, "Breaks in the sample stream", channel_labels, channel.timing.gaps
+            window = channel.stats.window() if channel.stats is not None else None
+            if window is not None and window.count:
+                for axis, (rms, peak) in enumerate(zip(window.rms.tolist(), window.peak_to_peak.tolist())):
+                    axis_labels = dict(channel_labels, axis=str(axis))
+                    yield "trebla_sample_rms", GAUGE, "RMS of the last samples", axis_labels, rms
+                    yield "trebla_sample_peak_to_peak", GAUGE, "Peak to peak of the last samples", axis_labels, peak
+            if channel.history is not None:
+                for sample in ring_metrics(channel.history, **channel_labels)():
+                    yield sample
+    return collect
+
+
+def fleet_metrics(collector, **labels):
+    """ Collector of a FleetCollector and the subscribers of its devices.
+    """
+    def collect():
+        yield "trebla_consumer_queue_depth", GAUGE, "Batches waiting for the consumer", labels, len(collector.queue)
+        for device in list(collector.devices.values()):
+            device_labels = dict(labels, device=device.id)
+            yield "trebla_dropped_samples_total", COUNTER, "Samples dropped", dict(device_labels, stage="queue"), device.stats.dropped
+            if device.subscriber is not None:
+                for sample in subscriber_metrics(device.subscriber, **device_labels)():
+                    yield sample
+    return collect
+
+
+def recorder_metrics(recorder, **labels):
+    """ Collector of a SessionRecorder.
+    """
+    def collect():
+        yield "trebla_recorded_samples_total", COUNTER, "Samples written", labels, recorder.samples
+        yield "trebla_recorder_queue_depth", GAUGE, "Batches waiting to be written", labels, recorder.pending()
+        yield "trebla_dropped_samples_total", COUNTER, "Samples dropped", dict(labels, stage="recorder"), recorder.dropped
+    return collect
+
+
+def bridge_metrics(bridge, **labels):
+    """ Collector of a ClientBridge: events waiting for the GUI.
+    """
+    def collect():
+        yield "trebla_consumer_queue_depth", GAUGE, "Events waiting for the consumer", labels, len(bridge.events)
+    return collect
+
+
+def renderer_metrics(renderer, **labels):
+    """ Collector of a render.BlitRenderer.
+    """
+    def collect():
+        yield "trebla_frame_seconds", GAUGE, "Render time of a frame", labels, renderer.frame_time
+        yield "trebla_full_draws_total", COUNTER, "Frames drawn in full", labels, renderer.full_draws
+        yield "trebla_blits_total", COUNTER, "Frames blitted", labels, renderer.blits
+    return collect
+
+
+class MetricsServer(object):
+    """ Serves registry.render() on http://host:port/metrics from a
+        background thread, port 0 picks a free port.
+    """
+    def __init__(self, registry, port=9464, host="127.0.0.1"):
+        self.registry = registry
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(handler):
+                if handler.path.split("?")[0] not in ("/", "/metrics"):
+                    handler.send_error(404)
+                    return
+                body = registry.render().encode("utf-8")
+                handler.send_response(200)
+                handler.send_header("Content-Type", CONTENT_TYPE)
+                handler.send_header("Content-Length", str(len(body)))
+                handler.end_headers()
+                handler.wfile.write(body)
+
+            def log_message(handler, format, *args):
+                log.debug("%s " + format, handler.address_string(), *args)
+
+        self._server = http.server.ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        self.port = self._server.server_address[1]
+        self._thread = threading.Thread(target=self._server.serve_forever, name="trebla-metrics")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+class LogReporter(object):
+    """ Logs registry.summary() every interval seconds from a background
+        thread.
+    """
+    def __init__(self, registry, interval=10.0, logger=log, level=logging.INFO):
+        self.registry = registry
+        self.interval = interval
+        self.logger = logger
+        self.level = level
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="trebla-metrics-log")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.logger.log(self.level, "%s", self.registry.summary())
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+
+
+class RateLimitedLog(object):
+    """ Logs each message (format string) at most once every interval
+        seconds, with the count of the ones left out since. Disabled
+        levels cost one check.
+
+        bad_reply = RateLimitedLog(log, 5.0)
+        bad_reply.warning("failure to get acc data: %s", line)
+    """
+    def __init__(self, logger, interval=5.0):
+        self.logger = logger
+        self.interval = interval
+        # format -> (time of the last message, messages left out)
+        self._last = {}
+
+    def log(self, level, msg, *args):
+        if not self.logger.isEnabledFor(level):
+            return
+        now = time.monotonic()
+        last, suppressed = self._last.get(msg, (None, 0))
+        if last is not None and now - last < self.interval:
+            self._last[msg] = (last, suppressed + 1)
+            return
+        self._last[msg] = (now, 0)
+        if suppressed:
+            self.logger.log(level, msg + " (%d more in %.1f s)", *(args + (suppressed, now - last)))
+        else:
+            self.logger.log(level, msg, *args)
+
+    def debug(self, msg, *args):
+        self.log(logging.DEBUG, msg, *args)
+
+    def info(self, msg, *args):
+        self.log(logging.INFO, msg, *args)
+
+    def warning(self, msg, *args):
+        self.log(logging.WARNING, msg, *args)
+
+    def error(self, msg, *args):
+        self.log(logging.ERROR, msg, *args)
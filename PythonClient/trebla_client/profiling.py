@@ -0,0 +1,212 @@
+"""
+Profiling of a running client, switched on and off without restarting.
+
+The hot paths time their stages with the module-wide `profiler`:
+
+    started = profiler.start()
+    ...
+    profiler.stop("decode", started)
+
+start() returns None while no session runs and stop() then returns at
+once, so the stages cost two calls per chunk of replies when off.
+
+A session (profiler.toggle(), SIGUSR1 with install_signal(), Ctrl-P in
+the clients) lasts at most `duration` seconds, then writes to
+`directory`, named after its start time:
+
+  - profile-<time>-stages.txt: calls, wall and CPU time of every stage
+    (read includes the wait for data, it is the idle time of the loop),
+  - profile-<time>-<thread>.prof with cprofile=True: cProfile stats of
+    every thread that went through a stage, for pstats or snakeviz,
+  - profile-<time>-tracemalloc.txt with tracemalloc=True: the lines that
+    allocated the most memory during the session.
+"""
+import cProfile
+import logging
+import os
+import re
+import signal
+import threading
+import time
+import tracemalloc as _tracemalloc
+
+log = logging.getLogger(__name__)
+
+STAGES = ("read", "framing", "decode", "filter", "fusion", "buffer", "spectrum", "draw")
+
+
+class StageStats(object):
+    def __init__(self):
+        self.calls = 0
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.max_wall = 0.0
+
+
+class Profiler(object):
+    """ Times the stages of the hot paths during a session, see the
+        module. on_finished(paths) is called with the files written at
+        the end of each session, from the thread that ended it.
+    """
+    def __init__(self):
+        self.active = False
+        self.directory = None
+        self.stages = {}
+        self._lock = threading.Lock()
+        self._started_at = None
+        self._ends_at = None
+        self._name = None
+        self._cprofile = False
+        # thread ident -> (thread name, cProfile.Profile), a profile can
+        # only be stopped by its thread: after the session the others are
+        # pending and written the next time their thread calls start()
+        self._profiles = {}
+        self._pending = {}
+        self._snapshot = None
+        # tracemalloc was started by the session, not already tracing
+        self._tracing = False
+        self._timer = None
+        self.on_finished = None
+
+    def start(self):
+        """ Returns the start of a stage, None when not profiling.
+        """
+        if not self.active:
+            if self._pending:
+                self._dump_pending()
+            return None
+        if self._cprofile and threading.get_ident() not in self._profiles:
+            self._profile_thread()
+        return time.perf_counter(), time.thread_time()
+
+    def stop(self, stage, started):
+        if started is None:
+            return
+        wall = time.perf_counter() - started[0]
+        cpu = time.thread_time() - started[1]
+        with self._lock:
+            stats = self.stages.get(stage)
+            if stats is None:
+                stats = self.stages[stage] = StageStats()
+            stats.calls += 1
+            stats.wall += wall
+            stats.cpu += cpu
+            stats.max_wall = max(stats.max_wall, wall)
+        if started[0] >= self._ends_at:
+            self.finish()
+
+    def begin(self, duration=30.0, directory=".", cprofile=False, tracemalloc=False):
+        """ Starts a session of at most duration seconds.
+        """
+        with self._lock:
+            if self.active:
+                return
+            self.stages = {}
+            self.directory = directory
+            self._name = "profile-" + time.strftime("%Y%m%d-%H%M%S")
+            self._cprofile = cprofile
+            self._profiles = {}
+            self._started_at = time.perf_counter()
+            self._ends_at = self._started_at + duration
+            if tracemalloc:
+                self._tracing = not _tracemalloc.is_tracing()
+                if self._tracing:
+                    _tracemalloc.start(10)
+                self._snapshot = _tracemalloc.take_snapshot()
+            self.active = True
+        # ends the session even if no stage runs any more
+        self._timer = threading.Timer(duration, self.finish)
+        self._timer.daemon = True
+        self._timer.start()
+        log.info("profiling for %.0f s", duration)
+
+    def toggle(self, **kwargs):
+        # starts a session with begin(**kwargs), or ends the running one
+        if self.active:
+            self.finish()
+        else:
+            self.begin(**kwargs)
+
+    def _profile_thread(self):
+        profile = cProfile.Profile()
+        with self._lock:
+            if not self.active:
+                return
+            self._profiles[threading.get_ident()] = (threading.current_thread().name, profile)
+        profile.enable()
+
+    def finish(self):
+        """ Ends the session and writes its files, returns their paths.
+        """
+        with self._lock:
+            if not self.active:
+                return []
+            self.active = False
+            elapsed = time.perf_counter() - self._started_at
+            snapshot, self._snapshot = self._snapshot, None
+            tracing, self._tracing = self._tracing, False
+        if self._timer is not None:
+            self._timer.cancel()
+        os.makedirs(self.directory, exist_ok=True)
+        base = os.path.join(self.directory, self._name)
+        paths = [base + "-stages.txt"]
+        with open(paths[0], "w") as f:
+            f.write(self.report(elapsed))
+        if snapshot is not None:
+            paths.append(base + "-tracemalloc.txt")
+            top = _tracemalloc.take_snapshot().compare_to(snapshot, "lineno")
+            if tracing:
+                _tracemalloc.stop()
+            with open(paths[-1], "w") as f:
+                f.write("allocated during %.1f s, by line\n" % elapsed)
+                for stat in top[:50]:
+                    f.write("%s\n" % stat)
+        with self._lock:
+            for ident, (name, profile) in self._profiles.items():
+                self._pending[ident] = (name, profile, base)
+            self._profiles = {}
+        if threading.get_ident() in self._pending:
+            paths.append(self._dump_pending())
+        log.info("profile written to %s", ", ".join(paths))
+        if self.on_finished is not None:
+            self.on_finished(paths)
+        return paths
+
+    def _dump_pending(self):
+        with self._lock:
+            pending = self._pending.pop(threading.get_ident(), None)
+        if pending is None:
+            return None
+        name, profile, base = pending
+        profile.disable()
+        path = "%s-%s.prof" % (base, re.sub(r"[^\w.-]", "_", name))
+        profile.dump_stats(path)
+        log.info("profile of %s written to %s", name, path)
+        return path
+
+    def report(self, elapsed=None):
+        """ The stage table as text.
+        """
+        elapsed = elapsed or (time.perf_counter() - self._started_at)
+        lines = ["%-10s %10s %12s %12s %12s %7s" % ("stage", "calls", "wall ms", "cpu ms", "max ms", "wall %")]
+        names = [s for s in STAGES if s in self.stages] + sorted(s for s in self.stages if s not in STAGES)
+        for name in names:
+            s = self.stages[name]
+            lines.append("%-10s %10d %12.1f %12.1f %12.2f %6.1f%%" % (
+                name, s.calls, s.wall * 1000, s.cpu * 1000, s.max_wall * 1000, 100 * s.wall / elapsed))
+        lines.append("over %.1f s" % elapsed)
+        return "\n".join(lines) + "\n"
+
+
+profiler = Profiler()
+
+
+def install_signal(signum=None, **kwargs):
+    """ Toggles a session with profiler.toggle(**kwargs) on a signal,
+        SIGUSR1 by default (not on Windows).
+    """
+    def handler(number, frame):
+        # not in the handler: it may have interrupted the profiler itself
+        threading.Thread(target=profiler.toggle, kwargs=kwargs, name="trebla-profiler").start()
+    signum = signal.SIGUSR1 if signum is None else signum
+    signal.signal(signum, handler)
@@ -0,0 +1,255 @@
+"""
+Session recording.
+
+A session is a directory with one file per channel (acc, gyro, battery,
+ext_gyro...). A file is a 64 byte header, with the channel name of at
+most NAME_SIZE bytes, followed by fixed width rows of float64: the
+timestamp then the `width` values of one sample. Rows are only ever
+appended, in chunks, so a file cut short by a crash loses at most its
+last partial row, and a reader maps the file and gets NumPy views of the
+timestamps and the values without parsing anything.
+
+The receive path only queues the batches, a background thread writes
+them. It also keeps the count, mean, std, min and max of every channel
+(stats.RunningStats) in summary.json, rewritten at every flush, so a
+session can be described without reading it; recording again into the
+same directory merges into it.
+"""
+import glob
+import json
+import logging
+import os
+import queue
+import re
+import struct
+import threading
+import time
+
+import numpy as np
+
+from trebla_client.stats import RunningStats
+
+log = logging.getLogger(__name__)
+
+MAGIC = b"TRBLREC\0"
+VERSION = 1
+# bytes of UTF-8 the header holds of the channel name
+NAME_SIZE = 40
+# magic, version, width, creation time, channel name
+HEADER = struct.Struct("<8sIId%ds" % NAME_SIZE)
+HEADER_SIZE = 64
+EXTENSION = ".trec"
+SUMMARY = "summary.json"
+
+
+def row_dtype(width):
+    return np.dtype([("t", np.float64), ("v", np.float64, (width,))])
+
+
+def check_channel(channel):
+    # the whole name goes in the header, open_session() keys on it
+    size = len(channel.encode("utf-8"))
+    if size > NAME_SIZE:
+        raise ValueError("channel name %s is %d bytes long, recordings hold %d" % (channel, size, NAME_SIZE))
+
+
+class SessionRecorder(object):
+    """ Records channels into `directory`.
+
+        record() may be called from any thread and never blocks: when the
+        writer falls more than queue_size batches behind, batches are
+        dropped and counted in `dropped`, as are the samples of a channel
+        that cannot be written (e.g. its width changed).
+    """
+    def __init__(self, directory, queue_size=10000, flush_interval=1.0):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.flush_interval = flush_interval
+        self.samples = 0
+        self.dropped = 0
+        self._queue = queue.Queue(queue_size)
+        self._files = {}
+        # names that passed check_channel()
+        self._channels = set()
+        # channels whose write failed, logged once
+        self._failed = set()
+        # channel -> RunningStats, only updated by the writer thread
+        self.stats = dict((channel, RunningStats.from_summary(summary))
+                          for channel, summary in read_summary(directory).items())
+        self._summary_changed = False
+        self._thread = threading.Thread(target=self._run, name="trebla-recorder")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def record(self, channel, times, values):
+        """ Queues samples of a channel, values is (n, width) and times a
+            scalar or n timestamps. A channel name longer than NAME_SIZE
+            bytes of UTF-8 raises ValueError.
+        """
+        if channel not in self._channels:
+            check_channel(channel)
+            self._channels.add(channel)
+        values = np.array(values, dtype=np.float64, ndmin=2)
+        times = np.broadcast_to(np.asarray(times, dtype=np.float64), (len(values),))
+        try:
+            # copies: the caller may reuse its buffers
+            self._queue.put_nowait((channel, times.copy(), values))
+        except queue.Full:
+            self.dropped += len(values)
+
+    def pending(self):
+        # batches queued and not written yet
+        return self._queue.qsize()
+
+    def record_batch(self, batch):
+        # fleet.SampleBatch, one file per device and channel
+        self.record("%s.%s" % (batch.device, batch.channel), batch.times, batch.values)
+
+    def _run(self):
+        last_flush = time.time()
+        while True:
+            try:
+                items = [self._queue.get(timeout=self.flush_interval)]
+            except queue.Empty:
+                items = []
+            # whatever else is waiting goes in the same write
+            while True:
+                try:
+                    items.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            closing = None in items
+            try:
+                self._write([item for item in items if item is not None])
+                if closing or time.time() - last_flush >= self.flush_interval:
+                    for f in self._files.values():
+                        f.flush()
+                    if self._summary_changed:
+                        self._write_summary()
+                    last_flush = time.time()
+            except (OSError, ValueError) as e:
+                log.error("recording to %s failed: %s", self.directory, e)
+            if closing:
+                for f in self._files.values():
+                    f.close()
+                return
+
+    def _write(self, items):
+        chunks = {}
+        for channel, times, values in items:
+            chunks.setdefault(channel, []).append((times, values))
+        for channel, parts in chunks.items():
+            # a channel that fails loses its rows, not the others'
+            try:
+                width = parts[0][1].shape[1]
+                rows = np.empty(sum(len(t) for t, v in parts), dtype=row_dtype(width))
+                start = 0
+                for times, values in parts:
+                    rows["t"][start:start + len(times)] = times
+                    rows["v"][start:start + len(times)] = values
+                    start += len(times)
+                self._file(channel, width).write(rows.tobytes())
+            except (OSError, ValueError) as e:
+                self.dropped += sum(len(t) for t, v in parts)
+                if channel not in self._failed:
+                    self._failed.add(channel)
+                    log.error("recording %s to %s failed: %s", channel, self.directory, e)
+                continue
+            self.samples += len(rows)
+            stats = self.stats.get(channel)
+            if stats is None or stats.width != width:
+                stats = self.stats[channel] = RunningStats(width)
+            stats.update(rows["v"])
+            self._summary_changed = True
+
+    def _write_summary(self):
+        # replaced in one step, a crash leaves the previous one
+        path = os.path.join(self.directory, SUMMARY)
+        with open(path + ".tmp", "w") as f:
+            json.dump(dict((channel, stats.summary()) for channel, stats in self.stats.items()), f, indent=1)
+        os.replace(path + ".tmp", path)
+        self._summary_changed = False
+
+    def _file(self, channel, width):
+        f = self._files.get(channel)
+        if f is None:
+            path = os.path.join(self.directory, re.sub(r"[^\w.-]", "_", channel) + EXTENSION)
+            if os.path.exists(path):
+                # appending to an existing recording
+                if read_header(path)["width"] != width:
+                    raise ValueError("%s holds %d values per sample, not %d" % (path, read_header(path)["width"], width))
+                f = open(path, "r+b")
+                # after the last complete row, a partial one would shift all the next ones
+                itemsize = row_dtype(width).itemsize
+                f.seek(HEADER_SIZE + (os.path.getsize(path) - HEADER_SIZE) // itemsize * itemsize)
+                f.truncate()
+            else:
+                f = open(path, "wb")
+                f.write(HEADER.pack(MAGIC, VERSION, width, time.time(), channel.encode("utf-8")).ljust(HEADER_SIZE, b"\0"))
+            self._files[channel] = f
+        return f
+
+    def close(self):
+        """ Writes what is queued and closes the files.
+        """
+        self._queue.put(None)
+        self._thread.join()
+
+
+def read_header(path):
+    with open(path, "rb") as f:
+        data = f.read(HEADER_SIZE)
+    if len(data) < HEADER_SIZE or data[:8] != MAGIC:
+        raise ValueError("%s is not a session recording" % path)
+    magic, version, width, created, channel = HEADER.unpack(data[:HEADER.size])
+    if version != VERSION:
+        raise ValueError("%s: unsupported version %d" % (path, version))
+    return {"width": width, "created": created, "channel": channel.rstrip(b"\0").decode("utf-8")}
+
+
+def read_summary(directory):
+    """ {channel: RunningStats.summary()} of a session directory, empty
+        if it has no summary.
+    """
+    path = os.path.join(directory, SUMMARY)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+class Recording(object):
+    """ One recorded channel, memory mapped: times (n,) and values
+        (n, width) are read-only views into the file.
+    """
+    def __init__(self, path):
+        self.path = path
+        header = read_header(path)
+        self.channel = header["channel"]
+        self.width = header["width"]
+        self.created = header["created"]
+        dtype = row_dtype(self.width)
+        # a row being written when the recorder stopped is ignored
+        count = (os.path.getsize(path) - HEADER_SIZE) // dtype.itemsize
+        if count:
+            self.rows = np.memmap(path, dtype=dtype, mode="r", offset=HEADER_SIZE, shape=(count,))
+        else:
+            self.rows = np.zeros(0, dtype=dtype)
+        self.times = self.rows["t"]
+        self.values = self.rows["v"]
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __repr__(self):
+        return "<Recording %s %d x %d>" % (self.channel, len(self), self.width)
+
+
+def open_session(directory):
+    """ Returns {channel: Recording} of a session directory.
+    """
+    recordings = {}
+    for path in sorted(glob.glob(os.path.join(directory, "*" + EXTENSION))):
+        recording = Recording(path)
+        recordings[recording.channel] = recording
+    return recordings
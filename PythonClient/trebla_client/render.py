@@ -0,0 +1,69 @@
+"""
+Blitted rendering for matplotlib canvases.
+
+A full canvas.draw() lays out and rasterizes the axes, ticks, labels and
+grid every frame although only the data lines move. BlitRenderer draws
+all of that once, keeps the rendered background and per frame only
+restores it, draws the line artists on top and blits the result. The
+full redraw only happens when the caller says the layout changed (new
+bounds, grid toggled...) or when the canvas redraws itself (resize).
+"""
+import time
+
+
+class BlitRenderer(object):
+    """ Renders `artists` of canvas.figure by blitting.
+
+        frame_time is the smoothed time a frame takes (seconds),
+        last_frame_time the time of the last one, full_draws and blits
+        count both kinds of frames.
+    """
+    def __init__(self, canvas, artists):
+        self.canvas = canvas
+        self.figure = canvas.figure
+        self.artists = list(artists)
+        for artist in self.artists:
+            # left out of canvas.draw(), they are drawn over the background
+            artist.set_animated(True)
+        self.background = None
+        self.frame_time = 0.0
+        self.last_frame_time = 0.0
+        self.full_draws = 0
+        self.blits = 0
+        self._cid = canvas.mpl_connect("draw_event", self._on_draw)
+
+    def invalidate(self):
+        # the next frame is a full redraw
+        self.background = None
+
+    def draw(self, layout_changed=False):
+        """ Renders one frame, with layout_changed the axes are laid out
+            and rasterized again first.
+        """
+        start = time.perf_counter()
+        if layout_changed or self.background is None:
+            # _on_draw takes the new background and draws the artists
+            self.canvas.draw()
+        else:
+            self.canvas.restore_region(self.background)
+            self._draw_artists()
+            self.blits += 1
+        self.canvas.blit(self.figure.bbox)
+        self.last_frame_time = time.perf_counter() - start
+        self.frame_time += 0.1 * (self.last_frame_time - self.frame_time)
+
+    def _on_draw(self, event):
+        # any full draw, ours or the canvas' own on resize, renders the
+        # figure without the animated artists: that is the background
+        self.background = self.canvas.copy_from_bbox(self.figure.bbox)
+        self._draw_artists()
+        self.full_draws += 1
+
+    def _draw_artists(self):
+        for artist in self.artists:
+            self.figure.draw_artist(artist)
+
+    def close(self):
+        self.canvas.mpl_disconnect(self._cid)
+        for artist in self.artists:
+            artist.set_animated(False)
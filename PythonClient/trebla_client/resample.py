@@ -0,0 +1,287 @@
+"""
+Resampling of irregularly timed samples onto a uniform grid.
+
+Samples are timestamped at the midpoint of their request (see timing),
+their intervals follow the polling and the round trips, not the sensor.
+Spectra and filters want samples at fixed intervals: UniformResampler
+interpolates linearly onto the times k / rate, k integer, so that the
+streams resampled at the same rate share the same grid.
+
+    resampler = UniformResampler(100, 3)
+    times, values = resampler.update(batch_times, batch_values)
+
+StreamAligner joins several streams resampled on the same grid, row by
+row, e.g. the acc, gyro and mfield of a phone for sensor fusion.
+ChannelJoin does it on the live buffers of channels (SampleRing), pulled
+whenever convenient, align_chunks() over recordings, a chunk at a time:
+
+    join = ChannelJoin([("gyro", gyro), ("ext_gyro", ext), ("battery", battery)], 100,
+                       methods={"battery": "previous"}, max_gap={"battery": None})
+    times, values = join.pull()             # values[:, join.columns["ext_gyro"]]
+
+    for times, values in align_chunks(open_session("sessions/run1"), 100):
+        ...
+
+A stream is interpolated linearly ("linear") or takes the value of its
+last sample at or before each grid point ("previous", an as-of join),
+for values that hold until the next one such as the battery state.
+"""
+import math
+
+import numpy as np
+
+
+def merge_equal_times(times, values):
+    """ Averages the samples that share a timestamp (requests sent and
+        answered in the same chunks), times must be sorted.
+    """
+    if len(times) < 2 or np.all(times[1:] > times[:-1]):
+        return times, values
+    unique, inverse, counts = np.unique(times, return_inverse=True, return_counts=True)
+    sums = np.zeros((len(unique), values.shape[1]))
+    np.add.at(sums, inverse, values)
+    return unique, sums / counts[:, None]
+
+
+def interpolate(xp, fp, x):
+    """ np.interp of every column of fp (n, width) at once, x within
+        xp[0], xp[-1].
+    """
+    index = np.clip(np.searchsorted(xp, x, side="right"), 1, len(xp) - 1)
+    x0 = xp[index - 1]
+    weight = (x - x0) / (xp[index] - x0)
+    return fp[index - 1] + weight[:, None] * (fp[index] - fp[index - 1])
+
+
+def asof(xp, fp, x):
+    """ fp (n, width) of the last xp at or before each x, x from xp[0]
+        on: the values that hold at x.
+    """
+    return fp[np.searchsorted(xp, x, side="right") - 1]
+
+
+# how the grid values are taken from the samples around them
+METHODS = {
+    "linear": interpolate,
+    "previous": asof,
+}
+
+
+def _per_stream(setting, names, default=None):
+    # one value for all the streams, or a dict by name or a list
+    if isinstance(setting, dict):
+        return [setting.get(name, default) for name in names]
+    if isinstance(setting, (list, tuple)):
+        return list(setting)
+    return [setting] * len(names)
+
+
+class UniformResampler(object):
+    """ Linear interpolation (or the as-of value with method "previous")
+        of a stream of (n, width) batches onto the times k / rate.
+
+        The samples of the last timestamp are held back until a later
+        one arrives, as more samples may share it, so the output lags by
+        one sample. No grid point is made inside an interval longer than
+        max_gap seconds (None to interpolate over anything), the grid
+        resumes after it and `gaps` counts them.
+    """
+    def __init__(self, rate, width, max_gap=None, method="linear"):
+        if method not in METHODS:
+            raise ValueError("unknown method %s, choose from %s" % (method, ", ".join(sorted(METHODS))))
+        self.rate = float(rate)
+        self.width = width
+        self.max_gap = max_gap
+        self.method = method
+        self.gaps = 0
+        # index k of the next grid point, None before the first sample
+        self._next = None
+        # the last sample interpolated from, then the held back ones
+        self._times = np.zeros(0)
+        self._values = np.zeros((0, width))
+
+    def reset(self):
+        self._next = None
+        self._times = np.zeros(0)
+        self._values = np.zeros((0, self.width))
+
+    def update(self, times, values):
+        """ Adds samples later than the previous ones, returns the grid
+            (times, values) they complete.
+        """
+        values = np.asarray(values, dtype=np.float64).reshape(-1, self.width)
+        times = np.asarray(times, dtype=np.float64)
+        if len(times) and len(self._times):
+            keep = times >= self._times[-1]
+            times, values = times[keep], values[keep]
+        times = np.concatenate((self._times, times))
+        values = np.concatenate((self._values, values))
+        if not len(times):
+            return times, values
+        held = np.searchsorted(times, times[-1])
+        # the samples of the last timestamp wait for the next batch
+        held_times, held_values = times[held:], values[held:]
+        times, values = merge_equal_times(times[:held], values[:held])
+        self._times = np.concatenate((times[-1:], held_times))
+        self._values = np.concatenate((values[-1:], held_values))
+        if not len(times):
+            return times, values
+        if self._next is None:
+            self._next = int(math.ceil(times[0] * self.rate))
+        last = int(math.floor(times[-1] * self.rate))
+        if last < self._next:
+            return np.zeros(0), np.zeros((0, self.width))
+        grid = np.arange(self._next, last + 1) / self.rate
+        self._next = last + 1
+        if len(times) == 1:
+            return grid, np.repeat(values, len(grid), axis=0)
+        if self.max_gap is not None:
+            index = np.clip(np.searchsorted(times, grid, side="right"), 1, len(times) - 1)
+            inside = ((times[index] - times[index - 1] <= self.max_gap)
+                      | (grid == times[index - 1]) | (grid == times[index]))
+            if not inside.all():
+                self.gaps += int(np.count_nonzero(np.diff(np.concatenate(([True], inside)).astype(np.int8)) == -1))
+                grid = grid[inside]
+        return grid, METHODS[self.method](times, values, grid)
+
+
+class StreamAligner(object):
+    """ Joins several streams on the grid k / rate: each is resampled by
+        its own UniformResampler, update() returns the grid points that
+        all of them have reached, as (times, (n, sum of widths) values),
+        the columns of the streams in the order of `widths`.
+
+        A grid point one stream has no value for (a break longer than
+        max_gap) is left out. methods and max_gap are one for all the
+        streams or a list of one per stream.
+    """
+    def __init__(self, widths, rate, max_gap=None, methods="linear"):
+        self.widths = list(widths)
+        self.rate = float(rate)
+        self.resamplers = [UniformResampler(rate, width, gap, method) for width, gap, method
+                           in zip(self.widths, _per_stream(max_gap, self.widths), _per_stream(methods, self.widths))]
+        # per stream, grid indices and values resampled and not joined yet
+        self._indices = [np.zeros(0, dtype=np.int64) for _ in self.widths]
+        self._values = [np.zeros((0, width)) for width in self.widths]
+
+    def update(self, stream, times, values):
+        """ Adds samples of stream number `stream`, returns the new joined
+            rows.
+        """
+        grid, resampled = self.resamplers[stream].update(times, values)
+        if len(grid):
+            self._indices[stream] = np.concatenate((self._indices[stream], np.round(grid * self.rate).astype(np.int64)))
+            self._values[stream] = np.concatenate((self._values[stream], resampled))
+        if any(not len(indices) for indices in self._indices):
+            return np.zeros(0), np.zeros((0, sum(self.widths)))
+        # up to where every stream has been resampled
+        last = min(indices[-1] for indices in self._indices)
+        done = [int(np.searchsorted(indices, last, side="right")) for indices in self._indices]
+        first = max(indices[0] for indices in self._indices)
+        if all(indices[0] + n - 1 == last for indices, n in zip(self._indices, done)):
+            # no break in any stream: the same contiguous indices from first
+            common = np.arange(first, last + 1)
+            columns = [values[n - len(common):n] for values, n in zip(self._values, done)]
+        else:
+            common = self._indices[0][:done[0]]
+            for indices, n in zip(self._indices[1:], done[1:]):
+                common = common[np.isin(common, indices[:n], assume_unique=True)]
+            columns = [values[:n][np.isin(indices[:n], common, assume_unique=True)]
+                       for indices, values, n in zip(self._indices, self._values, done)]
+        for i, n in enumerate(done):
+            self._indices[i] = self._indices[i][n:]
+            self._values[i] = self._values[i][n:]
+        return common / self.rate, np.concatenate(columns, axis=1)
+
+
+class ChannelJoin(object):
+    """ StreamAligner over the live buffers of channels: sources are
+        (name, SampleRing or channels.Channel) pairs, pull() takes what
+        each got since the last pull (SampleRing.since()) and returns the
+        new joined rows. columns[name] is the slice of the columns of a
+        source.
+
+        methods and max_gap are one for all the sources or a dict by
+        name, the sources not in it interpolate linearly over any gap. A
+        Channel whose width comes with its first reply joins once it
+        has one, until then pull() returns nothing.
+    """
+    def __init__(self, sources, rate, methods="linear", max_gap=None):
+        self.sources = list(sources.items() if isinstance(sources, dict) else sources)
+        self.names = [name for name, source in self.sources]
+        self.rate = float(rate)
+        self.methods = _per_stream(methods, self.names, "linear")
+        self.max_gap = _per_stream(max_gap, self.names)
+        self.aligner = None
+        self.columns = {}
+        self._seqs = [0] * len(self.sources)
+
+    def _ring(self, source):
+        # a SampleRing, or the history of a Channel
+        return getattr(source, "history", source)
+
+    def pull(self):
+        if self.aligner is None:
+            rings = [self._ring(source) for name, source in self.sources]
+            if any(ring is None for ring in rings):
+                return np.zeros(0), np.zeros((0, 0))
+            widths = [ring.channels for ring in rings]
+            self.aligner = StreamAligner(widths, self.rate, self.max_gap, self.methods)
+            bounds = np.cumsum([0] + widths).tolist()
+            self.columns = dict((name, slice(bounds[i], bounds[i + 1])) for i, name in enumerate(self.names))
+        times, rows = [], []
+        for i, (name, source) in enumerate(self.sources):
+            self._seqs[i], new_times, new_values = self._ring(source).since(self._seqs[i])
+            if len(new_times):
+                joined_times, joined = self.aligner.update(i, new_times, new_values)
+                if len(joined_times):
+                    times.append(joined_times)
+                    rows.append(joined)
+        if not times:
+            return np.zeros(0), np.zeros((0, sum(self.aligner.widths)))
+        return np.concatenate(times), np.concatenate(rows)
+
+
+def align_chunks(sources, rate, methods="linear", max_gap=None, chunk=60.0, start=None, stop=None):
+    """ Joins recorded streams on the grid k / rate, `chunk` seconds of
+        the recordings at a time: yields (times, (n, sum of widths)
+        values) per chunk, so that a long session never has to be
+        resampled in memory at once.
+
+        sources are recorder.Recording (open_session()) or (times, values)
+        by name, in a dict or as (name, source) pairs, the columns follow
+        their order. methods and max_gap as for ChannelJoin, start and
+        stop limit the time range.
+    """
+    sources = list(sources.items() if isinstance(sources, dict) else sources)
+    streams = []
+    for name, source in sources:
+        times, values = (source.times, source.values) if hasattr(source, "times") else source
+        streams.append((np.asarray(times), values.reshape(len(times), -1)))
+    names = [name for name, source in sources]
+    aligner = StreamAligner([values.shape[1] for times, values in streams], rate,
+                            _per_stream(max_gap, names), _per_stream(methods, names, "linear"))
+    nonempty = [times for times, values in streams if len(times)]
+    if not nonempty:
+        return
+    begin = min(times[0] for times in nonempty) if start is None else start
+    end = max(times[-1] for times in nonempty) if stop is None else stop
+    # index of the next sample of each stream
+    positions = [int(np.searchsorted(times, begin)) for times, values in streams]
+    while begin <= end:
+        limit = min(begin + chunk, end)
+        times, rows = [], []
+        for i, (stream_times, values) in enumerate(streams):
+            # the chunk includes limit, the next one starts after it
+            upto = int(np.searchsorted(stream_times, limit, side="right"))
+            if upto > positions[i]:
+                joined_times, joined = aligner.update(i, stream_times[positions[i]:upto], values[positions[i]:upto])
+                positions[i] = upto
+                if len(joined_times):
+                    times.append(joined_times)
+                    rows.append(joined)
+        if times:
+            yield np.concatenate(times), np.concatenate(rows)
+        if limit >= end:
+            break
+        begin = limit
@@ -0,0 +1,96 @@
+"""
+Fixed capacity sample history.
+
+Samples are written twice, at i and i + capacity, in a buffer of twice
+the capacity. That way the most recent n samples are always one
+contiguous slice and can be handed to matplotlib or NumPy as a view,
+without copying and without ever reallocating.
+"""
+import numpy as np
+
+
+class SampleRing(object):
+    """ Last `capacity` samples of `channels` values each, with timestamps.
+
+        There is one writer (the receiving thread). Readers get views into
+        the live buffer, a view taken while the writer wraps around may see
+        the newest samples, which is fine for plotting, use copy() to keep
+        the values.
+    """
+    def __init__(self, capacity, channels, dtype=np.float64):
+        self.capacity = capacity
+        self.channels = channels
+        self._values = np.zeros((2 * capacity, channels), dtype=dtype)
+        self._times = np.zeros(2 * capacity, dtype=np.float64)
+        # number of samples ever appended, sample k is stored at
+        # k % capacity, it is only increased once the samples are written
+        self.total = 0
+
+    def __len__(self):
+        return min(self.total, self.capacity)
+
+    def append(self, values, t=0.0):
+        head = self.total % self.capacity
+        self._values[head] = values
+        self._values[head + self.capacity] = values
+        self._times[head] = t
+        self._times[head + self.capacity] = t
+        self.total += 1
+
+    def extend(self, values, times=0.0):
+        """ Appends a (n, channels) batch, times is a scalar or n timestamps.
+        """
+        values = np.asarray(values, dtype=self._values.dtype).reshape(-1, self.channels)
+        n = len(values)
+        if n == 0:
+            return
+        times = np.broadcast_to(np.asarray(times, dtype=np.float64), (n,))
+        total = self.total + n
+        if n > self.capacity:
+            # only the last capacity samples survive anyway
+            values = values[-self.capacity:]
+            times = times[-self.capacity:]
+            n = self.capacity
+
+        head = (total - n) % self.capacity
+        first = min(n, self.capacity - head)
+        for start, stop, src in ((head, head + first, slice(0, first)),
+                                 (0, n - first, slice(first, n))):
+            if stop > start:
+                self._values[start:stop] = values[src]
+                self._values[start + self.capacity:stop + self.capacity] = values[src]
+                self._times[start:stop] = times[src]
+                self._times[start + self.capacity:stop + self.capacity] = times[src]
+        self.total = total
+
+    def last(self, n=None):
+        """ Returns (times, values) views of the n most recent samples,
+            oldest first.
+        """
+        total = self.total
+        count = min(total, self.capacity)
+        n = count if n is None else min(n, count)
+        stop = total % self.capacity + self.capacity
+        return self._times[stop - n:stop], self._values[stop - n:stop]
+
+    def since(self, seq):
+        """ Returns (total, times, values) with copies of the samples
+            appended after the first `seq` ones, pass the returned total
+            as seq next time. Samples already overwritten are skipped.
+        """
+        total = self.total
+        start = max(seq, total - self.capacity)
+        offset = start % self.capacity
+        stop = offset + total - start
+        return total, self._times[offset:stop].copy(), self._values[offset:stop].copy()
+
+    def channel(self, index, n=None):
+        # view of one channel of the n most recent samples
+        return self.last(n)[1][:, index]
+
+    def copy(self, n=None):
+        times, values = self.last(n)
+        return times.copy(), values.copy()
+
+    def clear(self):
+        self.total = 0
@@ -0,0 +1,211 @@
+"""
+Adaptive polling of the channels of a SensorSubscriber.
+
+    subscriber.subscribe("acc", rate=100, priority=2)
+    subscriber.subscribe("battery", rate=1)
+    scheduler = AdaptiveScheduler(subscriber)
+    scheduler.start()
+
+The server answers in order, so every request in flight delays the
+replies behind it, and a slow one (battery state, usb -l) delays all of
+them. Every `interval` the scheduler measures, per channel, the rate
+achieved, the round trip of the replies and how many replies were new
+values, then:
+
+  - sizes the window on the round trip: it grows while the channels are
+    short of their target and the round trip stays near its minimum,
+    and shrinks by a quarter as soon as requests start queueing (round
+    trip above `congestion` times the minimum), like TCP Vegas;
+  - slows down a channel that is polled faster than the phone updates
+    it (the listener is registered with SENSOR_DELAY_NORMAL, repeated
+    replies are the same sample) to 1.5 times its update rate, and
+    probes back up towards the target while the replies are all new;
+  - shares the window by priority, each channel getting the depth its
+    rate needs over one round trip (Little's law) and at least one, the
+    channels without a rate share what is left. A slow channel at 1 Hz
+    never has more than one request ahead of the others.
+
+It runs on the event loop of the client.
+"""
+import asyncio
+import logging
+import math
+
+from trebla_client.timing import clock
+
+log = logging.getLogger(__name__)
+
+
+class ChannelSchedule(object):
+    """ What the scheduler measured and decided for one channel.
+    """
+    def __init__(self, channel):
+        self.name = channel.name
+        self.poll = channel.poll
+        # rate the channel is polled at, None for as fast as the depth allows
+        self.rate = channel.rate
+        self.depth = None
+        self.achieved = 0.0
+        self.fresh_rate = 0.0
+        self.rtt = None
+        self._mark = None
+
+    def __repr__(self):
+        return "<ChannelSchedule %s rate %s depth %s achieved %.1f/s>" % (self.name, self.rate, self.depth, self.achieved)
+
+
+class AdaptiveScheduler(object):
+    """ Adapts the pipeline window of the client of `subscriber` and the
+        rate and depth of each of its channels, see the module.
+    """
+    def __init__(self, subscriber, interval=0.5, min_window=2, max_window=32, congestion=1.5,
+                 min_rate=2.0, min_samples=8):
+        self.subscriber = subscriber
+        self.pipeline = subscriber.client.pipeline
+        self.interval = interval
+        self.min_window = min_window
+        self.max_window = max_window
+        self.congestion = congestion
+        self.min_rate = min_rate
+        # replies needed before judging the freshness of a channel
+        self.min_samples = min_samples
+        self.rtt = None
+        self.base_rtt = None
+        self.schedules = {}
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.ensure_future(self.run())
+        return self
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                self.adjust()
+            except Exception:
+                log.exception("scheduling failed")
+
+    def adjust(self, now=None):
+        """ One step: measure since the last one and reassign rates, depths
+            and the window.
+        """
+        now = clock() if now is None else now
+        channels = [c for c in self.subscriber.channels.values() if c.poll is not None]
+        for name in set(self.schedules) - set(c.name for c in channels):
+            del self.schedules[name]
+        replies = rtt_total = 0
+        for channel in channels:
+            schedule = self.schedules.get(channel.name)
+            if schedule is None or schedule.poll is not channel.poll:
+                # new, or subscribed again with another rate
+                schedule = self.schedules[channel.name] = ChannelSchedule(channel)
+            replies += self._measure(schedule, channel, now)
+            rtt_total += schedule._rtt_total
+        if replies:
+            rtt = rtt_total / replies
+            self.rtt = rtt if self.rtt is None else 0.7 * self.rtt + 0.3 * rtt
+            # the minimum is slowly forgotten, the link may have changed
+            self.base_rtt = rtt if self.base_rtt is None else min(self.base_rtt * 1.02, rtt)
+            self._size_window(channels)
+        self._share_window(channels)
+
+    def _measure(self, schedule, channel, now):
+        # returns the replies since the last measure, their round trips
+        # are left in schedule._rtt_total
+        mark = (now, channel.replies, channel.rtt_total, channel.received, channel.fresh)
+        schedule._rtt_total = 0.0
+        if schedule._mark is None:
+            schedule._mark = mark
+            return 0
+        elapsed = now - schedule._mark[0]
+        replies = channel.replies - schedule._mark[1]
+        received = channel.received - schedule._mark[3]
+        if elapsed <= 0 or received < self.min_samples:
+            # too few to tell, slow channels are judged over longer periods
+            return 0
+        fresh = channel.fresh - schedule._mark[4]
+        schedule._rtt_total = channel.rtt_total - schedule._mark[2]
+        schedule.rtt = schedule._rtt_total / replies
+        schedule.achieved = received / elapsed
+        schedule.fresh_rate = fresh / elapsed
+        schedule._mark = mark
+
+        if fresh < received / 2:
+            # mostly repeated samples: the phone updates slower than we ask
+            rate = max(self.min_rate, 1.5 * schedule.fresh_rate)
+            if schedule.rate is None or rate < schedule.rate:
+                schedule.rate = rate
+        elif fresh > 0.9 * received and schedule.rate != channel.rate:
+            # all new: the sensor may have sped up, probe towards the target
+            rate = 1.25 * schedule.rate
+            if channel.rate is not None:
+                rate = min(rate, channel.rate)
+            elif rate > 2 * schedule.achieved:
+                # as fast as the depth allows is no faster
+                rate = None
+            schedule.rate = rate
+        if channel.rate is not None:
+            schedule.rate = min(schedule.rate, channel.rate)
+        return replies
+
+    def _size_window(self, channels):
+        window = self.pipeline.window
+        if self.rtt > self.congestion * self.base_rtt + 0.002:
+            # replies queue up behind each other, less in flight gets the
+            # same rate with shorter delays
+            window = max(self.min_window, window * 3 // 4)
+        elif any(self._short(c) for c in channels):
+            window = min(self.max_window, window + 1)
+        if window != self.pipeline.window:
+            log.debug("%s: window %d -> %d, rtt %.1f ms (min %.1f ms)", self.subscriber.client,
+                      self.pipeline.window, window, 1000 * self.rtt, 1000 * self.base_rtt)
+            self.pipeline.window = window
+
+    def _short(self, channel):
+        # a channel that would use more of the window, once measured
+        schedule = self.schedules[channel.name]
+        if schedule.rtt is None:
+            return False
+        return schedule.rate is None or schedule.achieved < 0.9 * schedule.rate
+
+    def _share_window(self, channels):
+        # by priority, the paced channels get the depth their rate needs
+        # and the others one, then what is left goes to the others
+        channels = sorted(channels, key=lambda c: -c.priority)
+        budget = self.pipeline.window
+        for i, channel in enumerate(channels):
+            schedule = self.schedules[channel.name]
+            # one request in flight is kept for each of the channels after
+            reserve = len(channels) - i - 1
+            depth = 1
+            if schedule.rate is not None:
+                rtt = schedule.rtt if schedule.rtt is not None else (self.rtt or 0.0)
+                # a quarter more for the jitter of the round trip
+                depth = min(int(math.ceil(1.25 * schedule.rate * rtt)), budget - reserve)
+            schedule.depth = max(1, depth)
+            budget -= schedule.depth
+        # evenly, the remainder one each in order of priority
+        unrated = [self.schedules[c.name] for c in channels if self.schedules[c.name].rate is None]
+        if unrated and budget > 0:
+            share, remainder = divmod(budget, len(unrated))
+            for i, schedule in enumerate(unrated):
+                schedule.depth += share + (1 if i < remainder else 0)
+        for channel in channels:
+            schedule = self.schedules[channel.name]
+            channel.poll.depth = schedule.depth
+            channel.poll.set_rate(schedule.rate)
+
+    def stats(self):
+        """ {channel: (rate, depth, achieved rate, round trip)}, plus the
+            window under "window".
+        """
+        stats = dict((name, (s.rate, s.depth, s.achieved, s.rtt)) for name, s in self.schedules.items())
+        stats["window"] = self.pipeline.window
+        return stats
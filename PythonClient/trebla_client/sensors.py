@@ -0,0 +1,75 @@
+"""
+What the phone can be polled for, see TreblaService.processMessage and
+InternalSensorListener.readSensorValues.
+"""
+import numpy as np
+
+# sensor name -> number of values in the "[a, b, c]" reply, None when it
+# depends on the phone: the rotation vector has 3 to 5 values depending
+# on the Android version
+SENSOR_WIDTHS = {
+    "acc": 3,
+    "gyro": 3,
+    "mfield": 3,
+    "rotation": None,
+    "temp": 1,
+    "pressure": 1,
+    "light": 1,
+    "proximity": 1,
+    "rh": 1,
+}
+
+# "battery state" replies [voltage, temperature, charge]
+BATTERY_WIDTH = 3
+
+# on the external board, not polled with "sensor" but read from what
+# "usb -r" forwards (see trebla_client.usbgyro)
+EXTERNAL_WIDTHS = {
+    "ext_gyro": 3,
+}
+
+# polls per second a collector asks for by default, the others as fast as
+# the window allows: the battery state and the slow environment sensors
+# change far less often than the phone answers
+POLL_RATES = {
+    "battery": 1.0,
+    "temp": 1.0,
+    "rh": 1.0,
+    "pressure": 10.0,
+    "light": 10.0,
+    "proximity": 10.0,
+}
+
+# the motion sensors get their share of the window first
+POLL_PRIORITIES = {
+    "acc": 1,
+    "gyro": 1,
+    "mfield": 1,
+    "rotation": 1,
+    "ext_gyro": 1,
+}
+
+
+def command(channel):
+    """ Returns the command polling a channel, "acc" -> "sensor acc".
+    """
+    if channel == "battery":
+        return "battery state"
+    return "sensor " + channel
+
+
+def width(channel):
+    if channel == "battery":
+        return BATTERY_WIDTH
+    if channel in EXTERNAL_WIDTHS:
+        return EXTERNAL_WIDTHS[channel]
+    return SENSOR_WIDTHS[channel]
+
+
+def dtype(channel):
+    """ Type the channel is stored as: the sensors are Java floats, which
+        float32 holds exactly in half the memory, the battery state ints.
+    """
+    if channel == "battery":
+        return np.int32
+    return np.float32
@@ -0,0 +1,76 @@
+"""
+SampleRing in shared memory, to hand samples to another process.
+
+The receiving process appends, the plotting process calls since() once
+per frame and gets every new sample in one copy: no pickling, no queue
+per axis and nothing that grows when the reader is slow, samples older
+than the capacity are simply skipped.
+
+The ring must be passed to the other process when it is created, as an
+argument of multiprocessing.Process, like any multiprocessing shared
+object.
+"""
+import ctypes
+import multiprocessing.sharedctypes as sharedctypes
+
+import numpy as np
+
+from trebla_client.ringbuffer import SampleRing
+
+
+class SharedSampleRing(SampleRing):
+    """ Single writer, any number of readers in other processes.
+    """
+    def __init__(self, capacity, channels):
+        self._raw_values = sharedctypes.RawArray(ctypes.c_double, 2 * capacity * channels)
+        self._raw_times = sharedctypes.RawArray(ctypes.c_double, 2 * capacity)
+        # number of samples published and number of samples being written,
+        # the writer bumps _raw_reserved before touching the buffer and
+        # total once it is done
+        self._raw_total = sharedctypes.RawValue(ctypes.c_uint64, 0)
+        self._raw_reserved = sharedctypes.RawValue(ctypes.c_uint64, 0)
+        self._attach(capacity, channels)
+
+    def _attach(self, capacity, channels):
+        self.capacity = capacity
+        self.channels = channels
+        self._values = np.ctypeslib.as_array(self._raw_values).reshape(2 * capacity, channels)
+        self._times = np.ctypeslib.as_array(self._raw_times)
+
+    def __getstate__(self):
+        return (self.capacity, self.channels, self._raw_values, self._raw_times,
+                self._raw_total, self._raw_reserved)
+
+    def __setstate__(self, state):
+        capacity, channels, self._raw_values, self._raw_times, self._raw_total, self._raw_reserved = state
+        self._attach(capacity, channels)
+
+    @property
+    def total(self):
+        return self._raw_total.value
+
+    @total.setter
+    def total(self, value):
+        self._raw_total.value = value
+
+    def append(self, values, t=0.0):
+        self._raw_reserved.value = self.total + 1
+        SampleRing.append(self, values, t)
+
+    def extend(self, values, times=0.0):
+        self._raw_reserved.value = self.total + np.size(values) // self.channels
+        SampleRing.extend(self, values, times)
+
+    def clear(self):
+        self._raw_reserved.value = 0
+        self.total = 0
+
+    def since(self, seq):
+        total, times, values = SampleRing.since(self, seq)
+        # the writer may have wrapped around while we were copying, drop
+        # whatever it could have overwritten
+        overwritten = self._raw_reserved.value - self.capacity - max(seq, total - self.capacity)
+        if overwritten > 0:
+            times = times[overwritten:]
+            values = values[overwritten:]
+        return total, times, values
@@ -0,0 +1,116 @@
+"""
+Rolling spectra of sample streams, for vibration analysis.
+
+RollingSpectrum resamples a channel onto a uniform grid (see resample),
+cuts it in frames of `size` samples every `hop` samples and keeps the
+power spectral density of every frame: the spectrogram. psd() averages
+the last frames (Welch's method). Only the frames completed by the new
+samples are transformed, all of them in one rfft call, the overlap is
+kept from one batch to the next.
+
+It reads the sample buffers, not the replies: pull() takes what a
+SampleRing got since the last call, so it runs on the thread that shows
+the spectra and the receive path does not wait for any FFT.
+
+    spectrum = RollingSpectrum(100, 3)
+    spectrum.pull(channel.history)          # e.g. every GUI frame
+    freqs, psd = spectrum.freqs, spectrum.psd()
+"""
+import numpy as np
+
+from trebla_client.resample import UniformResampler
+from trebla_client.ringbuffer import SampleRing
+
+
+class RollingSpectrum(object):
+    """ Spectrogram of a stream of `width` values per sample, resampled at
+        `rate` Hz, with Hann windowed frames of `size` samples every `hop`
+        (size / 4 by default). The last `frames` spectra are kept.
+
+        A break longer than max_gap seconds restarts the frames after it,
+        `gaps` counts them. The mean of each frame is removed (gravity),
+        the PSD is one-sided, in units squared per Hz.
+    """
+    def __init__(self, rate, width, size=256, hop=None, frames=256, average=8, max_gap=0.5):
+        self.rate = float(rate)
+        self.width = width
+        self.size = size
+        self.hop = hop or size // 4
+        self.average = average
+        self.resampler = UniformResampler(rate, width, max_gap)
+        self.freqs = np.fft.rfftfreq(size, 1.0 / self.rate)
+        self.window = np.hanning(size)
+        # density scaling, the energy of the negative frequencies is
+        # folded onto the positive ones
+        self._scale = np.full(len(self.freqs), 2.0 / (self.rate * (self.window ** 2).sum()))
+        self._scale[0] /= 2
+        if size % 2 == 0:
+            self._scale[-1] /= 2
+        # one row per frame, timestamped at its center
+        self.history = SampleRing(frames, len(self.freqs) * width, np.float32)
+        self.gaps = 0
+        # resampled samples not yet in a frame, or the overlap with the next
+        self._buffer = np.zeros((0, width))
+        self._start = None
+        self._seq = 0
+
+    def pull(self, ring):
+        """ Adds the samples `ring` (a SampleRing) got since the last pull,
+            returns the number of new frames.
+        """
+        self._seq, times, values = ring.since(self._seq)
+        return self.update(times, values)
+
+    def update(self, times, values):
+        """ Adds samples (times, (n, width) values), returns the number of
+            new frames.
+        """
+        gaps = self.resampler.gaps
+        times, values = self.resampler.update(times, values)
+        if not len(times):
+            return 0
+        expected = self._start + len(self._buffer) / self.rate if self._start is not None else None
+        if expected is None or self.resampler.gaps != gaps or abs(times[0] - expected) > 0.5 / self.rate:
+            if expected is not None:
+                self.gaps += 1
+            # a break, the frames start again after it
+            self._buffer = values
+            self._start = times[0]
+        else:
+            self._buffer = np.concatenate((self._buffer, values))
+        if len(self._buffer) < self.size:
+            return 0
+        count = (len(self._buffer) - self.size) // self.hop + 1
+        # (count, width, size) views of the buffer, nothing copied yet
+        frames = np.lib.stride_tricks.sliding_window_view(self._buffer, self.size, axis=0)[::self.hop][:count]
+        frames = frames - frames.mean(axis=2, keepdims=True)
+        spectra = np.fft.rfft(frames * self.window, axis=2)
+        power = (spectra.real ** 2 + spectra.imag ** 2) * self._scale
+        centers = self._start + (np.arange(count) * self.hop + (self.size - 1) / 2.0) / self.rate
+        self.history.extend(power.transpose(0, 2, 1).reshape(count, -1), centers)
+        self._buffer = self._buffer[count * self.hop:]
+        self._start += count * self.hop / self.rate
+        return count
+
+    def spectrogram(self, n=None):
+        """ (times, power) of the last n frames, power (n, bins, width) is a
+            view, see SampleRing.last().
+        """
+        times, power = self.history.last(n)
+        return times, power.reshape(len(power), len(self.freqs), self.width)
+
+    def psd(self, n=None):
+        """ Mean PSD (bins, width) of the last n frames (`average` by
+            default), None before the first frame.
+        """
+        times, power = self.spectrogram(n or self.average)
+        if not len(power):
+            return None
+        return power.mean(axis=0, dtype=np.float64)
+
+    def dominant(self):
+        # frequency of the highest peak of each value, DC left out
+        psd = self.psd()
+        if psd is None:
+            return None
+        return self.freqs[1 + psd[1:].argmax(axis=0)]
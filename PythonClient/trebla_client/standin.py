@@ -0,0 +1,440 @@
+"""
+Stand-in for the phone: a local server speaking the line protocol of
+SocketServerService and TreblaService.processMessage.
+
+It serves synthetic signals, or replays a recorded session (see
+trebla_client.recorder) at 1x, Nx or full speed, to any number of
+clients at once, optionally behind artificial latency and jitter. Every
+connection gets its own service state, like a fresh binding of
+TreblaService on the phone: "sensor start" is needed again after a
+reconnection.
+
+    python -m trebla_client.standin --port 8888 --rate 100 --latency 0.02 --jitter 0.01
+    python -m trebla_client.standin --replay sessions/flight1 --speed 4
+    python -m trebla_client.standin --replay sessions/fleet1 --device ph2
+"""
+import argparse
+import asyncio
+import logging
+import math
+import random
+import re
+import time
+
+import numpy as np
+
+from trebla_client import sensors, usbgyro
+from trebla_client.core import DEFAULT_PORT
+
+log = logging.getLogger(__name__)
+
+# same split as Command.java: the command, flags, then the argument
+COMMAND_PATTERN = re.compile(r"^(\S+)(?:\s+-.+?)?\s*?([^\s-]+)?$")
+FLAG_PATTERN = re.compile(r"-{1,2}([^\s=]+)(?:=([^\"\s]+|\"[^\"]+\"))?")
+
+
+def format_values(values):
+    # like java.util.Arrays.toString
+    return "[" + ", ".join(repr(float(v)) for v in values) + "]"
+
+
+class SyntheticSource(object):
+    """ Sensor values that change `rate` times per second: a slow motion
+        around gravity plus gaussian noise of `noise` standard deviation.
+    """
+    def __init__(self, rate=100.0, noise=0.05, seed=None):
+        self.rate = rate
+        self.noise = noise
+        self.random = np.random.default_rng(seed)
+        self._cache = {}
+
+    def read(self, channel, now):
+        # the phone keeps the last value of each sensor until the next event
+        tick = math.floor(now * self.rate)
+        cached = self._cache.get(channel)
+        if cached is not None and cached[0] == tick:
+            return cached[1]
+        t = tick / self.rate
+        signal = self.signal(channel, t)
+        values = signal + self.random.normal(0.0, self.noise, len(signal))
+        self._cache[channel] = (tick, values)
+        return values
+
+    def signal(self, channel, t):
+        phase = 2 * math.pi * 0.5 * t
+        if channel == "acc":
+            return np.array([math.sin(phase), math.cos(phase), 9.81])
+        if channel == "gyro":
+            return np.array([0.5 * math.cos(phase), -0.5 * math.sin(phase), 0.0])
+        if channel == "mfield":
+            return np.array([22.0 * math.cos(phase), 5.0, -40.0])
+        if channel == "rotation":
+            # x, y, z and the scalar part, as from Android 4.3 on
+            return np.array([0.0, 0.0, math.sin(phase / 2), math.cos(phase / 2)])
+        if channel == "battery":
+            return np.array([4.0, 30.0, 85.0])
+        return np.array([{"temp": 22.0, "pressure": 1013.25, "light": 300.0,
+                          "proximity": 5.0, "rh": 40.0}[channel]])
+
+    def usb_gyro(self, now):
+        # raw int16 rates of the L3G4200D on the external board
+        t = math.floor(now * self.rate) / self.rate
+        return np.round(2000 * np.array([math.sin(t), math.cos(t), 0.0])
+                        + self.random.normal(0.0, self.noise * 100, 3)).astype(int)
+
+
+# what the polls and "usb -r" can be answered with
+REPLAYABLE = set(sensors.SENSOR_WIDTHS) | set(sensors.EXTERNAL_WIDTHS) | {"battery"}
+
+
+def replayable(recordings, device=None):
+    """ Returns (device, {channel: recording}) of the channels of one
+        device a stand-in can serve. A client records "acc", collect
+        "<device>.acc" (the id may have dots itself); without `device`
+        the first device in order is taken.
+    """
+    devices = {}
+    for name, recording in recordings.items():
+        prefix, _, channel = name.rpartition(".")
+        if channel in REPLAYABLE and len(recording):
+            devices.setdefault(prefix or None, {})[channel] = recording
+    if device is None and devices:
+        device = sorted(devices, key=lambda d: d or "")[0]
+        if len(devices) > 1:
+            log.info("replaying device %s of %s", device, ", ".join(sorted(d or "-" for d in devices)))
+    return device, devices.get(device, {})
+
+
+class ReplaySource(object):
+    """ Replays a recorded session, `speed` times faster than real time,
+        or one new sample per read with speed 0 (as fast as polled).
+        Loops at the end of the recording. The recorded ext_gyro (deg/s)
+        goes back to counts of usb_scale deg/s full scale. A session
+        collected from several phones replays one, `device`, see
+        replayable().
+    """
+    def __init__(self, directory, speed=1.0, usb_scale=usbgyro.DEFAULT_FULL_SCALE, device=None):
+        from trebla_client.recorder import open_session
+        self.device, self.recordings = replayable(open_session(directory), device)
+        if not self.recordings:
+            raise ValueError("no sensor of %s recorded in %s" % (device or "any device", directory))
+        self.speed = speed
+        self.usb_scale = usbgyro.SCALES[usb_scale]
+        self.start = min(rec.times[0] for rec in self.recordings.values())
+        self.duration = max(rec.times[-1] for rec in self.recordings.values()) - self.start
+        self.started_at = time.time()
+        self._next = {}
+
+    def read(self, channel, now):
+        recording = self.recordings.get(channel)
+        if recording is None:
+            return None
+        if self.speed:
+            elapsed = ((now - self.started_at) * self.speed) % (self.duration or 1.0)
+            index = max(0, np.searchsorted(recording.times, self.start + elapsed, "right") - 1)
+        else:
+            index = self._next.get(channel, 0) % len(recording)
+            self._next[channel] = index + 1
+        return recording.values[index]
+
+    def usb_gyro(self, now):
+        values = self.read("ext_gyro", now)
+        if values is None:
+            return None
+        return np.clip(np.round(values / self.usb_scale), usbgyro.INT16_MIN, usbgyro.INT16_MAX).astype(int)
+
+
+class Service(object):
+    """ State of TreblaService for one connection.
+    """
+    def __init__(self, server, push):
+        self.server = server
+        self.push = push
+        self.sensor_started = False
+        self.battery_started = False
+        self.usb_connected = False
+        self.usb_task = None
+        # sent by the device, not read by the phone yet
+        self.usb_buffer = bytearray()
+        self.usb_sent = asyncio.Event()
+
+    def process(self, msg):
+        match = COMMAND_PATTERN.match(msg)
+        if match is None:
+            return "unrecognised command"
+        command, argument = match.group(1), match.group(2) or ""
+        flags = set(m.group(1) for m in FLAG_PATTERN.finditer(msg))
+        source = self.server.source
+        now = time.time()
+
+        if command == "sensor":
+            if argument == "start":
+                self.sensor_started = True
+                return "internal sensor listener started"
+            if not self.sensor_started:
+                return "internal sensor listener not started"
+            if argument == "stop":
+                self.sensor_started = False
+                return "internal sensor listener stopped"
+            if argument == "":
+                return "no sensor type specified"
+            if argument not in sensors.SENSOR_WIDTHS:
+                return "null"
+            values = source.read(argument, now)
+            return "null" if values is None else format_values(values)
+        if command == "battery":
+            if argument == "start" and not self.battery_started:
+                self.battery_started = True
+                return "battery listener started"
+            if not self.battery_started:
+                return "battery listener not started"
+            if argument == "stop":
+                self.battery_started = False
+                return "battery listener stopped"
+            if argument == "state":
+                values = source.read("battery", now)
+                return "null" if values is None else "[" + ", ".join(str(int(round(v))) for v in values) + "]"
+            return "no argument specified"
+        if command == "usb":
+            return self.usb(argument, flags, msg)
+        if command in ("picture", "image", "photo", "gps"):
+            return "not implemented yet"
+        return "unrecognised command"
+
+    def usb(self, argument, flags, msg):
+        if not self.server.usb:
+            if flags & {"l", "list"}:
+                return "no usb devices found"
+            if flags & {"w", "write"} and argument:
+                return "Transferred bytes: no usb device selected"
+            return "Trying to establish connection" if argument == "connect" and not flags else ""
+        if flags & {"l", "list"}:
+            return "Name: /dev/bus/usb/001/002"
+        if flags & {"r", "read"}:
+            # toggles the listening thread, the reply is empty on the phone too
+            if self.usb_task is not None:
+                self.usb_task.cancel()
+                self.usb_task = None
+                self.usb_buffer = bytearray()
+            else:
+                self.usb_task = asyncio.ensure_future(self.usb_reader())
+            return ""
+        if flags & {"w", "write"} and argument:
+            # the whole rest of the line is sent to the device
+            data = msg.split(None, 2)[-1]
+            if self.usb_task is not None:
+                # the sketch answers every 'g' with a reading, forwarded
+                # after the write has been acknowledged
+                for i in range(data.count("g")):
+                    self.usb_reading()
+            return "Transferred bytes: %d" % len(data.encode("utf-8"))
+        if argument == "connect":
+            self.usb_connected = True
+            return "Trying to establish connection"
+        return ""
+
+    def usb_send(self, values):
+        # what the sketch prints, no new line
+        self.usb_buffer += ("[%d,%d,%d]" % tuple(int(v) for v in values)).encode("ascii")
+        self.usb_sent.set()
+
+    async def usb_reader(self):
+        # the reading thread of the phone: what the device sent since the
+        # last read, forwarded in packets of usb_packet bytes, one line
+        # each, wherever that cuts the readings
+        streaming = asyncio.ensure_future(self.usb_streamer()) if self.server.usb_rate else None
+        try:
+            while True:
+                await self.usb_sent.wait()
+                await asyncio.sleep(self.server.usb_interval)
+                self.usb_sent.clear()
+                data, self.usb_buffer = bytes(self.usb_buffer), bytearray()
+                packet = self.server.usb_packet
+                for i in range(0, len(data), packet):
+                    self.push(data[i:i + packet].decode("ascii"))
+        finally:
+            if streaming is not None:
+                streaming.cancel()
+
+    async def usb_streamer(self):
+        # with usb_rate the device sends readings on its own, otherwise it
+        # only answers to "usb -w g"
+        while True:
+            await asyncio.sleep(1.0 / self.server.usb_rate)
+            self.usb_reading()
+
+    def usb_reading(self):
+        values = self.server.source.usb_gyro(time.time())
+        if values is not None:
+            self.usb_send(values)
+
+    def close(self):
+        if self.usb_task is not None:
+            self.usb_task.cancel()
+            self.usb_task = None
+
+
+class StandInServer(object):
+    """ Serves `source` (SyntheticSource or ReplaySource).
+
+        Replies are delayed by latency plus a uniform random jitter, in
+        order, like behind a slow WiFi link. With usb the external board
+        is simulated: every 'g' written with "usb -w" gets a "[x,y,z]"
+        reading, with usb_rate the board also streams readings by itself.
+        After "usb -r" what it sends is forwarded every usb_interval
+        seconds in lines of at most usb_packet bytes, like the reading
+        thread of the phone: readings come glued together or cut in two.
+    """
+    def __init__(self, source, host="127.0.0.1", port=DEFAULT_PORT, latency=0.0, jitter=0.0,
+                 usb=True, usb_rate=0.0, usb_packet=64, usb_interval=0.001):
+        self.source = source
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.jitter = jitter
+        self.usb = usb
+        self.usb_rate = usb_rate
+        self.usb_packet = usb_packet
+        self.usb_interval = usb_interval
+        self.connections = 0
+        self.commands = 0
+        self._server = None
+        # the tasks running handle(), one per connection
+        self._handlers = set()
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._accept, self.host, self.port)
+        # port 0 picks a free one
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self
+
+    async def serve_forever(self):
+        if self._server is None:
+            await self.start()
+        try:
+            await self._server.serve_forever()
+        finally:
+            await self.close()
+
+    async def close(self):
+        # Server.close() leaves the connections to their handlers
+        self._server.close()
+        handlers = list(self._handlers)
+        for task in handlers:
+            task.cancel()
+        await asyncio.gather(*handlers, return_exceptions=True)
+        await self._server.wait_closed()
+
+    def _accept(self, reader, writer):
+        # the handler tasks are ours, not start_server's, for close() to
+        # cancel and await them
+        task = asyncio.ensure_future(self.handle(reader, writer))
+        self._handlers.add(task)
+        task.add_done_callback(self._handler_done)
+
+    def _handler_done(self, task):
+        self._handlers.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            log.error("connection handler failed", exc_info=task.exception())
+
+    async def handle(self, reader, writer):
+        self.connections += 1
+        peer = writer.get_extra_info("peername")
+        log.info("client %s connected", peer)
+        outgoing = asyncio.Queue()
+        sender = asyncio.ensure_future(self.send(outgoing, writer))
+        service = Service(self, lambda line: outgoing.put_nowait((0.0, line)))
+        try:
+            try:
+                while True:
+                    msg = await reader.readline()
+                    msg = msg.decode("utf-8", "replace").rstrip("\r\n")
+                    # same end of session as SocketServerService
+                    if not msg or msg in ("close", "exit", "quit"):
+                        break
+                    self.commands += 1
+                    delay = self.latency + random.uniform(0.0, self.jitter) if self.latency or self.jitter else 0.0
+                    outgoing.put_nowait((time.time() + delay, service.process(msg)))
+            except (ConnectionError, asyncio.IncompleteReadError):
+                pass
+            service.close()
+            # the replies still due go out first
+            outgoing.put_nowait(None)
+            await sender
+        finally:
+            # also when the server is shutting down (CancelledError),
+            # which goes on up once the connection is cleaned up
+            service.close()
+            if not sender.done():
+                sender.cancel()
+                try:
+                    await sender
+                except asyncio.CancelledError:
+                    pass
+            writer.close()
+            log.info("client %s disconnected", peer)
+
+    async def send(self, outgoing, writer):
+        # replies leave in order, each no earlier than its due time, and
+        # whatever is due at once goes out in one write
+        due_at = 0.0
+        try:
+            while True:
+                item = await outgoing.get()
+                if item is None:
+                    break
+                lines = []
+                while item is not None:
+                    due_at = max(due_at, item[0])
+                    if due_at > time.time():
+                        if lines:
+                            writer.write("".join(lines).encode("utf-8"))
+                            lines = []
+                        await asyncio.sleep(due_at - time.time())
+                    lines.append(item[1] + "\n")
+                    item = outgoing.get_nowait() if not outgoing.empty() else None
+                writer.write("".join(lines).encode("utf-8"))
+                await writer.drain()
+        except ConnectionError:
+            pass
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Stand-in Trebla server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--rate", type=float, default=100.0, help="sensor update rate (Hz)")
+    parser.add_argument("--noise", type=float, default=0.05, help="noise standard deviation")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--replay", metavar="SESSION", help="replay a recorded session directory")
+    parser.add_argument("--speed", type=float, default=1.0, help="replay speed, 0 for as fast as polled")
+    parser.add_argument("--device", help="device of a collected session to replay, the first by default")
+    parser.add_argument("--latency", type=float, default=0.0, help="reply delay (s)")
+    parser.add_argument("--jitter", type=float, default=0.0, help="random extra reply delay (s)")
+    parser.add_argument("--no-usb", dest="usb", action="store_false", help="no external board")
+    parser.add_argument("--usb-rate", type=float, default=0.0, help="readings per second after usb -r")
+    parser.add_argument("--usb-packet", type=int, default=64, help="bytes per forwarded usb line")
+    parser.add_argument("--usb-interval", type=float, default=0.001, help="usb read interval (s)")
+    parser.add_argument("--usb-scale", type=int, default=250, choices=(250, 500, 2000),
+                        help="full scale (deg/s) of the replayed ext_gyro")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    if args.replay:
+        try:
+            source = ReplaySource(args.replay, args.speed, args.usb_scale, args.device)
+        except ValueError as e:
+            parser.error(str(e))
+    else:
+        source = SyntheticSource(args.rate, args.noise, args.seed)
+    server = StandInServer(source, args.host, args.port, args.latency, args.jitter, args.usb, args.usb_rate,
+                           args.usb_packet, args.usb_interval)
+    log.info("serving on %s:%d", args.host, args.port)
+    try:
+        asyncio.run(server.serve_forever())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,214 @@
+"""
+Streaming statistics of sample streams, updated per batch.
+
+RunningStats keeps count, mean, variance (Welford, batches merged with
+Chan's formula), min and max of everything seen. WindowStats keeps mean,
+variance, RMS, min, max and peak to peak of the last `window` samples:
+running sums corrected by the samples leaving the window, and min/max
+from monotonic deques, so a batch costs its own size whatever the
+window. StreamStats groups one RunningStats and several windows.
+
+The results are arrays of one value per channel, replaced (not modified)
+after every batch: another thread can read them without a lock.
+"""
+import collections
+
+import numpy as np
+
+from trebla_client.ringbuffer import SampleRing
+
+
+class RunningStats(object):
+    def __init__(self, width):
+        self.width = width
+        self.count = 0
+        self.mean = np.zeros(width)
+        self._m2 = np.zeros(width)
+        self.min = np.full(width, np.inf)
+        self.max = np.full(width, -np.inf)
+
+    def update(self, values):
+        """ Adds a batch, (n, width) or (width,).
+        """
+        values = np.asarray(values, dtype=np.float64).reshape(-1, self.width)
+        if not len(values):
+            return
+        # a NaN or an infinity makes the mean and variance NaN, quietly
+        with np.errstate(invalid="ignore"):
+            mean = values.mean(axis=0)
+            self.merge(len(values), mean, ((values - mean) ** 2).sum(axis=0))
+        # min and max of the finite values, fmin and fmax leave NaN out
+        finite = np.where(np.isfinite(values), values, np.nan)
+        self.min = np.fmin(self.min, np.fmin.reduce(finite, axis=0))
+        self.max = np.fmax(self.max, np.fmax.reduce(finite, axis=0))
+
+    def merge(self, count, mean, m2):
+        # adds `count` samples of that mean and sum of squared deviations
+        total = self.count + count
+        delta = mean - self.mean
+        self._m2 = self._m2 + m2 + delta ** 2 * (self.count * count / float(total))
+        self.mean = self.mean + delta * (count / float(total))
+        self.count = total
+
+    @property
+    def variance(self):
+        return self._m2 / self.count if self.count else np.full(self.width, np.nan)
+
+    @property
+    def std(self):
+        return np.sqrt(self.variance)
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "mean": self.mean.tolist(),
+            "std": self.std.tolist(),
+            "min": self.min.tolist(),
+            "max": self.max.tolist(),
+        }
+
+    @classmethod
+    def from_summary(cls, summary):
+        stats = cls(len(summary["mean"]))
+        if summary["count"]:
+            stats.merge(summary["count"], np.array(summary["mean"]),
+                        np.array(summary["std"]) ** 2 * summary["count"])
+            stats.min = np.array(summary["min"], dtype=np.float64)
+            stats.max = np.array(summary["max"], dtype=np.float64)
+        return stats
+
+
+def candidates(values):
+    """ Mask of the finite values above all the later ones of their
+        column: only those can ever be the maximum of a window ending
+        after the batch. NaN and infinities ("NaN", "Infinity" from the
+        phone) never are.
+    """
+    finite = np.isfinite(values)
+    values = np.where(finite, values, -np.inf)
+    after = np.empty_like(values)
+    after[-1] = -np.inf
+    after[:-1] = np.maximum.accumulate(values[:0:-1], axis=0)[::-1]
+    return (values > after) & finite
+
+
+class MonotonicDeques(object):
+    """ Maximum of the last `window` values of each channel: a deque per
+        channel holds (index, value) with decreasing values, the maximum
+        is its first one. Each value enters and leaves a deque at most
+        once, and the candidates() mask keeps most of a batch out of the
+        Python part. The maximum is NaN while the window holds no finite
+        value.
+    """
+    def __init__(self, width, window):
+        self.window = window
+        self.deques = [collections.deque() for _ in range(width)]
+
+    def extend(self, values, start):
+        # values (n, width) are the samples start, start + 1...
+        if len(values) > self.window:
+            start += len(values) - self.window
+            values = values[-self.window:]
+        columns, rows = np.nonzero(candidates(values).T)
+        kept = values[rows, columns].tolist()
+        rows = (rows + start).tolist()
+        bounds = np.searchsorted(columns, np.arange(len(self.deques) + 1)).tolist()
+        oldest = start + len(values) - self.window
+        maxima = []
+        for c, items in enumerate(self.deques):
+            lo, hi = bounds[c], bounds[c + 1]
+            if lo < hi:
+                first = kept[lo]
+                while items and items[-1][1] <= first:
+                    items.pop()
+                items.extend(zip(rows[lo:hi], kept[lo:hi]))
+            # a column without any finite value in the batch only ages
+            while items and items[0][0] < oldest:
+                items.popleft()
+            maxima.append(items[0][1] if items else np.nan)
+        return np.array(maxima, dtype=np.float64)
+
+
+class WindowStats(object):
+    def __init__(self, width, window):
+        self.width = width
+        self.window = window
+        self.total = 0
+        self._ring = SampleRing(window, width)
+        self._sum = np.zeros(width)
+        self._sumsq = np.zeros(width)
+        # samples added since the sums were last computed from scratch
+        self._since_exact = 0
+        self._max = MonotonicDeques(width, window)
+        self._min = MonotonicDeques(width, window)
+        self.count = 0
+        self.mean = self.variance = self.std = self.rms = np.full(width, np.nan)
+        self.min = self.max = self.peak_to_peak = np.full(width, np.nan)
+
+    def update(self, values):
+        """ Adds a batch, (n, width) or (width,).
+        """
+        values = np.asarray(values, dtype=np.float64).reshape(-1, self.width)
+        n = len(values)
+        if not n:
+            return
+        # NaN and infinities in the window make the sums NaN until they
+        # leave it and the sums are computed from scratch, quietly
+        with np.errstate(invalid="ignore"):
+            self._update_sums(values)
+        high = self._max.extend(values, self.total)
+        low = -self._min.extend(-values, self.total)
+        self.total += n
+
+        count = len(self._ring)
+        with np.errstate(invalid="ignore"):
+            mean = self._sum / count
+            variance = np.maximum(self._sumsq / count - mean * mean, 0.0)
+            self.rms = np.sqrt(self._sumsq / count)
+        self.count = count
+        self.mean = mean
+        self.variance = variance
+        self.std = np.sqrt(variance)
+        self.min = low
+        self.max = high
+        self.peak_to_peak = high - low
+
+    def _update_sums(self, values):
+        n = len(values)
+        leaving = max(0, len(self._ring) + n - self.window)
+        if n >= self.window or self._since_exact + n >= self.window:
+            # from scratch once per window, rounding errors stay bounded
+            self._ring.extend(values)
+            kept = self._ring.last()[1]
+            self._sum = kept.sum(axis=0)
+            self._sumsq = (kept * kept).sum(axis=0)
+            self._since_exact = 0
+        else:
+            if leaving:
+                old = self._ring.last()[1][:leaving]
+                self._sum = self._sum - old.sum(axis=0)
+                self._sumsq = self._sumsq - (old * old).sum(axis=0)
+            self._sum = self._sum + values.sum(axis=0)
+            self._sumsq = self._sumsq + (values * values).sum(axis=0)
+            self._ring.extend(values)
+            self._since_exact += n
+
+
+class StreamStats(object):
+    """ RunningStats of the whole stream (`total`) and WindowStats over
+        each of `windows` samples (`windows[size]`).
+    """
+    def __init__(self, width, windows=(100,)):
+        self.width = width
+        self.total = RunningStats(width)
+        self.windows = collections.OrderedDict((size, WindowStats(width, size)) for size in windows)
+
+    def update(self, values):
+        values = np.asarray(values, dtype=np.float64).reshape(-1, self.width)
+        self.total.update(values)
+        for window in self.windows.values():
+            window.update(values)
+
+    def window(self, size=None):
+        # the first window by default
+        return self.windows[size] if size is not None else next(iter(self.windows.values()))
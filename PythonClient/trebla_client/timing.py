@@ -0,0 +1,183 @@
+"""
+Timestamps, round trips and sample timing.
+
+Requests are stamped with clock(), a monotonic clock that NTP steps and
+suspend do not move. Sample timestamps are that clock shifted once to
+the epoch at start (wall()): they compare across channels and devices
+of the same process, can be stored and still look like time.time().
+
+The phone answers a "sensor" command with the last value its listener
+got, so the value was current somewhere between the request and the
+reply, the best guess is the midpoint. Its uncertainty is half the
+round trip, which RttEstimator follows per connection.
+"""
+import math
+import time
+
+import numpy as np
+
+clock = time.monotonic
+
+# wall() = clock() + EPOCH_OFFSET, fixed for the life of the process
+EPOCH_OFFSET = time.time() - clock()
+
+
+def wall(t):
+    """ Epoch seconds of a clock() time (or array of them).
+    """
+    return t + EPOCH_OFFSET
+
+
+def acquisition_times(requests):
+    """ Midpoints of the requests, as wall() times.
+    """
+    return np.array([(r.sent_at + r.replied_at) / 2 for r in requests]) + EPOCH_OFFSET
+
+
+class RttEstimator(object):
+    """ Round trips of one connection: smoothed like TCP (srtt and rttvar,
+        RFC 6298), the minimum, and a histogram with `per_decade`
+        logarithmic bins from `low` to `high` seconds for percentiles.
+    """
+    def __init__(self, low=1e-4, high=100.0, per_decade=20):
+        self.srtt = None
+        self.rttvar = None
+        self.min = None
+        self.count = 0
+        self._low = math.log10(low)
+        self._per_decade = per_decade
+        bins = int(round((math.log10(high) - self._low) * per_decade))
+        # the first and last bins also hold what is below and above
+        self.edges = 10 ** (self._low + np.arange(bins + 1) / float(per_decade))
+        self.histogram = np.zeros(bins, dtype=np.int64)
+
+    def add(self, rtts):
+        """ Adds a sequence of round trips (seconds).
+        """
+        rtts = np.asarray(rtts, dtype=np.float64)
+        if not len(rtts):
+            return
+        for rtt in rtts.tolist():
+            if self.srtt is None:
+                self.srtt, self.rttvar = rtt, rtt / 2
+            else:
+                self.rttvar += 0.25 * (abs(self.srtt - rtt) - self.rttvar)
+                self.srtt += 0.125 * (rtt - self.srtt)
+        low = float(rtts.min())
+        self.min = low if self.min is None else min(self.min, low)
+        self.count += len(rtts)
+        index = np.floor((np.log10(np.maximum(rtts, 1e-12)) - self._low) * self._per_decade).astype(np.int64)
+        self.histogram += np.bincount(np.clip(index, 0, len(self.histogram) - 1), minlength=len(self.histogram))
+
+    def percentile(self, q):
+        """ Upper edge of the bin holding the q-th percentile (0-100), at
+            most one bin (12% with 20 per decade) above the true value,
+            None before any round trip.
+        """
+        if not self.count:
+            return None
+        index = int(np.searchsorted(np.cumsum(self.histogram), q / 100.0 * self.count))
+        return float(self.edges[min(index, len(self.histogram) - 1) + 1])
+
+    def stats(self):
+        return {
+            "count": self.count,
+            "srtt": self.srtt,
+            "rttvar": self.rttvar,
+            "min": self.min,
+            "p50": self.percentile(50),
+            "p99": self.percentile(99),
+        }
+
+
+class ClockOffset(object):
+    """ Offset of a remote clock: remote time minus wall(), from replies
+        that carry the time of the remote side.
+
+        Like NTP the remote time is assumed to be read at the midpoint of
+        the request, the estimate from the shortest round trip of the
+        last `window` ones is kept, its error is at most half that round
+        trip.
+    """
+    def __init__(self, window=64):
+        self.window = window
+        self.offset = None
+        self.error = None
+        self._samples = []
+
+    def add(self, request, remote_time):
+        # remote_time in epoch seconds
+        midpoint = wall((request.sent_at + request.replied_at) / 2)
+        rtt = request.replied_at - request.sent_at
+        self._samples.append((rtt, remote_time - midpoint))
+        del self._samples[:-self.window]
+        rtt, self.offset = min(self._samples)
+        self.error = rtt / 2
+
+    def to_local(self, remote_time):
+        # remote timestamps as wall() times
+        return remote_time - (self.offset or 0.0)
+
+
+class IntervalStats(object):
+    """ Timing of a stream of samples: the interval between them
+        (smoothed), its jitter (smoothed mean deviation, RFC 3550) and
+        gaps, intervals over `gap_factor` times the average and at least
+        `min_gap` seconds.
+
+        Pipelined requests sent and answered in the same chunks get the
+        same timestamp, such samples count as one arrival for the
+        intervals, rate() is the average over all the samples. Shorter
+        breaks between such bursts are jitter, not gaps.
+    """
+    def __init__(self, gap_factor=3.0, min_gap=0.1):
+        self.gap_factor = gap_factor
+        self.min_gap = min_gap
+        self.count = 0
+        self.interval = None
+        self.jitter = 0.0
+        self.gaps = 0
+        self.max_gap = 0.0
+        self.first = None
+        self.last = None
+
+    def add(self, times):
+        """ Adds the timestamps of new samples, in order.
+        """
+        times = np.asarray(times, dtype=np.float64)
+        if not len(times):
+            return
+        if self.first is None:
+            self.first = float(times[0])
+        if self.last is not None:
+            times = np.concatenate(([self.last], times))
+        self.count += len(times) - (self.last is not None)
+        self.last = float(times[-1])
+        intervals = np.diff(times)
+        average = (self.last - self.first) / (self.count - 1) if self.count > 1 else None
+        for interval in intervals[intervals > 0].tolist():
+            if self.interval is None:
+                self.interval = interval
+                continue
+            if interval > self.min_gap and interval > self.gap_factor * (average or self.interval):
+                # a gap says nothing about the usual interval
+                self.gaps += 1
+                self.max_gap = max(self.max_gap, interval)
+                continue
+            self.jitter += (abs(interval - self.interval) - self.jitter) / 16.0
+            self.interval += (interval - self.interval) / 16.0
+
+    def rate(self):
+        if self.count < 2 or self.last <= self.first:
+            return None
+        return (self.count - 1) / (self.last - self.first)
+
+    def stats(self):
+        return {
+            "count": self.count,
+            "rate": self.rate(),
+            "interval": self.interval,
+            "jitter": self.jitter,
+            "gaps": self.gaps,
+            "max_gap": self.max_gap,
+        }
@@ -0,0 +1,315 @@
+"""
+The external gyroscope: an L3G4200D on the Arduino behind the phone's
+USB port (Arduino/TreblaArduino/TreblaArduino.ino).
+
+The sketch answers every 'g' written to it ("usb -w g") with the raw
+rates "[x,y,z]", int16 counts, without a new line, and once "usb -r"
+started the reading thread the phone forwards whatever the device sent
+to the socket: several readings can come in one line and one reading
+over two. TripleScanner finds the complete readings in that stream
+wherever it is cut, ExternalGyro converts them to deg/s with the full
+scale the sensor is set to and counts the saturated ones.
+
+    gyro = attach(subscriber, full_scale=250, rate=20, burst=5)
+    await gyro.start(client)                # usb connect, usb -r
+    subscriber.channels["ext_gyro"]         # deg/s
+
+The 'g' are polled like the internal sensors, in the same pipeline
+window, so the external gyroscope runs as fast as the link allows next
+to the internal one, and written several at a time with burst: a round
+trip through TreblaService and the USB manager for `burst` readings.
+The sensor updates at 100 Hz (CTRL_REG1 of the sketch), readings closer
+than that repeat the same values, see Channel.fresh.
+"""
+import logging
+import re
+
+import numpy as np
+
+from trebla_client.profiling import profiler
+from trebla_client.timing import wall
+
+log = logging.getLogger(__name__)
+
+# deg/s per count of each full scale (deg/s), L3G4200D datasheet
+SCALES = {
+    250: 8.75e-3,
+    500: 17.5e-3,
+    2000: 70e-3,
+}
+
+# the sketch sets 250 at reset, 's' sets 2000
+DEFAULT_FULL_SCALE = 250
+
+# 'g' in one write at most: the serial receive buffer of the sketch
+MAX_BURST = 64
+
+# the output registers hold these when the rate is beyond the full scale
+INT16_MIN = -32768
+INT16_MAX = 32767
+
+# longest reading the sketch can send, "[-32768,-32768,-32768]"
+MAX_READING = 22
+
+TRIPLE = re.compile(r"\[(-?\d{1,6},-?\d{1,6},-?\d{1,6})\]")
+# what the device sends, nothing the phone replies is made of these only:
+# Arrays.toString puts spaces between values and floats have a dot
+USB_DATA = re.compile(r"[-0-9,\[\]]+\Z")
+
+
+def is_usb_data(line):
+    """ True for a line forwarded by "usb -r" from the device, see
+        engine.Pipeline.pushed.
+    """
+    return USB_DATA.match(line) is not None
+
+
+def command(burst=1):
+    """ The write asking for `burst` readings, "usb -w ggg".
+    """
+    return "usb -w " + "g" * burst
+
+
+def _burst(burst):
+    burst = int(burst)
+    if not 1 <= burst <= MAX_BURST:
+        raise ValueError("burst of %d, from 1 to %d" % (burst, MAX_BURST))
+    return burst
+
+
+def transferred(reply):
+    """ Number of bytes of a "usb -w" reply, None when nothing was
+        written ("Transferred bytes: no usb device selected", or -1).
+    """
+    if not reply.startswith("Transferred bytes: "):
+        return None
+    try:
+        count = int(reply[19:])
+    except ValueError:
+        return None
+    return count if count >= 0 else None
+
+
+class TripleScanner(object):
+    """ Finds the complete "[x,y,z]" readings in a stream of text cut
+        anywhere. What is not part of a complete reading (the end of one
+        whose start was lost, garbage) is skipped and counted in
+        `skipped` characters.
+    """
+    def __init__(self):
+        self._tail = ""
+        self.readings = 0
+        self.skipped = 0
+
+    def reset(self):
+        # the stream starts again, e.g. after a reconnection
+        self._tail = ""
+
+    def feed(self, text):
+        """ Adds the next piece of the stream, returns the (n, 3) int64
+            readings it completes.
+        """
+        text = self._tail + text
+        # an unfinished reading waits for the rest of it
+        start = text.rfind("[")
+        if start >= 0 and text.find("]", start) < 0 and len(text) - start < MAX_READING:
+            text, self._tail = text[:start], text[start:]
+        else:
+            self._tail = ""
+        matches = TRIPLE.findall(text)
+        if not matches:
+            self.skipped += len(text)
+            return np.zeros((0, 3), dtype=np.int64)
+        joined = ",".join(matches)
+        # the brackets and the commas between the readings
+        self.skipped += len(text) - (len(joined) + len(matches) + 1)
+        counts = np.fromstring(joined, dtype=np.int64, sep=",").reshape(-1, 3)
+        valid = np.all((counts >= INT16_MIN) & (counts <= INT16_MAX), axis=1)
+        if not valid.all():
+            counts = counts[valid]
+        self.readings += len(counts)
+        return counts
+
+
+class ExternalGyro(object):
+    """ Readings of the L3G4200D in deg/s, full_scale (250, 500 or 2000
+        deg/s) as set by setupL3G4200D() in the sketch, handed to
+        on_samples(times, (n, 3) deg/s, saturated (n,)) as they are
+        timestamped.
+
+        'g' are written `burst` at a time, "usb -w ggg...": one command
+        and one round trip for `burst` readings. A write acknowledged
+        with "Transferred bytes: n" gets the next n readings, spread
+        evenly from the midpoint of its request over the interval between
+        writes (the poll rate, or the average interval), so the stream
+        has the rate of the readings and not of the writes. Readings no write asked for (nothing is
+        polled, the board streams by itself) keep the time they arrived
+        at, readings still missing max_lag seconds after their write are
+        counted as `lost`.
+
+        A reading with an axis at the end of the int16 range is saturated:
+        the rate was beyond the full scale, the value only says it was at
+        least that. They are kept and counted in `saturated`.
+    """
+    def __init__(self, full_scale=DEFAULT_FULL_SCALE, burst=1, max_lag=1.0, on_samples=None):
+        if full_scale not in SCALES:
+            raise ValueError("full scale %s, choose from %s" % (full_scale, ", ".join(str(s) for s in sorted(SCALES))))
+        self.full_scale = full_scale
+        self.scale = SCALES[full_scale]
+        self.burst = _burst(burst)
+        self.max_lag = max_lag
+        self.on_samples = on_samples
+        self.scanner = TripleScanner()
+        self.samples = 0
+        self.saturated = 0
+        # 'g' the device got, the writes it did not get and those it got
+        # only part of
+        self.requested = 0
+        self.failed = 0
+        self.short_writes = 0
+        self.lost = 0
+        self.poll = None
+        self.reset()
+
+    def reset(self):
+        # the stream starts again, e.g. after a reconnection
+        self.scanner.reset()
+        # times of the readings written for and not received yet
+        self._slots = np.zeros(0)
+        # readings received before their write was acknowledged, and when
+        self._counts = np.zeros((0, 3), dtype=np.int64)
+        self._arrived = np.zeros(0)
+        # midpoint of the last write and average interval between writes,
+        # end of the span of the last burst, last time given to a reading
+        self._last_write = None
+        self._interval = 0.0
+        self._next_write = None
+        self._last_time = -np.inf
+
+    def feed(self, text, now):
+        """ Adds a piece of the forwarded stream, received at `now` (wall
+            time). Returns the number of readings timestamped.
+        """
+        started = profiler.start()
+        counts = self.scanner.feed(text)
+        profiler.stop("decode", started)
+        if len(counts):
+            self._counts = np.concatenate((self._counts, counts))
+            self._arrived = np.concatenate((self._arrived, np.full(len(counts), now)))
+        return self._match(now)
+
+    def on_writes(self, requests):
+        """ Replies to the polled "usb -w g...", returns the number of
+            readings timestamped.
+        """
+        for request in requests:
+            count = transferred(request.reply)
+            if count is None:
+                self.failed += 1
+                continue
+            if count < request.command.count("g"):
+                self.short_writes += 1
+            self.requested += count
+            middle = request.acquired_at
+            if self._last_write is not None:
+                # writes sent and answered together share their midpoint,
+                # only the average interval means something
+                interval = min(max(middle - self._last_write, 0.0), self.max_lag)
+                self._interval += 0.1 * (interval - self._interval)
+            self._last_write = middle
+            if not count:
+                continue
+            # the burst covers the time until the next one: from where the
+            # previous one ended, unless that is long gone or far ahead
+            interval = self.poll.interval if self.poll is not None and self.poll.interval else self._interval
+            start = middle
+            if self._next_write is not None and 0.0 < self._next_write - middle < self.max_lag:
+                start = self._next_write
+            self._next_write = start + interval
+            slots = start + interval * np.arange(count) / count
+            floor = self._slots[-1] if len(self._slots) else self._last_time
+            self._slots = np.concatenate((self._slots, np.maximum(slots, floor)))
+        return self._match(wall(requests[-1].replied_at)) if requests else 0
+
+    def _match(self, now):
+        # the readings in order to the slots of the acknowledged 'g'
+        n = min(len(self._slots), len(self._counts))
+        times, counts = self._slots[:n], self._counts[:n]
+        self._slots, self._counts, self._arrived = self._slots[n:], self._counts[n:], self._arrived[n:]
+        if len(self._slots):
+            expired = int(np.searchsorted(self._slots, now - self.max_lag))
+            if expired:
+                self.lost += expired
+                self._slots = self._slots[expired:]
+        elif len(self._counts):
+            # asked for by nobody, or by a write whose reply is very late
+            late = len(self._counts) if self.poll is None else int(np.searchsorted(self._arrived, now - self.max_lag))
+            if late:
+                times = np.concatenate((times, self._arrived[:late]))
+                counts = np.concatenate((counts, self._counts[:late]))
+                self._counts, self._arrived = self._counts[late:], self._arrived[late:]
+        if not len(counts):
+            return 0
+        times = np.maximum.accumulate(np.maximum(times, self._last_time))
+        self._last_time = times[-1]
+        saturated = np.any((counts == INT16_MIN) | (counts == INT16_MAX), axis=1)
+        if saturated.any():
+            if not self.saturated:
+                log.warning("external gyroscope saturated, beyond %d deg/s", self.full_scale)
+            self.saturated += int(np.count_nonzero(saturated))
+        self.samples += len(counts)
+        if self.on_samples is not None:
+            self.on_samples(times, counts * self.scale, saturated)
+        return len(counts)
+
+    def subscribe(self, client, rate=None, priority=0):
+        """ Polls the readings with "usb -w g..." as fast as the pipeline
+            window allows, or `rate` writes per second.
+        """
+        if self.poll is not None:
+            self.poll.stop()
+        self.poll = client.poll(command(self.burst), self.on_writes, batch=True, rate=rate, priority=priority)
+        return self.poll
+
+    def set_burst(self, burst):
+        # from the next write on
+        self.burst = _burst(burst)
+        if self.poll is not None:
+            self.poll.command = command(self.burst)
+
+    async def start(self, client):
+        """ Connects the device and starts the reading thread on the phone.
+            "usb -r" toggles it: call this once per connection, the thread
+            stops with it.
+        """
+        await client.request("usb connect", urgent=True)
+        await client.request("usb -r", urgent=True)
+
+    def stop(self):
+        if self.poll is not None:
+            self.poll.stop()
+            self.poll = None
+
+
+def attach(subscriber, full_scale=DEFAULT_FULL_SCALE, name="ext_gyro", rate=None, priority=0, burst=1):
+    """ Adds the channel `name` (deg/s) to a channels.SensorSubscriber,
+        polls the readings, `burst` per write, and takes them out of the
+        lines its client receives. The other unsolicited lines still go to
+        the on_unsolicited of the client. Returns the ExternalGyro,
+        start() it once connected.
+    """
+    channel = subscriber.computed(name)
+    gyro = ExternalGyro(full_scale, burst, on_samples=lambda times, values, saturated: channel.add(times, values))
+    client = subscriber.client
+    client.pipeline.pushed = is_usb_data
+    previous = client.on_unsolicited
+
+    def on_unsolicited(client, line):
+        if is_usb_data(line):
+            gyro.feed(line, wall(client.received_at))
+        elif previous is not None:
+            previous(client, line)
+
+    client.on_unsolicited = on_unsolicited
+    gyro.subscribe(client, rate, priority)
+    return gyro
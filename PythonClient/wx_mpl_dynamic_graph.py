@@ -22,11 +22,7 @@ import pprint
 import random
 import sys
 import wx
-import socket
 import time
-import threading
-import select
-import re
 
 # The recommended way to use wx with mpl is with the WXAgg
 # backend. 
@@ -39,114 +35,15 @@ from matplotlib.backends.backend_wxagg import \
     NavigationToolbar2WxAgg as NavigationToolbar
 import numpy as np
 import pylab
+from trebla_client import metrics
+from trebla_client.bridge import ClientBridge, DISCONNECTED
+from trebla_client.engine import ConnectionLost
+from trebla_client.graph import AccGraph, AccTracker
+from trebla_client.profiling import profiler
+from trebla_client.recorder import SessionRecorder
+from trebla_client.spectrum import RollingSpectrum
 
 connectionState = 0
-dataBuffer = ""
-EVENT_DISCONNECTED = wx.NewEventType()
-EVENT_NEW_ACC_DATA = wx.NewEventType()
-
-
-class SocketClientThread(threading.Thread):
-    def __init__(self, conn, parent):
-        threading.Thread.__init__(self)
-        self.conn = conn
-        self.parent = parent
-        self.command = 0
-        self.command_lock = threading.RLock()
-        self.command_queue = []
-        self.accRegex = "[-+]?\d*\.\d+|\d+"
-        self.data_acc_x_array = [0.0]
-        self.data_acc_y_array = [0.0]
-        self.data_acc_z_array = [0.0]
-
-    def run(self):
-        global connectionState, dataBuffer
-        while connectionState:
-            # this will try to recieve data continuously
-            try:
-                # this makes sure there's someting to read from the server before actually reading it
-                # it's necessary because without it will keep blocking even with a closed connection
-                if select.select([self.conn], [], []):
-                    # this is blocking
-                    data = self.conn.recv(1024)
-                
-                # connection lost
-                if not data:
-                    wx.PostEvent(self.parent, wx.PyCommandEvent(EVENT_DISCONNECTED, -1))
-                    return
-                
-                # remove all whitespace characters on the right side
-                # append so that if there's a new packet before the previous is shown it doesn't get lost
-                dataBuffer += data.rstrip()
-                self.command_lock.acquire()
-                if self.command == 1:
-                    print "sensor started"
-                elif self.command == 2 or self.command == 3:
-                    acc_data = re.findall(self.accRegex, dataBuffer)
-                    if acc_data is not None:
-                        #tracing acc_data
-                        #print dataBuffer
-                        print acc_data
-                        
-                        self.data_acc_x_array.append(float(acc_data[0]))
-                        self.data_acc_y_array.append(float(acc_data[1]))
-                        self.data_acc_z_array.append(float(acc_data[2]))
-                        
-                        if len(self.data_acc_x_array) > 2000:
-                        	self.data_acc_x_array.pop(0)
-                        	self.data_acc_y_array.pop(0)
-                        	self.data_acc_z_array.pop(0)
-                        	
-                        wx.PostEvent(self.parent, wx.PyCommandEvent(EVENT_NEW_ACC_DATA, -1))
-                
-                if self.command == 3:
-                    self.command_queue.append(3)
-                    
-                if len(self.command_queue) != 0:
-                    self.command = self.command_queue.pop(0)
-                    if self.command == 1:
-                        self.conn.send("sensor start\n")
-                    elif self.command == 2 or self.command == 3:
-                        self.conn.send("sensor linearacc\n")
-                                    
-                self.command_lock.release()
-                dataBuffer = "" 
-                
-            except socket.timeout, e:
-                #print e.args[0]
-                continue
-            except Exception as e:
-                #print e.args[0]
-                return
-
-    def send(self, data, auto=False):
-        # new line defines an end of command on the server side
-        command = -1
-        self.command_lock.acquire()
-        
-        if "sensor start" in data:
-            command = 1
-        elif "sensor linearacc" in data:
-            if auto:
-                command = 3
-            else:
-                command = 2
-        else:
-            print "sending unknown command"
-            command = -1
-        
-        self.command = command
-        if len(self.command_queue) != 0:
-            self.command_queue.append(command)
-        else:
-            self.conn.send(data + "\n")
-            
-        self.command_lock.release()
-
-    def close(self):
-        global connectionState
-        connectionState = 0
-        self.conn.close()
 
 
 class BoundControlBox(wx.Panel):
@@ -201,12 +98,38 @@ class GraphFrame(wx.Frame):
     """ The main frame of the application
     """
     title = 'Demo: dynamic matplotlib graph'
+    # the spectrum is computed on the samples resampled at this rate (Hz)
+    spectrum_rate = 100.0
+    # spectra shown in the spectrogram, 0.64 s each at 100 Hz
+    spectrogram_frames = 128
+    # choices of the Filter box: label, filters.parse() text
+    filter_choices = (
+        ("Raw", ""),
+        ("Without gravity", "highpass:0.3"),
+        ("Low-pass 5 Hz", "lowpass:5:2"),
+        ("Despiked", "median:5:3"),
+        ("Smoothed", "median:5,average:5"),
+    )
+    # port to serve the metrics on for Prometheus, e.g. 9464, None to not serve
+    metrics_port = None
     
     def __init__(self):
         wx.Frame.__init__(self, None, -1, self.title)
         
         self.paused = False
-        self.sct = None
+        # the socket is handled by an event loop in a background thread
+        self.bridge = ClientBridge()
+        self.client = None
+        self.tracker = AccTracker(self.bridge)
+        # spectra of the acceleration, computed here and not on the bridge loop
+        self.spectrum = RollingSpectrum(self.spectrum_rate, 3, frames=self.spectrogram_frames)
+        # the figure, drawn on the canvas of the main panel
+        self.graph = AccGraph(self.tracker, self.spectrum, self.spectrogram_frames)
+        self.metrics = metrics.Registry()
+        self.metrics.register(self.collect_metrics)
+        self.metrics_server = None
+        if self.metrics_port is not None:
+            self.metrics_server = metrics.MetricsServer(self.metrics, self.metrics_port)
         
         self.create_menu()
         self.create_status_bar()
@@ -222,6 +145,10 @@ class GraphFrame(wx.Frame):
         menu_file = wx.Menu()
         m_expt = menu_file.Append(-1, "&Save plot\tCtrl-S", "Save plot to file")
         self.Bind(wx.EVT_MENU, self.on_save_plot, m_expt)
+        self.m_profile = menu_file.Append(-1, "&Profile 30 s\tCtrl-P", "Profile the receiving and the drawing")
+        self.Bind(wx.EVT_MENU, self.on_profile, self.m_profile)
+        self.m_record = menu_file.Append(-1, "&Record session...\tCtrl-R", "Record the samples to a directory")
+        self.Bind(wx.EVT_MENU, self.on_record, self.m_record)
         menu_file.AppendSeparator()
         m_exit = menu_file.Append(-1, "E&xit\tCtrl-X", "Exit")
         self.Bind(wx.EVT_MENU, self.on_exit, m_exit)
@@ -232,8 +159,7 @@ class GraphFrame(wx.Frame):
     def create_main_panel(self):
         self.panel = wx.Panel(self)
 
-        self.init_plot()
-        self.canvas = FigCanvas(self.panel, -1, self.fig)
+        self.canvas = FigCanvas(self.panel, -1, self.graph.fig)
 
         self.xmin_control = BoundControlBox(self.panel, -1, "X min", 0)
         self.xmax_control = BoundControlBox(self.panel, -1, "X max", 50)
@@ -256,6 +182,17 @@ class GraphFrame(wx.Frame):
         self.Bind(wx.EVT_CHECKBOX, self.on_cb_xlab, self.cb_xlab)        
         self.cb_xlab.SetValue(True)
         
+        self.cb_blit = wx.CheckBox(self.panel, -1, 
+            "Blit",
+            style=wx.ALIGN_RIGHT)
+        self.Bind(wx.EVT_CHECKBOX, self.on_cb_blit, self.cb_blit)        
+        self.cb_blit.SetValue(True)
+        self.graph.attach(self.canvas, blit=True)
+        
+        self.filter_choice = wx.Choice(self.panel, choices=[label for label, spec in self.filter_choices])
+        self.filter_choice.SetSelection(0)
+        self.Bind(wx.EVT_CHOICE, self.on_filter_choice, self.filter_choice)
+        
         #set tcp ip control box
         self.tcp_ip = wx.TextCtrl(self.panel, size=(120, -1), value="192.168.0.105")
         self.tcp_port = wx.TextCtrl(self.panel, value="8888")
@@ -282,6 +219,11 @@ class GraphFrame(wx.Frame):
         self.hbox1.Add(self.cb_grid, border=5, flag=wx.ALL | wx.ALIGN_CENTER_VERTICAL)
         self.hbox1.AddSpacer(10)
         self.hbox1.Add(self.cb_xlab, border=5, flag=wx.ALL | wx.ALIGN_CENTER_VERTICAL)
+        self.hbox1.AddSpacer(10)
+        self.hbox1.Add(self.cb_blit, border=5, flag=wx.ALL | wx.ALIGN_CENTER_VERTICAL)
+        self.hbox1.AddSpacer(20)
+        self.hbox1.Add(wx.StaticText(self.panel, label="Filter:"), border=5, flag=wx.ALL | wx.ALIGN_CENTER_VERTICAL)
+        self.hbox1.Add(self.filter_choice, border=5, flag=wx.ALL | wx.ALIGN_CENTER_VERTICAL)
         
         self.hbox2 = wx.BoxSizer(wx.HORIZONTAL)
         self.hbox2.Add(self.xmin_control, border=5, flag=wx.ALL)
@@ -301,13 +243,16 @@ class GraphFrame(wx.Frame):
     
     def create_status_bar(self):
         self.statusbar = self.CreateStatusBar()
+        # messages on the left, sample timing then frame time on the right
+        self.statusbar.SetFieldsCount(3)
+        self.statusbar.SetStatusWidths([-2, -1, -1])
         
     def func_track_acc(self, event):
         global connectionState
 
         if connectionState:
             #check if sensor service has already started
-            self.sct.send("sensor linearacc", True)
+            self.tracker.track(self.client, "sensor linearacc")
         
     def connect(self, event):
         global connectionState
@@ -317,26 +262,20 @@ class GraphFrame(wx.Frame):
             self.disconnect(wx.EVT_BUTTON)
             return
         
-        self.clientSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        # set timeout in case a wrong ip is used (in seconds)
-        self.clientSocket.settimeout(2)
         ip = self.tcp_ip.GetValue()
         port = int(self.tcp_port.GetValue())
         
         try:
-            self.clientSocket.connect((ip, port))
-        except socket.timeout:
-            wx.MessageBox('Timeout while connecting, verify the IP and port.', 'Error', wx.OK|wx.ICON_ERROR)
-            return
-        except Exception, e:
-            wx.MessageBox('Could not connect to socket, is the app running?', 'Error', wx.OK|wx.ICON_ERROR)
+            # set timeout in case a wrong ip is used (in seconds)
+            self.client = self.bridge.connect(ip, port, reconnect=False, connect_timeout=2)
+        except ConnectionLost:
+            wx.MessageBox('Could not connect to socket, verify the IP and port, is the app running?', 'Error', wx.OK|wx.ICON_ERROR)
             return
         
-        # start the receieveing thread
         connectionState = 1
-        self.sct = SocketClientThread(self.clientSocket, self)
-        self.sct.start()
-        self.sct.send("sensor start")
+        # starts the sensors unless they already run, replies come back in
+        # order so the polls can go right behind it
+        self.bridge.call(self.client.ensure_started)
         
         # update UI element statuses
         self.button_connect.SetLabel("Stop")
@@ -349,7 +288,8 @@ class GraphFrame(wx.Frame):
         
     def disconnect(self, event):
         global connectionState
-        self.clientSocket.close()
+        self.tracker.stop()
+        self.bridge.disconnect(self.client)
         connectionState = 0
         
         if event != wx.EVT_BUTTON:
@@ -364,209 +304,29 @@ class GraphFrame(wx.Frame):
         # set focus on the ip field
         wx.Window.SetFocus(self.tcp_ip)        
         
-    def init_plot(self):
-        self.dpi = 100
-        self.fig = Figure(None, self.dpi)
-        self.fig.subplots_adjust(bottom=0.05, wspace=0.1, hspace=0.2, left=0.0455, top=0.99, right=0.99)
-        self.axes = self.fig.add_subplot(311)
-#        self.axes.set_axis_bgcolor('black')
-#        self.axes.set_title('Acc x', size=12)
-       
-        self.axes_y = self.fig.add_subplot(312)
-#        self.axes_y.set_axis_bgcolor('black')
-#        self.axes_y.set_title('Acc y', size=12)
-        
-        self.axes_z = self.fig.add_subplot(313)
-#        self.axes_z.set_axis_bgcolor('black')
-
-        pylab.setp(self.axes.get_xticklabels(), fontsize=8)
-        pylab.setp(self.axes.get_yticklabels(), fontsize=8)
-        
-        pylab.setp(self.axes_y.get_xticklabels(), fontsize=8)
-        pylab.setp(self.axes_y.get_yticklabels(), fontsize=8)
-        
-        pylab.setp(self.axes_z.get_xticklabels(), fontsize=8)
-        pylab.setp(self.axes_z.get_yticklabels(), fontsize=8)
-
-        # plot the data as a line series, and save the reference 
-        # to the plotted line series
-        #
-        array = [0]
-        if self.sct is not None:
-            array = self.sct.data_acc_x_array
-        self.plot_data = self.axes.plot(
-            array, 
-            linewidth=1,
-            color=(1, 1, 0),
-            )[0]
-            
-        array = [0]
-        if self.sct is not None:
-            array = self.sct.data_acc_y_array
-        self.plot_data_y = self.axes_y.plot(
-            array, 
-            linewidth=1,
-            color=(1, 1, 0),
-            )[0]
-            
-        array = [0]
-        if self.sct is not None:
-            array = self.sct.data_acc_z_array
-        self.plot_data_z = self.axes_z.plot(
-            array, 
-            linewidth=1,
-            color=(1, 1, 0),
-            )[0]
-
     def draw_plot(self):
         """ Redraws the plot
         """
-        # when xmin is on auto, it "follows" xmax to produce a 
-        # sliding window effect. therefore, xmin is assigned after
-        # xmax.
-        #
-        array = [0]
-        if self.sct is not None:
-            array = self.sct.data_acc_x_array
-            
-        array_y = [0]
-        if self.sct is not None:
-            array_y = self.sct.data_acc_y_array
-            
-        array_z = [0]
-        if self.sct is not None:
-            array_z = self.sct.data_acc_z_array
-        
-        # x
-        if self.xmax_control.is_auto():
-            xmax = len(array) if len(array) > 20 else 20
-        else:
-            xmax = int(self.xmax_control.manual_value())
-            
-        if self.xmin_control.is_auto():            
-            xmin = xmax - 20
-        else:
-            xmin = int(self.xmin_control.manual_value())
-
-        # for ymin and ymax, find the minimal and maximal values
-        # in the data set and add a mininal margin.
-        # 
-        # note that it's easy to change this scheme to the 
-        # minimal/maximal value in the current display, and not
-        # the whole data set.
-        # 
-        if self.ymin_control.is_auto():
-            ymin = round(min(array), 0) - 1
-        else:
-            ymin = int(self.ymin_control.manual_value())
-        
-        if self.ymax_control.is_auto():
-            ymax = round(max(array), 0) + 1
-        else:
-            ymax = int(self.ymax_control.manual_value())
-
-        self.axes.set_xbound(lower=xmin, upper=xmax)
-        self.axes.set_ybound(lower=ymin, upper=ymax)
-        
-        # y 
-        if self.xmax_control.is_auto():
-            xmax = len(array_y) if len(array_y) > 20 else 20
-        else:
-            xmax = int(self.xmax_control.manual_value())
-            
-        if self.xmin_control.is_auto():            
-            xmin = xmax - 20
+        started = profiler.start()
+        bounds = [None if control.is_auto() else int(control.manual_value())
+                  for control in (self.xmin_control, self.xmax_control, self.ymin_control, self.ymax_control)]
+        self.graph.draw(*bounds, grid=self.cb_grid.IsChecked(), xlabels=self.cb_xlab.IsChecked())
+        
+        timing = self.tracker.acc_timing
+        if timing.rate():
+            # vibration: RMS around the mean (gravity left out) of the
+            # last 100 samples
+            second = self.tracker.acc_stats.window(100)
+            self.statusbar.SetStatusText("%.0f Hz, jitter %.1f ms, %d gaps, RMS %.2f %.2f %.2f" % (
+                (timing.rate(), timing.jitter * 1000, timing.gaps) + tuple(second.std)), 1)
+        
+        renderer = self.graph.renderer
+        if renderer is not None:
+            self.statusbar.SetStatusText("frame %.1f ms, %d full redraws" % (
+                renderer.frame_time * 1000, renderer.full_draws), 2)
         else:
-            xmin = int(self.xmin_control.manual_value())
-
-        # for ymin and ymax, find the minimal and maximal values
-        # in the data set and add a mininal margin.
-        # 
-        # note that it's easy to change this scheme to the 
-        # minimal/maximal value in the current display, and not
-        # the whole data set.
-        # 
-        if self.ymin_control.is_auto():
-            ymin = round(min(array_y), 0) - 1
-        else:
-            ymin = int(self.ymin_control.manual_value())
-        
-        if self.ymax_control.is_auto():
-            ymax = round(max(array_y), 0) + 1
-        else:
-            ymax = int(self.ymax_control.manual_value())
-
-        self.axes_y.set_xbound(lower=xmin, upper=xmax)
-        self.axes_y.set_ybound(lower=ymin, upper=ymax)
-        
-        # z 
-        if self.xmax_control.is_auto():
-            xmax = len(array_z) if len(array_z) > 20 else 20
-        else:
-            xmax = int(self.xmax_control.manual_value())
-            
-        if self.xmin_control.is_auto():            
-            xmin = xmax - 20
-        else:
-            xmin = int(self.xmin_control.manual_value())
-
-        # for ymin and ymax, find the minimal and maximal values
-        # in the data set and add a mininal margin.
-        # 
-        # note that it's easy to change this scheme to the 
-        # minimal/maximal value in the current display, and not
-        # the whole data set.
-        # 
-        if self.ymin_control.is_auto():
-            ymin = round(min(array_z), 0) - 1
-        else:
-            ymin = int(self.ymin_control.manual_value())
-        
-        if self.ymax_control.is_auto():
-            ymax = round(max(array_z), 0) + 1
-        else:
-            ymax = int(self.ymax_control.manual_value())
-
-        self.axes_z.set_xbound(lower=xmin, upper=xmax)
-        self.axes_z.set_ybound(lower=ymin, upper=ymax)
-                
-        # anecdote: axes.grid assumes b=True if any other flag is
-        # given even if b is set to False.
-        # so just passing the flag into the first statement won't
-        # work.
-        #
-        if self.cb_grid.IsChecked():
-            self.axes.grid(True, color='gray')
-            self.axes_y.grid(True, color='gray')
-            self.axes_z.grid(True, color='gray')
-        else:
-            self.axes.grid(False)
-            self.axes_y.grid(False)
-            self.axes_z.grid(False)
-
-        # Using setp here is convenient, because get_xticklabels
-        # returns a list over which one needs to explicitly 
-        # iterate, and setp already handles this.
-        #  
-        pylab.setp(self.axes.get_xticklabels(), 
-            visible=self.cb_xlab.IsChecked())
-            
-        pylab.setp(self.axes_y.get_xticklabels(), 
-            visible=self.cb_xlab.IsChecked())
-            
-        pylab.setp(self.axes_z.get_xticklabels(), 
-            visible=self.cb_xlab.IsChecked())
-        
-        self.plot_data.set_xdata(np.arange(len(array)))
-        self.plot_data.set_ydata(np.array(array))
-        
-        self.plot_data_y.set_xdata(np.arange(len(array_y)))
-        self.plot_data_y.set_ydata(np.array(array_y))
-        
-        self.plot_data_z.set_xdata(np.arange(len(array_z)))
-        self.plot_data_z.set_ydata(np.array(array_z))
-        
-        self.canvas.draw()
+            self.statusbar.SetStatusText("frame %.1f ms" % (self.graph.frame_time * 1000), 2)
+        profiler.stop("draw", started)
     
     def on_pause_button(self, event):
         self.paused = not self.paused
@@ -581,6 +341,15 @@ class GraphFrame(wx.Frame):
     def on_cb_xlab(self, event):
         self.draw_plot()
     
+    def on_cb_blit(self, event):
+        self.graph.set_blit(self.cb_blit.IsChecked())
+        self.draw_plot()
+    
+    def on_filter_choice(self, event):
+        label, spec = self.filter_choices[self.filter_choice.GetSelection()]
+        self.tracker.set_filter(spec)
+        self.flash_status_message("Filter: %s" % label)
+    
     def on_save_plot(self, event):
         file_choices = "PNG (*.png)|*.png"
         
@@ -590,23 +359,87 @@ class GraphFrame(wx.Frame):
             defaultDir=os.getcwd(),
             defaultFile="plot.png",
             wildcard=file_choices,
-            style=wx.SAVE)
+            style=wx.FD_SAVE)
         
         if dlg.ShowModal() == wx.ID_OK:
             path = dlg.GetPath()
-            self.canvas.print_figure(path, dpi=self.dpi)
+            self.canvas.print_figure(path, dpi=self.graph.dpi)
             self.flash_status_message("Saved to %s" % path)
     
+    def on_profile(self, event):
+        if profiler.active:
+            profiler.finish()
+            return
+        dlg = wx.DirDialog(
+            self, 
+            message="Write the profile to...",
+            defaultPath=os.getcwd())
+        
+        if dlg.ShowModal() == wx.ID_OK:
+            # the files are written from the thread that ends the session
+            profiler.on_finished = lambda paths: wx.CallAfter(self.on_profile_finished, paths)
+            profiler.begin(30.0, dlg.GetPath(), cprofile=True, tracemalloc=True)
+            self.m_profile.SetItemLabel("Stop &profiling\tCtrl-P")
+            self.flash_status_message("Profiling for 30 s")
+    
+    def on_profile_finished(self, paths):
+        self.m_profile.SetItemLabel("&Profile 30 s\tCtrl-P")
+        self.flash_status_message("Profile written to %s" % os.path.dirname(paths[0]))
+    
+    def on_record(self, event):
+        if self.tracker.recorder is not None:
+            recorder, self.tracker.recorder = self.tracker.recorder, None
+            recorder.close()
+            self.m_record.SetItemLabel("&Record session...\tCtrl-R")
+            self.flash_status_message("Recorded %d samples to %s" % (recorder.samples, recorder.directory))
+            return
+        
+        dlg = wx.DirDialog(
+            self, 
+            message="Record session to...",
+            defaultPath=os.getcwd())
+        
+        if dlg.ShowModal() == wx.ID_OK:
+            self.tracker.recorder = SessionRecorder(dlg.GetPath())
+            self.m_record.SetItemLabel("Stop &recording\tCtrl-R")
+            self.flash_status_message("Recording to %s" % dlg.GetPath())
+    
     def on_redraw_timer(self, event):
+        for kind, client, error in self.bridge.drain():
+            if kind == DISCONNECTED and client is self.client and connectionState:
+                self.disconnect(None)
+        
         # if paused do not add data, but still redraw the plot
         # (to respond to scale modifications, grid change, etc.)
         #
         #if not self.paused:
         #    self.data.append(self.datagen.next())
         
+        started = profiler.start()
+        self.spectrum.pull(self.tracker.acc_history)
+        profiler.stop("spectrum", started)
         self.draw_plot()
     
+    def collect_metrics(self):
+        # runs on the thread of the metrics server
+        collectors = [metrics.bridge_metrics(self.bridge),
+                      metrics.ring_metrics(self.tracker.acc_history, channel="acc")]
+        if self.client is not None:
+            collectors.append(metrics.client_metrics(self.client))
+        if self.tracker.recorder is not None:
+            collectors.append(metrics.recorder_metrics(self.tracker.recorder))
+        renderer = self.graph.renderer
+        if renderer is not None:
+            collectors.append(metrics.renderer_metrics(renderer))
+        else:
+            yield "trebla_frame_seconds", metrics.GAUGE, "Render time of a frame", {}, self.graph.frame_time
+        for collect in collectors:
+            for sample in collect():
+                yield sample
+    
     def on_exit(self, event):
+        if self.metrics_server is not None:
+            self.metrics_server.close()
         self.Destroy()
     
     def flash_status_message(self, msg, flash_len_ms=1500):
@@ -623,7 +456,7 @@ class GraphFrame(wx.Frame):
 
 
 if __name__ == '__main__':
-    app = wx.PySimpleApp()
+    app = wx.App(False)
     app.frame = GraphFrame()
     app.frame.Show()
     app.MainLoop()